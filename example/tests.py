@@ -1,10 +1,27 @@
 import math
+import time
 import random
+import os
+import tempfile
+import json
+import re
+import asyncio
+import tracemalloc
+import threading
+import statistics
+import sys
 
 import pystats2md
 from pystats2md.stats_subset import *
 from pystats2md.stats_file import *
+from pystats2md.stats_database import *
 from pystats2md.micro_bench import *
+from pystats2md.bench_suite import *
+from pystats2md.resource_sampler import *
+from pystats2md.stats_plot import *
+from pystats2md.svg_chart import *
+from pystats2md.device_specs import *
+from pystats2md.aggregation import *
 
 f = StatsFile('example/benchmarks.json')
 
@@ -39,3 +56,744 @@ assert f.existing_index(MicroBench(
 # )
 # f.upsert(b)
 # f.dump_to_file()
+
+grouped = StatsSubset.group(
+    f.benchmarks,
+    'database_name', 'benchmark_name',
+    operations_per_second=Aggregation.take_max,
+)
+assert len(grouped) == 16
+assert all(isinstance(g['operations_per_second'], float) for g in grouped)
+assert StatsSubset.group(f.benchmarks, 'num_cpus')[0]['num_cpus'] == 16
+
+vals = [random.gauss(10, 3) for _ in range(1000)]
+welford = MeanAccumulator()
+for v in vals[:400]:
+    welford.add(v)
+welford_tail = MeanAccumulator()
+for v in vals[400:]:
+    welford_tail.add(v)
+welford.merge(welford_tail)
+assert math.isclose(welford.result(), Aggregation.take_mean(vals))
+assert math.isclose(welford.stdev(), Aggregation.take_stdev(vals))
+median = Aggregation.quantile(0.5)
+for v in vals:
+    median.add(v)
+assert abs(median.result() / Aggregation.take_median(vals) - 1) < 0.05
+
+unindexed = StatsFile('example/benchmarks.json', indexed=False)
+for b in f.benchmarks:
+    criterea = {k: b[k] for k in ['benchmark_name', 'dataset_name', 'database_name']}
+    assert f.existing_index(criterea) == unindexed.existing_index(criterea)
+replacement = {**f.benchmarks[1], 'operations_per_second': 0}
+assert f.upsert(replacement) == True
+assert f.upsert({**replacement, 'benchmark_name': 'Unknown'}) == True
+assert f.existing_index({'benchmark_name': 'Unknown'}) == len(f.benchmarks) - 1
+f.reset_from_file()
+assert not f.contains({'benchmark_name': 'Unknown'})
+
+heterogeneous = StatsFile()
+for i in range(100):
+    heterogeneous.upsert({'benchmark_name': 'Mixed', f'field_{i}': i, 'result': random.random()})
+    heterogeneous.contains({'benchmark_name': 'Mixed', f'field_{i}': i})
+assert len(heterogeneous.benchmarks) == 100
+assert len(heterogeneous._identity_indexes) == 0
+for i in range(20):
+    assert heterogeneous.existing_index({f'field_{i}': i}) == i
+    assert heterogeneous.existing_index({f'field_{i}': i}) == i
+assert len(heterogeneous._identity_indexes) <= StatsFile.identity_indexes_limit
+
+with tempfile.TemporaryDirectory() as temp_dir:
+    log_path = os.path.join(temp_dir, 'log.jsonl')
+    log = StatsFile(log_path)
+    for b in f.benchmarks:
+        log.upsert(MicroBench(
+            func=lambda: 1,
+            benchmark_name=b['benchmark_name'],
+            device_name=b['device_name'],
+            database_name=b['database_name'],
+            dataset_name=b['dataset_name'],
+            save_io=False,
+            save_source=False,
+            limit_iterations=10,
+        ))
+    again = MicroBench(
+        func=lambda: 1,
+        benchmark_name='Insert Dump',
+        device_name='macbook',
+        database_name='MongoDB',
+        dataset_name='Movie Ratings',
+        save_io=False,
+        save_source=False,
+        limit_iterations=20,
+    )
+    again.run()
+    assert log.upsert(again) == False
+    assert len(log.benchmarks) == len(f.benchmarks)
+    count_lines = len(open(log_path).readlines())
+    assert count_lines == len(f.benchmarks) + 1
+
+    replayed = StatsFile(log_path)
+    assert replayed.benchmarks == log.benchmarks
+    assert replayed.benchmarks[0]['count_iterations'] == 20
+    replayed.compact()
+    assert len(open(log_path).readlines()) == len(f.benchmarks)
+    assert StatsFile(log_path).benchmarks == log.benchmarks
+
+    in_memory = StatsFile()
+    in_memory.upsert({'benchmark_name': 'Unsaved'})
+    working_dir = os.getcwd()
+    os.chdir(temp_dir)
+    try:
+        in_memory.dump_to_file()
+        dumped = True
+    except AssertionError:
+        dumped = False
+    finally:
+        os.chdir(working_dir)
+    assert not dumped
+    assert not os.path.exists(os.path.join(temp_dir, 'None.tmp'))
+
+    google_path = os.path.join(temp_dir, 'google.json')
+    json.dump({
+        'context': {'num_cpus': 8, 'library_build_type': 'release'},
+        'benchmarks': [
+            {'name': f'BM_Sort/{i}', 'real_time': i * 1.5, 'iterations': 10 ** 6}
+            for i in range(1000)
+        ],
+    }, open(google_path, 'w'))
+    google_file = StatsFile(google_path)
+    assert google_file.context['num_cpus'] == 8
+    assert len(google_file.benchmarks) == 1000
+    assert google_file.benchmarks[7]['num_cpus'] == 8
+
+    streamed = StatsFile.stream(google_path, chunk_size=7)
+    assert list(streamed) == google_file.benchmarks
+    matches = StatsSubset.filter(
+        StatsFile.stream(google_path), name=re.compile('BM_Sort/99.*'))
+    assert len(matches) == 11
+
+    # Streamed logs keep the entries in the order of their last update.
+    log.upsert(again)
+    streamed = list(StatsFile.stream(log_path))
+    assert len(streamed) == len(log.benchmarks)
+    assert streamed[-1] == log.benchmarks[0]
+
+    db = StatsDatabase(os.path.join(temp_dir, 'history.sqlite'))
+    db.append(f)
+    assert len(db.benchmarks) == len(f.benchmarks)
+    assert db.existing_index({
+        'benchmark_name': 'Insert Dump',
+        'database_name': 'MongoDB',
+        'dataset_name': 'Patent Citations Graph',
+    }) == 1
+    assert len(db.filtered(database_name='SQLite').dicts_list) == 8
+    pushed = db.grouped(
+        'database_name', 'benchmark_name',
+        operations_per_second=Aggregation.take_max,
+    ).dicts_list
+    by_keys = lambda g: (g['database_name'], g['benchmark_name'])
+    assert sorted(pushed, key=by_keys) == sorted(grouped, key=by_keys)
+    assert db.table('database_name', 'benchmark_name', 'operations_per_second').print() == \
+        f.table('database_name', 'benchmark_name', 'operations_per_second').print()
+    singles = db.grouped(
+        'database_name', 'benchmark_name', 'dataset_name',
+        operations_per_second=Aggregation.take_max,
+    ).dicts_list
+    assert sorted(singles, key=by_keys) == sorted(StatsSubset.group(
+        f.benchmarks, 'database_name', 'benchmark_name', 'dataset_name',
+        operations_per_second=Aggregation.take_max), key=by_keys)
+    # Modifications are batched and mirrored in the loaded entries.
+    loaded = db.benchmarks
+    db.upsert({**f.benchmarks[0], 'operations_per_second': 1})
+    assert db.benchmarks is loaded and db.has_unsaved_changes()
+    assert len(loaded) == len(f.benchmarks) + 1
+    assert loaded[-1]['operations_per_second'] == 1
+    db.upsert({**f.benchmarks[0], 'operations_per_second': 2},
+              criterea={**f.benchmarks[0], 'operations_per_second': 1})
+    assert len(loaded) == len(f.benchmarks) + 1
+    assert loaded[-1]['operations_per_second'] == 2
+    db.dump_to_file()
+    assert not db.has_unsaved_changes()
+    db.close()
+    assert len(StatsDatabase(os.path.join(temp_dir, 'history.sqlite')).benchmarks) == len(f.benchmarks) + 1
+
+columnar = StatsSubset(f, columnar=True)
+assert columnar.dicts_list == f.benchmarks
+assert columnar.unique('database_name') == StatsSubset(f).unique('database_name')
+assert StatsSubset(f, columnar=True).filtered(database_name=re.compile('SQ.*'), num_cpus=16).dicts_list == \
+    StatsSubset(f).filtered(database_name=re.compile('SQ.*'), num_cpus=16).dicts_list
+for policy in [Aggregation.take_mean, Aggregation.take_max, Aggregation.take_median]:
+    expected = StatsSubset(f).grouped(
+        'database_name', 'benchmark_name', operations_per_second=policy).dicts_list
+    received = StatsSubset(f, columnar=True).grouped(
+        'database_name', 'benchmark_name', operations_per_second=policy).dicts_list
+    assert len(expected) == len(received)
+    for e, r in zip(sorted(expected, key=by_keys), sorted(received, key=by_keys)):
+        assert e.keys() == r.keys()
+        assert math.isclose(e['operations_per_second'], r['operations_per_second'])
+
+mixed = [
+    {'name': random.choice('ABC'), 'threads': random.choice([1, 2, 1 << 40]),
+     'load': random.choice([0.5, 1.5]), 'secs': random.random()}
+    for _ in range(500)
+] + [{'name': 'A', 'secs': 1.0}, {'threads': 1, 'secs': 1.0}]
+for keys in [('name',), ('name', 'threads'), ('threads', 'load', 'name')]:
+    expected = StatsSubset(mixed).filtered(name=re.compile('[AB]')).grouped(
+        *keys, secs=Aggregation.take_mean).dicts_list
+    received = StatsSubset(mixed, columnar=True).filtered(name=re.compile('[AB]')).grouped(
+        *keys, secs=Aggregation.take_mean).dicts_list
+    assert [tuple(e[k] for k in keys) for e in expected] == \
+        [tuple(r[k] for k in keys) for r in received]
+    assert all(math.isclose(e['secs'], r['secs']) for e, r in zip(expected, received))
+# Integer sums and extremes stay exact beyond the precision of floats.
+huge = [{'name': n, 'bytes': (1 << 60) + i} for i, n in enumerate('ABAB')]
+for policy in [Aggregation.take_sum, Aggregation.take_max, Aggregation.take_min]:
+    assert StatsSubset(huge, columnar=True).grouped('name', bytes=policy).dicts_list == \
+        StatsSubset(huge).grouped('name', bytes=policy).dicts_list
+
+view =f.subset().filtered(database_name='SQLite')
+assert all(any(d is b for b in f.benchmarks) for d in view.dicts_list)
+view.dicts_list.append({'database_name': 'SQLite'})
+assert len(view) == 9 and len(f.benchmarks) == 32
+shared = f.subset()
+assert shared._source is f.benchmarks
+shared.include([{'database_name': 'Unknown'}])
+assert len(shared) == 33 and len(f.benchmarks) == 32
+whole = f.subset()
+sqlite_view = f.filtered(database_name='SQLite')
+sqlite_before = [b['operations_per_second'] for b in sqlite_view]
+f.upsert({'benchmark_name': 'New', 'database_name': 'SQLite'})
+f.upsert({**sqlite_view.dicts_list[0], 'operations_per_second': -1},
+         criterea={k: sqlite_view.dicts_list[0][k] for k in ['benchmark_name', 'database_name', 'dataset_name']})
+assert len(whole) == 32 and len(f.benchmarks) == 33
+assert [b['operations_per_second'] for b in sqlite_view] == sqlite_before
+assert len(f.filtered(database_name='SQLite')) == 9
+f.reset_from_file()
+col_names = ['Find Entry']
+f.subset().table(
+    'database_name', 'benchmark_name', 'operations_per_second',
+    col_names=col_names,
+).add_gains()
+assert col_names == ['Find Entry']
+
+lazy = StatsSubset('example/benchmarks.json', lazy=True) \
+    .grouped('database_name', 'benchmark_name', operations_per_second=Aggregation.take_mean) \
+    .filtered(database_name=re.compile('.*SQL.*')) \
+    .filtered(benchmark_name='Find Entry')
+plan, used_fields = StatsSubset.optimize(lazy._plan, {'database_name'})
+assert [step[0] for step in plan] == ['filter', 'group']
+assert used_fields == {'database_name', 'benchmark_name', 'operations_per_second'}
+eager = StatsSubset(f) \
+    .grouped('database_name', 'benchmark_name', operations_per_second=Aggregation.take_mean) \
+    .filtered(database_name=re.compile('.*SQL.*')) \
+    .filtered(benchmark_name='Find Entry')
+assert lazy.unique('database_name') == eager.unique('database_name') == ['MySQL', 'PostgreSQL', 'SQLite']
+assert lazy.table('database_name', 'benchmark_name', 'operations_per_second').print() == \
+    eager.table('database_name', 'benchmark_name', 'operations_per_second').print()
+assert lazy.is_lazy() and len(lazy) == 3 and not lazy._is_pending()
+for lazy_input in [StatsFile.stream('example/benchmarks.json'),
+                   lambda: StatsFile.stream('example/benchmarks.json')]:
+    streamed = StatsSubset(lazy_input, lazy=True).filtered(num_cpus=16)
+    assert streamed.unique('database_name') == StatsSubset(f).unique('database_name')
+    assert streamed.unique('database_name') == StatsSubset(f).unique('database_name')
+    assert streamed.table('database_name', 'benchmark_name', 'operations_per_second').print() == \
+        f.table('database_name', 'benchmark_name', 'operations_per_second').print()
+
+for filters in [
+    dict(database_name='MySQL'),
+    dict(database_name='MySQL', benchmark_name='Find Entry'),
+    dict(database_name=re.compile('^Mo'), num_cpus=16),
+    dict(num_cpus=16.0, build_type='debug'),
+    dict(database_name='Unknown'),
+]:
+    expected = [b for b in f.benchmarks if all(
+        (isinstance(v, re.Pattern) and v.search(b.get(k, ''))) or b.get(k) == v
+        for k, v in filters.items())]
+    assert f.filtered(**filters).dicts_list == expected
+    assert StatsSubset(list(f.benchmarks)).filtered(**filters).dicts_list == expected
+    assert f.filtered(device_name='macbook').filtered(**filters).dicts_list == expected
+
+for i in range(StatsSubset._regex_patterns_limit * 2):
+    assert len(f.filtered(database_name=re.compile(f'^Mo|#{i}#'))) == \
+        len(f.filtered(database_name='MongoDB'))
+assert len(StatsSubset._regex_cache) <= StatsSubset._regex_patterns_limit
+
+assert f.subset().unique('num_cpus') == [16]
+pivot = f.subset().table(
+    'database_name', 'num_cpus', 'operations_per_second',
+    cell_aggregation=Aggregation.take_max,
+)
+assert pivot.header_row == [16]
+assert pivot.content[pivot.header_col.index('SQLite')][0] == max(
+    b['operations_per_second'] for b in f.benchmarks if b['database_name'] == 'SQLite')
+assert '| SQLite |' in pivot.print().replace('  ', ' ').replace('  ', ' ')
+medians = f.subset().table(
+    'database_name', 'benchmark_name', 'operations_per_second',
+    cell_aggregation=Aggregation.take_median,
+)
+assert medians.content == f.subset().grouped(
+    'database_name', 'benchmark_name', operations_per_second=Aggregation.take_median,
+).table('database_name', 'benchmark_name', 'operations_per_second').content
+
+exact = MicroBench(
+    func=lambda: 5,
+    limit_iterations=137,
+    limit_operations=None,
+    limit_seconds=None,
+    save_io=False,
+)
+exact.run()
+assert exact.count_iterations == 137 and exact.count_operations == 685
+assert 0 <= exact.time_elapsed < 1
+
+with tempfile.TemporaryDirectory() as temp_dir:
+    latencies = StatsFile(os.path.join(temp_dir, 'latencies.json'))
+    for name, func in [('Sine', lambda: math.sin(random.random())), ('Sum', lambda: sum(range(100)))]:
+        latencies.upsert(MicroBench(
+            func=func,
+            benchmark_name=name,
+            limit_iterations=5000,
+            save_io=False,
+            save_source=False,
+            save_latencies=True,
+        ))
+    latencies.dump_to_file()
+    latencies.reset_from_file()
+    sine = latencies.benchmarks[0]
+    # Every call is timed separately, when latencies are saved.
+    assert QuantileSketch.from_dict(sine['latency_histogram']).count == sine['count_iterations']
+    assert sine['msecs_p50'] <= sine['msecs_p90'] <= sine['msecs_p99'] <= sine['msecs_p999'] <= sine['msecs_max']
+    percentiles = latencies.subset().latency_table()
+    assert percentiles.header_col == ['Sine', 'Sum']
+    assert percentiles.header_row == ['p50', 'p90', 'p99', 'p999', 'max']
+    cdf = latencies.subset().latency_plot(title='Latencies').histograms['Sine'].cdf()
+    assert cdf[-1][1] == 1.0 and cdf[0][0] <= sine['msecs_p50'] * 1.02
+
+    without_histogram = {k: v for k, v in sine.items() if k != 'latency_histogram'}
+    restored = MicroBench(func=lambda: 1, save_latencies=True, serialized=without_histogram)
+    assert restored.latencies.count == 0
+    assert 'msecs_p50' not in restored.stats()
+
+warmed = MicroBench(
+    func=lambda: sum(range(100)),
+    limit_iterations=None,
+    limit_operations=None,
+    limit_seconds=5,
+    warmup_iterations=100,
+    target_relative_error=0.5,
+    save_io=False,
+)
+warmed.run()
+assert warmed.batch_latencies.count >= MicroBench.min_batches
+assert warmed.relative_error() <= 0.5
+assert warmed.serialize()['relative_error'] == warmed.relative_error()
+single = MicroBench(func=lambda: 1, limit_iterations=1, target_relative_error=0.5,
+                    warmup_iterations=0, save_io=False)
+single.run()
+assert single.relative_error() == math.inf
+json.dumps(single.serialize(), allow_nan=False)
+if sys.version_info >= (3, 8):
+    import pystats2md.micro_bench as micro_bench
+    for confidence, z in micro_bench._z_scores.items():
+        assert math.isclose(statistics.NormalDist().inv_cdf((1 + confidence) / 2), z, abs_tol=1e-4)
+
+with tempfile.TemporaryDirectory() as temp_dir:
+    suite_path = os.path.join(temp_dir, 'suite.jsonl')
+    suite_file = StatsFile(suite_path)
+    suite_file.upsert(MicroBench(
+        func=lambda: sum(range(10)), benchmark_name='Sum', items=10,
+        limit_iterations=10, limit_operations=None, save_io=False, save_source=False))
+    suite = BenchSuite(source=suite_file, max_workers=2, pin_cpus=True)
+    for items in [10, 100, 1000]:
+        suite.add(MicroBench(
+            func=lambda items=items: sum(range(items)), benchmark_name='Sum', items=items,
+            limit_iterations=10, limit_operations=None, save_io=False, save_source=False))
+    assert len(suite.pending()) == 2
+    suite.run()
+    assert len(suite.pending()) == 0
+    assert all(b.did_run() for b in suite.benches[1:])
+    resumed = StatsFile(suite_path)
+    assert sorted(b['items'] for b in resumed.benchmarks) == [10, 100, 1000]
+    assert all(b['count_iterations'] == 10 for b in resumed.benchmarks)
+    isolated = BenchSuite([*suite.benches, MicroBench(
+        func=lambda: sum(range(10000)), benchmark_name='Sum', items=10000,
+        limit_iterations=10, limit_operations=None, save_io=False, save_source=False)], source=resumed, isolate=True)
+    assert len(isolated.pending()) == 1
+    isolated.run()
+    assert len(StatsFile(suite_path).benchmarks) == 4
+
+    in_memory = StatsFile()
+    working_dir = os.getcwd()
+    os.chdir(temp_dir)
+    try:
+        BenchSuite([MicroBench(
+            func=lambda items=items: sum(range(items)), benchmark_name='Sum', items=items,
+            limit_iterations=10, limit_operations=None, save_io=False, save_source=False)
+            for items in [10, 100]], source=in_memory, max_workers=2).run()
+    finally:
+        os.chdir(working_dir)
+    assert sorted(b['items'] for b in in_memory.benchmarks) == [10, 100]
+    assert not os.path.exists(os.path.join(temp_dir, 'None.tmp'))
+
+    # Without `fork` the benches run in this process one after another.
+    import multiprocessing
+    start_methods = multiprocessing.get_all_start_methods
+    multiprocessing.get_all_start_methods = lambda: ['spawn']
+    try:
+        sequential = StatsFile(os.path.join(temp_dir, 'sequential.json'))
+        BenchSuite([MicroBench(
+            func=lambda items=items: sum(range(items)), benchmark_name='Sum', items=items,
+            limit_iterations=10, limit_operations=None, save_io=False, save_source=False)
+            for items in [10, 100]], source=sequential).run()
+    finally:
+        multiprocessing.get_all_start_methods = start_methods
+    assert sorted(b['items'] for b in StatsFile(sequential.filename).benchmarks) == [10, 100]
+
+with tempfile.TemporaryDirectory() as temp_dir:
+    scaling_file = StatsFile(os.path.join(temp_dir, 'scaling.json'))
+    for executor in ['threads', 'processes']:
+        sweep = MicroBench.sweep(
+            lambda: time.sleep(0.001), [1, 2], source=scaling_file,
+            benchmark_name='Sleep', executor=executor, threads=executor == 'threads',
+            limit_iterations=20, limit_operations=None, save_io=False, save_source=False)
+        assert [b.count_iterations for b in sweep] == [20, 40]
+        assert sweep[0].scaling_efficiency() == 1.0
+        assert sweep[1].scaling_efficiency() > 0.5
+    scaling = scaling_file.table('concurrency', 'threads', 'scaling_efficiency')
+    assert scaling.header_col == [1, 2]
+    resumed = MicroBench.sweep(
+        lambda: time.sleep(0.001), [1, 2], source=scaling_file,
+        benchmark_name='Sleep', threads=True, save_io=False, save_source=False)
+    assert not any(b.did_run() for b in resumed)
+
+# Forked workers, that die without posting results, fail the run instead of hanging it.
+parent_pid = os.getpid()
+crashing = MicroBench(
+    func=lambda: os.getpid() == parent_pid or os._exit(3),
+    concurrency=2, executor='processes', limit_iterations=20,
+    limit_operations=None, save_io=False, save_source=False)
+try:
+    crashing.run()
+    assert False, 'Crashed workers must be reported'
+except RuntimeError as e:
+    assert 'code 3' in str(e)
+
+
+async def async_request():
+    await asyncio.sleep(0.001)
+
+windowed = MicroBench(
+    func=async_request,
+    max_in_flight=10,
+    limit_iterations=100,
+    limit_operations=None,
+    warmup_iterations=10,
+    save_io=False,
+    save_latencies=True,
+)
+windowed.run()
+assert windowed.count_iterations == 100 and windowed.count_operations == 100
+assert windowed.time_elapsed < windowed.stats()['msecs_per_request'] * 100 / 1000 / 2
+assert windowed.latencies.count == 100
+
+
+async def run_inside_loop() -> MicroBench:
+    # Like in Jupyter or async test harnesses, where a loop is already running.
+    bench = MicroBench(func=async_request, max_in_flight=5, limit_iterations=20,
+                       limit_operations=None, warmup_iterations=5, save_io=False)
+    await bench.run_async()
+    return bench
+
+awaited = asyncio.run(run_inside_loop())
+assert awaited.did_run() and awaited.count_iterations == 20
+
+retained = list()
+leaky = MicroBench(
+    func=lambda: retained.append(bytearray(1000)),
+    limit_iterations=500,
+    limit_operations=None,
+    save_io=False,
+    save_memory=True,
+)
+leaky.run()
+leaky_stats = leaky.serialize()
+assert 1000 <= leaky_stats['traced_retained_bytes_per_operation'] < 1200
+assert leaky_stats['traced_peak_bytes'] >= 500 * 1000
+assert 'gc_collections_gen0' in leaky_stats and 'rss_delta_bytes' in leaky_stats
+assert not tracemalloc.is_tracing()
+
+# Tracing started by the caller keeps running, but the peak starts anew.
+tracemalloc.start()
+spike = bytearray(10 ** 7)
+del spike
+reset_peak = tracemalloc.reset_peak
+for supports_reset in [True, False]:
+    if not supports_reset:
+        del tracemalloc.reset_peak
+    try:
+        small = MicroBench(func=lambda: bytearray(100), limit_iterations=10,
+                           limit_operations=None, save_io=False, save_memory=True)
+        small.run()
+    finally:
+        tracemalloc.reset_peak = reset_peak
+    assert small.serialize()['traced_peak_bytes'] < 10 ** 6
+    assert tracemalloc.is_tracing()
+tracemalloc.stop()
+
+
+def failing():
+    raise ValueError('Expected failure')
+
+count_threads = threading.active_count()
+for is_async in [False, True]:
+    async def failing_async():
+        failing()
+    try:
+        MicroBench(func=failing_async if is_async else failing, save_io=False,
+                   save_memory=True, sample_interval=0.01).run()
+        failed = False
+    except ValueError:
+        failed = True
+    assert failed and not tracemalloc.is_tracing()
+    assert threading.active_count() == count_threads
+
+sampled = MicroBench(
+    func=lambda: sum(range(1000)),
+    benchmark_name='Sampled',
+    limit_iterations=None,
+    limit_operations=None,
+    limit_seconds=0.3,
+    sample_interval=0.02,
+    save_io=False,
+)
+sampled.run()
+assert len(sampled.timeline) >= 5
+encoded = json.loads(json.dumps(sampled.serialize()))['resource_timeline']
+decoded = ResourceSampler.from_dict(encoded)
+assert decoded['msecs'] == sampled.timeline.msecs
+assert decoded['rss_bytes'] == sampled.timeline.series['rss_bytes']
+assert all(0 <= p <= 100 for p in decoded['cpu_percent'])
+timeline_plot = StatsSubset(source=[sampled.serialize()]).timeline_plot(title='CPU Load')
+assert list(timeline_plot.timelines.keys()) == ['Sampled']
+side_by_side = pystats2md.Report().add_plots(timeline_plot, timeline_plot.__class__(
+    timeline_plot.timelines, title='Memory', metric='rss_bytes'))
+assert side_by_side.content.count('![') == 2 and side_by_side.content.count('\n') == 2
+assert timeline_plot.spec()['backend'] == StatsPlot.default_backend()
+with tempfile.TemporaryDirectory() as temp_dir:
+    import xml.dom.minidom
+    sketch = QuantileSketch()
+    for i in range(1, 100):
+        sketch.add(i / 10)
+    for plot in [
+        StatsSubset(source=[sampled.serialize()]).timeline_plot(title='CPU Load', backend='svg'),
+        LatencyPlot({'Uniform': sketch, 'Empty': QuantileSketch()}, title='Latencies', backend='svg'),
+    ]:
+        plot_path = os.path.join(temp_dir, 'lines.svg')
+        assert plot.render_to(plot_path) and plot.is_rendered(plot_path)
+        lines = xml.dom.minidom.parse(plot_path).getElementsByTagName('polyline')
+        assert len(lines) == len(plot.spec().get('histograms', plot.spec().get('timelines')))
+
+
+def profiled_inner(n):
+    return sum(math.sqrt(i) for i in range(n))
+
+
+def profiled_outer():
+    profiled_inner(100)
+
+with tempfile.TemporaryDirectory() as temp_dir:
+    profiles = StatsFile(os.path.join(temp_dir, 'profiles.json'))
+    for profiler in ['cprofile', 'sampling']:
+        profiles.upsert(MicroBench(
+            func=profiled_outer,
+            source=profiles,
+            profiler_name=profiler,
+            limit_iterations=10,
+            save_io=False,
+            profile=True,
+            profiler=profiler,
+            profile_seconds=0.3,
+            profile_top=3,
+            save_stacks=profiler == 'sampling',
+        ))
+    by_profiler = {b['profiler_name']: b for b in profiles.benchmarks}
+    assert len(by_profiler['cprofile']['hotspots']) == 3
+    assert 'stacks_path' not in by_profiler['cprofile']
+    folded = open(by_profiler['sampling']['stacks_path']).read().splitlines()
+    assert all(line.startswith('profiled_outer') for line in folded)
+    all_profiles = profiles.subset()
+    hotspots = all_profiles.hotspots_table('profiled_outer', profiler_name='cprofile')
+    assert len(all_profiles) == 2
+    assert hotspots.header_row == ['Own %', 'Total %', 'Calls']
+    assert any('tests.py' in f for f in hotspots.header_col)
+    assert '| Own % |' in hotspots.print()
+
+
+class CountingPlot(StatsPlot):
+
+    def save_to(self, path: str = '') -> str:
+        with open(path, 'w') as f:
+            f.write(f'<svg xmlns="http://www.w3.org/2000/svg"><text>{self.title}</text></svg>')
+        return path
+
+with tempfile.TemporaryDirectory() as temp_dir:
+    report_path = os.path.join(temp_dir, 'README.md')
+    charts_table = f.table('database_name', 'benchmark_name', 'operations_per_second')
+
+    def cached_report(titles: list) -> pystats2md.Report:
+        r = pystats2md.Report()
+        for title in titles:
+            r.add(CountingPlot(charts_table, title=title))
+        return r
+    cached_report(['First', 'Second', 'Third']).print_to(report_path, max_workers=2)
+    chart_paths = {t: os.path.join(temp_dir, t + '.svg') for t in ['First', 'Second', 'Third']}
+    mtimes = {t: os.stat(p).st_mtime_ns for t, p in chart_paths.items()}
+    assert all(CountingPlot(charts_table, title=t).is_rendered(p) for t, p in chart_paths.items())
+    changed = CountingPlot(charts_table, title='Second', print_height=False)
+    r = cached_report(['First', 'Third'])
+    r.add(changed)
+    r.print_to(report_path)
+    assert os.stat(chart_paths['First']).st_mtime_ns == mtimes['First']
+    assert os.stat(chart_paths['Third']).st_mtime_ns == mtimes['Third']
+    assert changed.is_rendered(chart_paths['Second'])
+
+assert [si2str(v) for v in [0, 1234, 999.7, 0.00056, 45e6, -2500]] == ['0', '1.2k', '1.0k', '560µ', '45M', '-2.5k']
+assert nice_ticks(0, 43000) == [0, 10000, 20000, 30000, 40000, 50000]
+with tempfile.TemporaryDirectory() as temp_dir:
+    svg_path = os.path.join(temp_dir, 'bars.svg')
+    f.plot(
+        title='DB Performance <Ops/Sec>', variants='database_name', groups='benchmark_name',
+        values='operations_per_second', backend='svg',
+    ).render_to(svg_path)
+    import xml.dom.minidom
+    svg = xml.dom.minidom.parse(svg_path)
+    bars = [r for r in svg.getElementsByTagName('rect') if r.getElementsByTagName('title')]
+    assert len(bars) == len(f.subset().unique('database_name')) * len(f.subset().unique('benchmark_name'))
+    assert bars[0].getAttribute('fill') == prism_colors[0]
+
+import subprocess
+import_check = subprocess.run([sys.executable, '-c', '''
+import sys, time
+started = time.perf_counter()
+import pystats2md
+print(time.perf_counter() - started)
+print(','.join(m for m in ['plotly', 'psutil', 'cpuinfo', 'numpy', 'asyncio', 'sqlite3'] if m in sys.modules))
+'''], capture_output=True, text=True, check=True, env={**os.environ, 'PYTHONPATH': os.getcwd()})
+import_secs, heavy_imports = import_check.stdout.splitlines()
+assert heavy_imports == '', heavy_imports
+assert float(import_secs) < 1.0, import_secs
+
+with tempfile.TemporaryDirectory() as temp_dir:
+    os.environ['PYSTATS2MD_CACHE_DIR'] = temp_dir
+    DeviceSpecs._current = None
+    probed = DeviceSpecs.current()
+    assert DeviceSpecs.cache_path().exists()
+    assert 'mhz_per_cpu' not in probed
+    # Other processes load the specs from disk, instead of probing.
+    with open(DeviceSpecs.cache_path()) as specs_file:
+        cached = json.load(specs_file)
+    cached['cpu_model'] = 'Cached CPU'
+    with open(DeviceSpecs.cache_path(), 'w') as specs_file:
+        json.dump(cached, specs_file)
+    DeviceSpecs._current = None
+    assert DeviceSpecs.current()['cpu_model'] == 'Cached CPU'
+    assert DeviceSpecs.current(ttl_seconds=0)['cpu_model'] == probed['cpu_model']
+    assert 'Cached CPU' not in pystats2md.Report().add_current_device_specs().content
+
+    compact = MicroBench(
+        func=lambda: None, limit_iterations=10, save_io=False, save_source=False,
+        save_context='fingerprint')
+    compact.run()
+    compact_record = compact.serialize()
+    assert compact_record['device_fingerprint'] == probed['device_fingerprint']
+    assert 'num_cpus' not in compact_record and 'date_utc' in compact_record
+    assert 'mhz_per_cpu' in MicroBench(func=lambda: None).context()
+    assert compact_record['build_type'] == ('debug' if __debug__ else 'release')
+
+    compact_path = os.path.join(temp_dir, 'compact.json')
+    compact_file = StatsFile(compact_path)
+    compact_file.upsert(MicroBench(
+        func=lambda: None, limit_iterations=10, save_io=False, save_source=False,
+        save_context='fingerprint'))
+    compact_file.dump_to_file()
+    reloaded = StatsFile(compact_path)
+    fingerprint = reloaded.benchmarks[0]['device_fingerprint']
+    assert reloaded.device_specs(fingerprint)['num_cpus'] == probed['num_cpus']
+    assert os.path.exists(reloaded.devices_filename())
+    del os.environ['PYSTATS2MD_CACHE_DIR']
+    DeviceSpecs._current = None
+
+with tempfile.TemporaryDirectory() as temp_dir:
+    sections_source = StatsFile(os.path.join(temp_dir, 'sections.json'))
+    sections_source.benchmarks = [dict(b) for b in f.benchmarks]
+    sections_source.dump_to_file()
+    builds = list()
+
+    def build_ops_table(part: pystats2md.Report):
+        builds.append('ops')
+        part.add(sections_source.table('database_name', 'benchmark_name', 'operations_per_second'))
+
+    def sectioned_report(query: str = 'ops') -> pystats2md.Report:
+        r = pystats2md.Report()
+        r.add('# Results')
+        r.add_section('ops', build_ops_table, inputs=[sections_source, query])
+        return r
+
+    generated_path = os.path.join(temp_dir, 'generated.md')
+    sectioned_report().print_to(generated_path)
+    first_output = open(generated_path).read()
+    assert builds == ['ops'] and '<!-- pystats2md:begin ops ' in first_output
+    sectioned_report().print_to(generated_path)
+    assert builds == ['ops'] and open(generated_path).read() == first_output
+    sectioned_report(query='other').print_to(generated_path)
+    assert builds == ['ops', 'ops'] and open(generated_path).read() != first_output
+
+    readme_path = os.path.join(temp_dir, 'README.md')
+    with open(readme_path, 'w') as readme:
+        readme.write('# Hand-written\n\nIntro.\n\n<!-- pystats2md:begin ops stale -->\nOld table\n<!-- pystats2md:end ops -->\n\nOutro.\n')
+    sectioned_report().splice_into(readme_path)
+    spliced = open(readme_path).read()
+    assert spliced.startswith('# Hand-written\n\nIntro.\n\n') and spliced.endswith('\nOutro.\n')
+    assert 'Old table' not in spliced and '# Results' not in spliced
+    assert spliced.count('<!-- pystats2md:begin ops ') == 1
+    sectioned_report().splice_into(readme_path)
+    assert builds == ['ops'] * 3 and open(readme_path).read() == spliced
+
+    # Saving the input file again invalidates its sections.
+    os.utime(sections_source.filename, ns=(0, 0))
+    sectioned_report().splice_into(readme_path)
+    assert builds == ['ops'] * 4
+
+    # So do the changes, that weren't saved yet.
+    sections_source.upsert({**sections_source.benchmarks[0], 'operations_per_second': 1})
+    assert sections_source.has_unsaved_changes()
+    sectioned_report().splice_into(readme_path)
+    assert builds == ['ops'] * 5
+    sectioned_report().splice_into(readme_path)
+    assert builds == ['ops'] * 5
+    sections_source.dump_to_file()
+    assert not sections_source.has_unsaved_changes()
+
+    # Charts of reused sections are regenerated, if deleted.
+    def build_ops_chart(part: pystats2md.Report):
+        builds.append('chart')
+        part.add(sections_source.plot('Sections Chart', 'database_name', 'benchmark_name',
+                                      'operations_per_second', backend='svg'))
+
+    charted = lambda: pystats2md.Report().add_section('chart', build_ops_chart, inputs=[sections_source])
+    chart_path = os.path.join(temp_dir, 'Sections_Chart.svg')
+    assert '![Sections Chart]' in charted().content and not os.path.exists(chart_path)
+    for print_report in [lambda r: r.print_to(generated_path), lambda r: r.splice_into(readme_path)]:
+        print_report(charted())
+        builds.clear()
+        print_report(charted())
+        assert builds == [] and os.path.exists(chart_path)
+        os.remove(chart_path)
+        print_report(charted())
+        assert builds == ['chart'] and os.path.exists(chart_path)
+
+    # The content can still be assigned and extended.
+    extended = pystats2md.Report().add_section('ops', build_ops_table, inputs=[sections_source])
+    extended.content += 'Footer\n'
+    assert extended.content.endswith('Footer\n') and 'pystats2md:begin ops' in extended.content
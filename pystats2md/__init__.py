@@ -1,8 +1,15 @@
 from .stats_file import *
+from .stats_database import *
 from .stats_subset import *
+from .stats_columns import *
 from .stats_table import *
 from .stats_plot import *
+from .svg_chart import *
 
 from .micro_bench import *
+from .bench_suite import *
+from .resource_sampler import *
+from .profiler import *
 from .aggregation import *
 from .report import *
+from .device_specs import *
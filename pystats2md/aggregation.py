@@ -1,4 +1,7 @@
+from __future__ import annotations
+from typing import Callable, Optional, List, Tuple
 import statistics
+import math
 
 
 class Aggregation(object):
@@ -62,3 +65,396 @@ class Aggregation(object):
         if len(vals) == 0:
             return 0
         return statistics.variance(vals)
+
+    @staticmethod
+    def quantile(q: float, relative_accuracy: float = 0.01) -> QuantileAccumulator:
+        """
+            Approximate streaming quantile policy, like `quantile(0.99)`.
+        """
+        return QuantileAccumulator(q, relative_accuracy)
+
+    @staticmethod
+    def accumulator_for(policy) -> Optional[Callable[[], Accumulator]]:
+        """
+            Returns a factory of empty accumulators for the given
+            aggregation policy or `None`, if the policy must be
+            applied to a fully materialized list of values.
+        """
+        if isinstance(policy, type) and issubclass(policy, Accumulator):
+            return policy
+        if isinstance(policy, Accumulator):
+            return policy.fresh
+        return _accumulators_for_policies.get(policy, None)
+
+
+class Accumulator(object):
+    """
+        Online reduction over a stream of values.
+        Values are added one at a time and accumulators of the
+        same kind can be merged, so reducing millions of stats
+        takes constant memory per group.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def fresh(self) -> Accumulator:
+        """
+            Returns an empty accumulator with the same settings.
+            Allows passing instances as aggregation policies.
+        """
+        return type(self)()
+
+    def add(self, val):
+        self.count += 1
+
+    def merge(self, other: Accumulator) -> Accumulator:
+        assert type(self) is type(other), 'Can only merge same accumulators'
+        self.count += other.count
+        return self
+
+    def result(self) -> object:
+        raise NotImplementedError()
+
+
+class CountAccumulator(Accumulator):
+
+    def result(self) -> int:
+        return self.count
+
+
+class FirstAccumulator(Accumulator):
+
+    def __init__(self):
+        super().__init__()
+        self.first = 0
+
+    def add(self, val):
+        if self.count == 0:
+            self.first = val
+        self.count += 1
+
+    def merge(self, other: FirstAccumulator) -> FirstAccumulator:
+        if self.count == 0:
+            self.first = other.first
+        return super().merge(other)
+
+    def result(self) -> object:
+        return self.first
+
+
+class LastAccumulator(Accumulator):
+
+    def __init__(self):
+        super().__init__()
+        self.last = 0
+
+    def add(self, val):
+        self.last = val
+        self.count += 1
+
+    def merge(self, other: LastAccumulator) -> LastAccumulator:
+        if other.count != 0:
+            self.last = other.last
+        return super().merge(other)
+
+    def result(self) -> object:
+        return self.last
+
+
+class MinAccumulator(Accumulator):
+
+    def __init__(self):
+        super().__init__()
+        self.min = 0
+
+    def add(self, val):
+        if self.count == 0 or val < self.min:
+            self.min = val
+        self.count += 1
+
+    def merge(self, other: MinAccumulator) -> MinAccumulator:
+        if other.count != 0 and (self.count == 0 or other.min < self.min):
+            self.min = other.min
+        return super().merge(other)
+
+    def result(self) -> float:
+        return self.min
+
+
+class MaxAccumulator(Accumulator):
+
+    def __init__(self):
+        super().__init__()
+        self.max = 0
+
+    def add(self, val):
+        if self.count == 0 or val > self.max:
+            self.max = val
+        self.count += 1
+
+    def merge(self, other: MaxAccumulator) -> MaxAccumulator:
+        if other.count != 0 and (self.count == 0 or other.max > self.max):
+            self.max = other.max
+        return super().merge(other)
+
+    def result(self) -> float:
+        return self.max
+
+
+class SumAccumulator(Accumulator):
+
+    def __init__(self):
+        super().__init__()
+        self.sum = 0
+
+    def add(self, val):
+        self.sum += val
+        self.count += 1
+
+    def merge(self, other: SumAccumulator) -> SumAccumulator:
+        self.sum += other.sum
+        return super().merge(other)
+
+    def result(self) -> float:
+        return self.sum
+
+
+class MeanAccumulator(Accumulator):
+    """
+        Welford's online algorithm for the mean and the sum of
+        squared deviations. Merging uses the pairwise update
+        by Chan et al., so partial results combine exactly.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.mean = 0.0
+        self.squares = 0.0
+
+    def add(self, val):
+        self.count += 1
+        delta = val - self.mean
+        self.mean += delta / self.count
+        self.squares += delta * (val - self.mean)
+
+    def merge(self, other: MeanAccumulator) -> MeanAccumulator:
+        assert type(self) is type(other), 'Can only merge same accumulators'
+        if other.count == 0:
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.squares += other.squares + \
+            delta * delta * self.count * other.count / count
+        self.count = count
+        return self
+
+    def variance(self) -> float:
+        if self.count < 2:
+            return 0
+        return self.squares / (self.count - 1)
+
+    def stdev(self) -> float:
+        return math.sqrt(self.variance())
+
+    def result(self) -> float:
+        if self.count == 0:
+            return 0
+        return self.mean
+
+
+class VarianceAccumulator(MeanAccumulator):
+
+    def result(self) -> float:
+        return self.variance()
+
+
+class StdevAccumulator(MeanAccumulator):
+
+    def result(self) -> float:
+        return self.stdev()
+
+
+class QuantileSketch(object):
+    """
+        Mergeable log-bucketed sketch of a distribution.
+        Every value lands in a bucket `ceil(log(|x|, gamma))`, so
+        any estimated quantile is within `relative_accuracy` of
+        the true value, while memory grows only with the logarithm
+        of the range of values.
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01):
+        assert 0 < relative_accuracy < 1, 'Accuracy must be in (0, 1)'
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positives = dict()
+        self.negatives = dict()
+        self.zeros = 0
+        self.count = 0
+        self.min = 0
+        self.max = 0
+
+    def bucket_of(self, val: float) -> int:
+        return math.ceil(math.log(val) / self.log_gamma)
+
+    def value_of(self, bucket: int) -> float:
+        return 2 * (self.gamma ** bucket) / (self.gamma + 1)
+
+    def add(self, val: float, times: int = 1):
+        if val > 0:
+            idx = self.bucket_of(val)
+            self.positives[idx] = self.positives.get(idx, 0) + times
+        elif val < 0:
+            idx = self.bucket_of(-val)
+            self.negatives[idx] = self.negatives.get(idx, 0) + times
+        else:
+            self.zeros += times
+        if self.count == 0 or val < self.min:
+            self.min = val
+        if self.count == 0 or val > self.max:
+            self.max = val
+        self.count += times
+
+    def merge(self, other: QuantileSketch) -> QuantileSketch:
+        assert self.gamma == other.gamma, 'Sketches must share accuracy'
+        if other.count == 0:
+            return self
+        for idx, n in other.positives.items():
+            self.positives[idx] = self.positives.get(idx, 0) + n
+        for idx, n in other.negatives.items():
+            self.negatives[idx] = self.negatives.get(idx, 0) + n
+        self.zeros += other.zeros
+        if self.count == 0 or other.min < self.min:
+            self.min = other.min
+        if self.count == 0 or other.max > self.max:
+            self.max = other.max
+        self.count += other.count
+        return self
+
+    def quantile(self, q: float) -> float:
+        assert 0 <= q <= 1, 'Quantile must be in [0, 1]'
+        if self.count == 0:
+            return 0
+        rank = q * (self.count - 1)
+        seen = 0
+        for idx in sorted(self.negatives.keys(), reverse=True):
+            seen += self.negatives[idx]
+            if seen > rank:
+                return max(-self.value_of(idx), self.min)
+        seen += self.zeros
+        if seen > rank:
+            return 0
+        for idx in sorted(self.positives.keys()):
+            seen += self.positives[idx]
+            if seen > rank:
+                return min(self.value_of(idx), self.max)
+        return self.max
+
+    def cdf(self) -> List[Tuple[float, float]]:
+        """
+            Returns pairs of bucket values and the fraction
+            of all the values not exceeding them, in ascending order.
+        """
+        points = list()
+        seen = 0
+        for idx in sorted(self.negatives.keys(), reverse=True):
+            seen += self.negatives[idx]
+            points.append((-self.value_of(idx), seen / self.count))
+        if self.zeros:
+            seen += self.zeros
+            points.append((0, seen / self.count))
+        for idx in sorted(self.positives.keys()):
+            seen += self.positives[idx]
+            points.append((self.value_of(idx), seen / self.count))
+        return points
+
+    def to_dict(self) -> dict:
+        """
+            Compact JSON-friendly representation, where sorted
+            bucket indexes are delta-encoded.
+        """
+        def encode(buckets: dict) -> dict:
+            indexes = sorted(buckets.keys())
+            deltas = [b - a for a, b in zip([0] + indexes, indexes)]
+            return {'deltas': deltas, 'counts': [buckets[i] for i in indexes]}
+
+        return {
+            'relative_accuracy': self.relative_accuracy,
+            'positives': encode(self.positives),
+            'negatives': encode(self.negatives),
+            'zeros': self.zeros,
+            'min': self.min,
+            'max': self.max,
+        }
+
+    @staticmethod
+    def from_dict(serialized: dict) -> QuantileSketch:
+        def decode(encoded: dict) -> dict:
+            buckets = dict()
+            idx = 0
+            for delta, count in zip(encoded['deltas'], encoded['counts']):
+                idx += delta
+                buckets[idx] = count
+            return buckets
+
+        sketch = QuantileSketch(serialized['relative_accuracy'])
+        sketch.positives = decode(serialized['positives'])
+        sketch.negatives = decode(serialized['negatives'])
+        sketch.zeros = serialized['zeros']
+        sketch.min = serialized['min']
+        sketch.max = serialized['max']
+        sketch.count = sketch.zeros + \
+            sum(sketch.positives.values()) + sum(sketch.negatives.values())
+        return sketch
+
+
+class QuantileAccumulator(Accumulator):
+    """
+        Approximate quantile on top of the `QuantileSketch`.
+    """
+
+    def __init__(self, quantile: float = 0.5, relative_accuracy: float = 0.01):
+        super().__init__()
+        self.quantile = quantile
+        self.sketch = QuantileSketch(relative_accuracy)
+
+    def fresh(self) -> QuantileAccumulator:
+        return QuantileAccumulator(
+            self.quantile, self.sketch.relative_accuracy)
+
+    def add(self, val):
+        self.sketch.add(val)
+        self.count += 1
+
+    def merge(self, other: QuantileAccumulator) -> QuantileAccumulator:
+        self.sketch.merge(other.sketch)
+        return super().merge(other)
+
+    def result(self) -> float:
+        return self.sketch.quantile(self.quantile)
+
+
+class MedianAccumulator(QuantileAccumulator):
+
+    def __init__(self, relative_accuracy: float = 0.01):
+        super().__init__(0.5, relative_accuracy)
+
+    def fresh(self) -> MedianAccumulator:
+        return MedianAccumulator(self.sketch.relative_accuracy)
+
+
+# Exact list-based policies, that have online counterparts.
+_accumulators_for_policies = {
+    Aggregation.take_first: FirstAccumulator,
+    Aggregation.take_last: LastAccumulator,
+    Aggregation.take_min: MinAccumulator,
+    Aggregation.take_max: MaxAccumulator,
+    Aggregation.take_sum: SumAccumulator,
+    Aggregation.take_mean: MeanAccumulator,
+    Aggregation.take_stdev: StdevAccumulator,
+    Aggregation.take_variance: VarianceAccumulator,
+}
+
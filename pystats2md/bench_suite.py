@@ -0,0 +1,180 @@
+from __future__ import annotations
+from typing import List, Optional, Iterable
+from datetime import datetime
+import os
+
+import pystats2md.micro_bench as mb
+import pystats2md.stats_file as sf
+from pystats2md.helpers import LazyModule
+from pystats2md.device_specs import DeviceSpecs
+
+cf = LazyModule('concurrent.futures')
+mp = LazyModule('multiprocessing')
+
+
+# Benches of the running suite, inherited by forked workers,
+# so that lambdas and closures don't have to be pickled.
+_forked_benches = None
+
+
+def _run_in_worker(idx: int, cpu: Optional[int]) -> dict:
+    bench = _forked_benches[idx]
+    if cpu is not None and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, {cpu})
+    # Results are exported by the parent process.
+    bench.source = None
+    bench.run()
+    return bench.serialize()
+
+
+class BenchSuite(object):
+    """
+        Runs many independent `MicroBench`-es across processes and
+        upserts the results into the `source` file as they finish.
+        Benches already present in the `source` are skipped, so a
+        killed suite resumes where it left off, if restarted.
+    """
+
+    def __init__(
+        self,
+        benches: Optional[Iterable[mb.MicroBench]] = None,
+        source: Optional[sf.StatsFile] = None,
+        max_workers: Optional[int] = None,
+        isolate: bool = False,
+        pin_cpus: bool = False,
+    ):
+        """
+            Up to `max_workers` benches run at once, defaulting to the
+            number of available CPUs. If `isolate`, every bench gets
+            a fresh process. If `pin_cpus`, every running bench is
+            pinned to a different CPU, where the OS supports it.
+            Where processes can't be forked, benches run one after
+            another in the current process, without pinning.
+        """
+        self.benches = list(benches) if benches else []
+        self.source = source
+        self.max_workers = max_workers
+        self.isolate = isolate
+        self.pin_cpus = pin_cpus
+
+    def add(self, bench: mb.MicroBench) -> BenchSuite:
+        assert isinstance(bench, mb.MicroBench), type(bench).__name__
+        self.benches.append(bench)
+        return self
+
+    def pending(self) -> List[mb.MicroBench]:
+        """
+            Benches, that haven't run yet and have no results in the `source`.
+        """
+        result = list()
+        for b in self.benches:
+            if b.did_run():
+                continue
+            if self.source is not None and self.source.contains(b):
+                continue
+            result.append(b)
+        return result
+
+    @staticmethod
+    def available_cpus() -> List[int]:
+        if hasattr(os, 'sched_getaffinity'):
+            return sorted(os.sched_getaffinity(0))
+        return list(range(os.cpu_count() or 1))
+
+    def run(self) -> BenchSuite:
+        global _forked_benches
+        pending = self.pending()
+        if len(pending) == 0:
+            return self
+        if 'fork' not in mp.get_all_start_methods():
+            # Spawned workers would have to pickle lambdas and closures.
+            return self._run_sequentially(pending)
+
+        cpus = BenchSuite.available_cpus()
+        max_workers = self.max_workers if self.max_workers else len(cpus)
+        if self.pin_cpus:
+            max_workers = min(max_workers, len(cpus))
+        free_cpus = list(cpus) if self.pin_cpus else None
+
+        context = mp.get_context('fork')
+        _forked_benches = pending
+
+        shared = None
+        if not self.isolate:
+            shared = cf.ProcessPoolExecutor(
+                max_workers=max_workers, mp_context=context)
+        running = dict()
+        errors = list()
+        next_idx = 0
+
+        def start(idx: int) -> cf.Future:
+            cpu = free_cpus.pop(0) if self.pin_cpus else None
+            executor = shared if shared else cf.ProcessPoolExecutor(
+                max_workers=1, mp_context=context)
+            future = executor.submit(_run_in_worker, idx, cpu)
+            running[future] = (idx, cpu, executor)
+            return future
+
+        try:
+            while next_idx < len(pending) or len(running):
+                while next_idx < len(pending) and len(running) < max_workers:
+                    start(next_idx)
+                    next_idx += 1
+                done, _ = cf.wait(list(running.keys()),
+                                  return_when=cf.FIRST_COMPLETED)
+                for future in done:
+                    idx, cpu, executor = running.pop(future)
+                    if cpu is not None:
+                        free_cpus.append(cpu)
+                    if executor is not shared:
+                        executor.shutdown(wait=False)
+                    try:
+                        self._finish(pending[idx], future.result())
+                    except Exception as e:
+                        errors.append(e)
+        finally:
+            # Cancelled manually, as `cancel_futures` needs Python 3.9.
+            for future, (_, _, executor) in running.items():
+                future.cancel()
+                if executor is not shared:
+                    executor.shutdown(wait=False)
+            if shared is not None:
+                shared.shutdown(wait=True)
+            _forked_benches = None
+
+        if len(errors):
+            raise errors[0]
+        return self
+
+    def _run_sequentially(self, pending: List[mb.MicroBench]) -> BenchSuite:
+        errors = list()
+        for bench in pending:
+            # Results are exported by `_finish()`, just like from workers.
+            source, bench.source = bench.source, None
+            try:
+                bench.run()
+                self._finish(bench, bench.serialize())
+            except Exception as e:
+                errors.append(e)
+            finally:
+                bench.source = source
+        if len(errors):
+            raise errors[0]
+        return self
+
+    def _finish(self, bench: mb.MicroBench, result: dict):
+        bench.time_elapsed = result['time_elapsed']
+        bench.count_iterations = result['count_iterations']
+        bench.count_operations = result['count_operations']
+        bench.date_utc = datetime.utcnow()
+        if self.source is None:
+            return
+        if bench.save_context == 'fingerprint':
+            self.source.add_device_specs(DeviceSpecs.current())
+        self.source.upsert(result, criterea=bench.filtering_criterea())
+        # In-memory sources have nowhere to persist, logs are appended by `upsert()`.
+        if self.source.filename is not None and not self.source.is_log():
+            self.source.dump_to_file()
+
+    def __call__(self):
+        return self.run()
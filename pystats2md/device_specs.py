@@ -0,0 +1,130 @@
+from __future__ import annotations
+from typing import Optional
+from pathlib import Path
+import platform
+import hashlib
+import json
+import time
+import os
+import re
+
+from pystats2md.helpers import LazyModule
+
+psutil = LazyModule('psutil')
+cpuinfo = LazyModule('cpuinfo')
+
+
+class DeviceSpecs(object):
+    """
+        Process-wide provider of the hardware and OS specs of the current
+        machine. Probing, especially `cpuinfo`, can take seconds, so the
+        results are cached in memory and on disk, in a file keyed by
+        the hostname and the boot, so it never outlives a reboot.
+    """
+
+    # Seconds, after which the specs cached on disk are probed again.
+    ttl_seconds = 24 * 60 * 60
+
+    # Specs of this process, once probed or loaded.
+    _current = None
+
+    @staticmethod
+    def cache_dir() -> Path:
+        custom = os.environ.get('PYSTATS2MD_CACHE_DIR', None)
+        if custom:
+            return Path(custom)
+        base = os.environ.get('XDG_CACHE_HOME', None)
+        base = Path(base) if base else Path.home() / '.cache'
+        return base / 'pystats2md'
+
+    @staticmethod
+    def boot_id() -> str:
+        try:
+            with open('/proc/sys/kernel/random/boot_id') as f:
+                return f.read().strip()
+        except OSError:
+            return str(int(psutil.boot_time()))
+
+    @staticmethod
+    def cache_path() -> Path:
+        name = re.sub(r'[^\w\-]', '_', f'{platform.node()}-{DeviceSpecs.boot_id()}')
+        return DeviceSpecs.cache_dir() / f'device-{name}.json'
+
+    @staticmethod
+    def probe() -> dict:
+        cpu_info = cpuinfo.get_cpu_info()
+        freq = psutil.cpu_freq()
+        specs = {
+            'device_name': platform.node(),
+            'cpu_model': cpu_info.get('brand_raw', cpu_info.get('brand', '?')),
+            'num_cores': psutil.cpu_count(logical=False),
+            'num_cpus': psutil.cpu_count(),
+            'mhz_min': freq.min if freq else 0,
+            'ram_bytes': psutil.virtual_memory().total,
+            'disk_bytes': psutil.disk_usage('/').total,
+            'os_family': platform.system(),
+            'python_version': platform.python_version(),
+        }
+        specs['device_fingerprint'] = DeviceSpecs.fingerprint(specs)
+        return specs
+
+    @staticmethod
+    def fingerprint(specs: dict) -> str:
+        """
+            Short identifier of the specs, that don't fluctuate.
+        """
+        # Older caches also stored the fluctuating `mhz_per_cpu`.
+        stable = {k: v for k, v in specs.items() if k not in [
+            'mhz_per_cpu', 'device_fingerprint', 'probed_at']}
+        serialized = json.dumps(stable, sort_keys=True, default=str)
+        return hashlib.sha1(serialized.encode()).hexdigest()[:12]
+
+    @staticmethod
+    def current_mhz() -> float:
+        """
+            Clock speed, that changes with the load and throttling,
+            so it's always read live and never cached.
+        """
+        freq = psutil.cpu_freq()
+        return freq.current if freq else 0
+
+    @staticmethod
+    def current(ttl_seconds: Optional[float] = None, refresh: bool = False) -> dict:
+        """
+            Returns the specs probed at most `ttl_seconds` ago,
+            loading them from the disk cache, if possible.
+        """
+        if ttl_seconds is None:
+            ttl_seconds = DeviceSpecs.ttl_seconds
+        specs = DeviceSpecs._current
+        if not refresh and specs is not None and \
+                time.time() - specs['probed_at'] < ttl_seconds:
+            return specs
+
+        path = DeviceSpecs.cache_path()
+        specs = None
+        if not refresh:
+            try:
+                with open(path) as f:
+                    specs = json.load(f)
+                if time.time() - specs['probed_at'] >= ttl_seconds:
+                    specs = None
+            except (OSError, ValueError, KeyError):
+                specs = None
+
+        if specs is None:
+            specs = DeviceSpecs.probe()
+            specs['probed_at'] = time.time()
+            try:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                # Concurrent processes may probe at once, but
+                # the swap guarantees that files are never torn.
+                temp_path = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+                with open(temp_path, 'w') as f:
+                    json.dump(specs, f, indent=4)
+                os.replace(temp_path, path)
+            except OSError:
+                pass
+
+        DeviceSpecs._current = specs
+        return specs
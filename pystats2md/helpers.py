@@ -1,7 +1,9 @@
 from __future__ import annotations
-from typing import List, Optional, Set
+from typing import List, Optional, Set, Dict
 from random import choice
 from string import ascii_lowercase
+import importlib
+import importlib.util
 
 
 def secs2str(num: float) -> str:
@@ -68,6 +70,30 @@ def num2str(num: float) -> str:
     return '{:,.2f}'.format(num)
 
 
+def percentile2str(quantile: float) -> str:
+    """
+        Names quantiles like percentiles: `0.99` is `p99`, `0.999` is `p999`.
+    """
+    return 'p' + f'{quantile * 100:g}'.replace('.', '')
+
+
+def delta_encode(vals: List[int]) -> List[int]:
+    """
+        Replaces every value with its difference from the previous one,
+        so slowly changing series compress into small numbers.
+    """
+    return [b - a for a, b in zip([0] + vals, vals)]
+
+
+def delta_decode(deltas: List[int]) -> List[int]:
+    vals = list()
+    last = 0
+    for d in deltas:
+        last += d
+        vals.append(last)
+    return vals
+
+
 def str2num(str_: str) -> float:
     if str_ is None or len(str_) == 0:
         return None
@@ -81,6 +107,57 @@ def get_unique(dicts: list, key: str) -> Set[str]:
     return {num2str(s.get(key)) for s in dicts if key in s}
 
 
+def sorted_values(vals) -> list:
+    """
+        Sorts values keeping their original types. Values of
+        incomparable types are ordered by type name and text.
+    """
+    vals = list(vals)
+    try:
+        return sorted(vals)
+    except TypeError:
+        return sorted(vals, key=lambda v: (type(v).__name__, str(v)))
+
+
+def unique_values(dicts, key: str) -> list:
+    """
+        Returns the sorted distinct hashable values of the `key` field.
+    """
+    result = set()
+    for d in dicts:
+        if key not in d:
+            continue
+        try:
+            result.add(d[key])
+        except TypeError:
+            continue
+    return sorted_values(result)
+
+
+def positions_by_value(dicts: list, key: str, positions: Optional[dict] = None, start: int = 0) -> Dict[object, List[int]]:
+    """
+        Maps every hashable value of the `key` field to the ascending
+        list of positions of dictionaries with it. Can continue
+        indexing from the `start` into existing `positions`.
+    """
+    if positions is None:
+        positions = dict()
+    for i in range(start, len(dicts)):
+        d = dicts[i]
+        if key not in d:
+            continue
+        try:
+            matching = positions.get(d[key], None)
+        except TypeError:
+            # Unhashable values can't be equal to the hashable criterea.
+            continue
+        if matching is None:
+            positions[d[key]] = [i]
+        else:
+            matching.append(i)
+    return positions
+
+
 def index_of(vs: List[object], v: object) -> Optional[int]:
     try:
         return vs.index(v)
@@ -107,3 +184,28 @@ def table2str(table: List[List[str]]) -> str:
 
 def random_str(letters: int = 8) -> str:
     return ''.join(choice(ascii_lowercase) for i in range(letters))
+
+
+class LazyModule(object):
+    """
+        Stands in for a heavy module and only imports it, when one
+        of its attributes is accessed for the first time.
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr: str):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+
+def optional_module(name: str) -> Optional[LazyModule]:
+    """
+        Lazily imported module, or `None` if it isn't installed.
+    """
+    if importlib.util.find_spec(name) is None:
+        return None
+    return LazyModule(name)
@@ -1,14 +1,50 @@
+from __future__ import annotations
+from typing import List, Optional
 from datetime import datetime
 import platform
 import time
 import inspect
 import copy
+import math
+import statistics
+import threading
+import sys
+import gc
+import tracemalloc
+import json
+import queue
+import hashlib
+import re
+from pathlib import Path
 
-import psutil
+try:
+    import resource
+except ImportError:
+    resource = None
 
+from pystats2md.helpers import percentile2str, LazyModule
+from pystats2md.aggregation import QuantileSketch, MeanAccumulator
+from pystats2md.resource_sampler import ResourceSampler
+from pystats2md.profiler import _profilers_by_name
+from pystats2md.device_specs import DeviceSpecs
 import pystats2md.stats_file as sf
 import pystats2md.stats_file as ss
 
+psutil = LazyModule('psutil')
+asyncio = LazyModule('asyncio')
+mp = LazyModule('multiprocessing')
+
+# Two-sided z-scores for Python 3.6 and 3.7, that lack `statistics.NormalDist`.
+_z_scores = {
+    0.8: 1.2816,
+    0.9: 1.6449,
+    0.95: 1.9600,
+    0.98: 2.3263,
+    0.99: 2.5758,
+    0.995: 2.8070,
+    0.999: 3.2905,
+}
+
 
 class MicroBench(object):
     """
@@ -18,6 +54,13 @@ class MicroBench(object):
         Allows batching multiple operations in the same iteration and logs both.
     """
 
+    # Exported by `stats()`, if `save_latencies` is set.
+    percentiles = [0.5, 0.9, 0.99, 0.999]
+    # Batches to run before `target_relative_error` is checked.
+    min_batches = 10
+    # Seconds to wait for forked workers to get ready.
+    start_timeout = 60
+
 # pragma region Serialization
 
     def __init__(
@@ -30,9 +73,26 @@ class MicroBench(object):
         limit_iterations=1000,
         limit_operations=10000,
         limit_seconds=10.0,
+        batch_seconds=0.001,
+        subtract_overhead=True,
+        warmup_iterations=0,
+        warmup_seconds=0.0,
+        target_relative_error=None,
+        confidence=0.95,
+        concurrency=None,
+        executor='threads',
+        max_in_flight=1,
         save_context=True,
         save_io=True,
         save_source=True,
+        save_latencies=False,
+        save_memory=False,
+        sample_interval=None,
+        profile=False,
+        profiler='cprofile',
+        profile_seconds=1.0,
+        profile_top=10,
+        save_stacks=False,
         **kwargs,
     ):
         """
@@ -42,6 +102,51 @@ class MicroBench(object):
             The `source` and `serialized` are closely tied. 
             Both allow importing previous results, but `source` 
             also exports the new results back.
+
+            The `func` is called in batches, sized to take about
+            `batch_seconds`, so the clock is read once per batch.
+            If `subtract_overhead`, the calibrated cost of calling
+            an empty function and reading the clock is excluded
+            from the `time_elapsed`.
+
+            If `save_latencies`, every call is timed separately, as
+            percentiles of batch means would hide the tail. Latencies are
+            logged into a `QuantileSketch` and exported as percentiles
+            and a compressed histogram.
+
+            Before measuring, `func` is called for at least
+            `warmup_iterations` times and `warmup_seconds`, and those
+            calls aren't counted. If `target_relative_error` is set,
+            the run also stops once the `confidence` interval of the
+            mean time per operation across batches gets narrower than
+            that fraction of the mean. The limits still apply.
+
+            If `concurrency` is set, `func` is called from that many
+            `executor` workers at once, either 'threads' or forked
+            'processes', each bound by the limits separately. The
+            `time_elapsed` is then the wall time of the whole run,
+            so `operations_per_second` is the aggregate throughput.
+            Results are tagged with the `concurrency` attribute.
+
+            Coroutine functions are awaited on a single event loop,
+            keeping up to `max_in_flight` requests running at once.
+            Every request is timed separately.
+
+            If `save_memory`, the growth of the resident set size,
+            the peak of memory traced by `tracemalloc` and the garbage
+            collections during the run are exported. Tracing slows
+            down allocations, so it also inflates the timings.
+
+            If `sample_interval` is set, a `ResourceSampler` thread
+            logs the CPU, memory and IO usage every that many seconds
+            and the `resource_timeline` is exported with the results.
+
+            If `profile`, `func` is called for `profile_seconds` more
+            after the measurements under the 'cprofile' or the 'sampling'
+            `profiler`, and the `profile_top` functions by own time are
+            exported as `hotspots`. The 'sampling' profiler can also
+            `save_stacks` in the collapsed format into a file with the
+            given path or, if `True`, next to the `source` file.
         """
         assert callable(func), 'Must be a callable!'
         self.func = func
@@ -50,10 +155,32 @@ class MicroBench(object):
         self.limit_iterations = limit_iterations
         self.limit_operations = limit_operations
         self.limit_seconds = limit_seconds
+        self.batch_seconds = batch_seconds
+        self.subtract_overhead = subtract_overhead
+        self.warmup_iterations = warmup_iterations
+        self.warmup_seconds = warmup_seconds
+        self.target_relative_error = target_relative_error
+        self.confidence = confidence
+        self.concurrency = concurrency
+        self.executor = executor
+        self.max_in_flight = max_in_flight
         self.save_context = save_context
         self.save_io = save_io
         self.save_source = save_source
+        self.save_latencies = save_latencies
+        self.save_memory = save_memory
+        self.sample_interval = sample_interval
+        self.profile = profile
+        self.profiler = profiler
+        self.profile_seconds = profile_seconds
+        self.profile_top = profile_top
+        self.save_stacks = save_stacks
+        if profile:
+            assert profiler in _profilers_by_name, profiler
         self.attributes = dict(**kwargs)
+        if concurrency is not None:
+            assert executor in ['threads', 'processes'], executor
+            self.attributes['concurrency'] = concurrency
         self.source = source        
         self.deserialize(serialized)
 
@@ -63,10 +190,30 @@ class MicroBench(object):
             self.count_operations = 0
             self.count_iterations = 0
             self.date_utc = None
+            self.latencies = QuantileSketch()
+            self.batch_latencies = MeanAccumulator()
+            self.msecs_per_op_per_worker = None
+            self.baseline_ops_per_sec = None
+            self.memory_usage = dict()
+            self.timeline = None
+            self.hotspots = None
+            self.stacks_path = None
         elif isinstance(serialized, dict):
             self.time_elapsed = serialized['time_elapsed']
             self.count_operations = serialized['count_operations']
             self.count_iterations = serialized['count_iterations']
+            self.batch_latencies = MeanAccumulator()
+            self.msecs_per_op_per_worker = serialized.get(
+                'msecs_per_operation_per_worker', None)
+            self.baseline_ops_per_sec = None
+            self.memory_usage = dict()
+            self.timeline = None
+            self.hotspots = serialized.get('hotspots', None)
+            self.stacks_path = serialized.get('stacks_path', None)
+            self.latencies = QuantileSketch()
+            if 'latency_histogram' in serialized:
+                self.latencies = QuantileSketch.from_dict(
+                    serialized['latency_histogram'])
             self.date_utc = datetime.fromtimestamp(serialized['date_utc'])
             self.attributes.update(serialized)
         elif isinstance(serialized, sf.StatsFile):
@@ -78,22 +225,36 @@ class MicroBench(object):
                 self.deserialize(matches[0])
 
     def context(self) -> dict:
+        """
+            Device specs come from the cached `DeviceSpecs.current()`,
+            but the fluctuating clock speed is read live.
+            If `save_context` is 'fingerprint', only the fingerprint
+            of the specs is exported instead of the separate fields,
+            and the `source` file stores the full specs aside.
+        """
         date = self.date_utc if self.date_utc else datetime.utcnow()
-        return {
+        specs = DeviceSpecs.current()
+        result = {
             # Fields matching Google Benchmark:
             # https://github.com/google/benchmark#output-formats
             'date': date.strftime('%Y/%M/%d-%H:%m:%S'),
-            'num_cpus': psutil.cpu_count(),
-            'mhz_per_cpu': psutil.cpu_freq().current,
+            'num_cpus': specs['num_cpus'],
+            'mhz_per_cpu': DeviceSpecs.current_mhz(),
             'build_type': 'debug' if __debug__ else 'release',
             'cpu_scaling_enabled': False,
 
             # Fields that only we output.
             'device_name': self.device_name,
+            'device_fingerprint': specs['device_fingerprint'],
             'date_utc': datetime.timestamp(date),
             'date_readable': date.strftime('%b %d, %Y'),
             'date_sortable': date.strftime('%Y/%M/%d'),
         }
+        if self.save_context == 'fingerprint':
+            # The build type and CPU scaling aren't part of the device specs.
+            for k in ['num_cpus', 'mhz_per_cpu']:
+                result.pop(k)
+        return result
 
     def filtering_criterea(self, include_context=False) -> dict:
         result = {
@@ -102,7 +263,7 @@ class MicroBench(object):
         }
         if include_context:
             result.update({
-                'num_cpus': psutil.cpu_count(),
+                'num_cpus': DeviceSpecs.current()['num_cpus'],
                 'build_type': 'debug' if __debug__ else 'release',
             })
         result.update(self.attributes)
@@ -119,6 +280,28 @@ class MicroBench(object):
         }
         if self.save_source:
             result['benchmark_code'] = inspect.getsource(self.func)
+        if self.save_latencies and self.latencies.count > 0:
+            result.update(self.latency_stats())
+        if self.target_relative_error is not None:
+            relative_error = self.relative_error()
+            # JSON has no infinities.
+            if math.isfinite(relative_error):
+                result['relative_error'] = relative_error
+        if self.is_async() and self.batch_latencies.count > 0:
+            result['msecs_per_request'] = self.batch_latencies.result()
+        if self.concurrency is not None:
+            result['msecs_per_operation_per_worker'] = self.msecs_per_op_per_worker
+            efficiency = self.scaling_efficiency()
+            if efficiency is not None:
+                result['scaling_efficiency'] = efficiency
+        return result
+
+    def latency_stats(self) -> dict:
+        result = dict()
+        for q in MicroBench.percentiles:
+            result['msecs_' + percentile2str(q)] = self.latencies.quantile(q)
+        result['msecs_max'] = self.latencies.max
+        result['latency_histogram'] = self.latencies.to_dict()
         return result
     
     def current_io(self) -> dict:
@@ -149,6 +332,64 @@ class MicroBench(object):
                 delta_io[k + '_per_second'] = 0
         return delta_io
 
+    @staticmethod
+    def current_memory() -> dict:
+        result = {
+            'rss_bytes': psutil.Process().memory_info().rss,
+            'gc_collections': [g['collections'] for g in gc.get_stats()],
+            'traced_bytes': tracemalloc.get_traced_memory()[0],
+        }
+        if resource is not None:
+            # Reported in kilobytes everywhere, but on MacOS.
+            scale = 1 if sys.platform == 'darwin' else 1024
+            result['max_rss_bytes'] = resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss * scale
+        return result
+
+    def start_tracking_memory(self):
+        self._stops_tracing = not tracemalloc.is_tracing()
+        if self._stops_tracing:
+            tracemalloc.start()
+        elif hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        else:
+            # Before Python 3.9 the peak is only reset by a restart,
+            # that also forgets the existing traces.
+            frames = tracemalloc.get_traceback_limit()
+            tracemalloc.stop()
+            tracemalloc.start(frames)
+        self.last_memory = MicroBench.current_memory()
+
+    def stop_tracking_memory(self):
+        traced_peak = tracemalloc.get_traced_memory()[1]
+        new_memory = MicroBench.current_memory()
+        if self._stops_tracing:
+            tracemalloc.stop()
+        old_memory = self.last_memory
+        self.memory_usage = {
+            'rss_delta_bytes': new_memory['rss_bytes'] - old_memory['rss_bytes'],
+            'traced_peak_bytes': traced_peak - old_memory['traced_bytes'],
+            'traced_retained_bytes': new_memory['traced_bytes'] - old_memory['traced_bytes'],
+        }
+        if 'max_rss_bytes' in new_memory:
+            self.memory_usage['peak_rss_delta_bytes'] = \
+                new_memory['max_rss_bytes'] - old_memory['max_rss_bytes']
+        for generation, (new, old) in enumerate(zip(
+                new_memory['gc_collections'], old_memory['gc_collections'])):
+            self.memory_usage[f'gc_collections_gen{generation}'] = new - old
+
+    def memory(self) -> dict:
+        """
+            Memory usage during the last run. Only the retained bytes
+            can be attributed to separate operations, as CPython
+            doesn't count the total allocated volume.
+        """
+        result = dict(self.memory_usage)
+        if len(result) and self.count_operations:
+            result['traced_retained_bytes_per_operation'] = \
+                result['traced_retained_bytes'] / self.count_operations
+        return result
+
     def serialize(self) -> dict:
         result = copy.deepcopy(self.attributes)
         result.update(self.stats())
@@ -156,6 +397,14 @@ class MicroBench(object):
             result.update(self.context())
         if self.save_io:
             result.update(self.io())
+        if self.save_memory:
+            result.update(self.memory())
+        if self.timeline is not None:
+            result['resource_timeline'] = self.timeline.to_dict()
+        if self.hotspots is not None:
+            result['hotspots'] = self.hotspots
+        if self.stacks_path is not None:
+            result['stacks_path'] = self.stacks_path
         return result
 
     def __dict__(self) -> dict:
@@ -168,32 +417,493 @@ class MicroBench(object):
 # pragma region Running
 
     def run(self):
-        before = time.time()
-        self.count_operations = 0
-        self.count_iterations = 0
+        """
+            Coroutine functions are awaited on a new event loop.
+            Inside of an already running loop, await `run_async()`.
+        """
+        if self.is_async():
+            asyncio.run(self.run_async())
+            return
+        call_overhead, clock_overhead = 0, 0
+        if self.subtract_overhead:
+            call_overhead, clock_overhead = MicroBench.calibrate()
+        self.warmup()
+        self._start_logging()
+        try:
+            if self.concurrency is None:
+                self._measure(call_overhead, clock_overhead)
+            else:
+                self._measure_concurrently(call_overhead, clock_overhead)
+        finally:
+            self._stop_logging()
+        if self.profile:
+            self._profile()
+        self._complete()
+
+    async def run_async(self):
+        """
+            Equivalent of `run()` for coroutine functions,
+            that runs on the current event loop.
+        """
+        assert self.is_async(), 'Only coroutine functions can be awaited'
+        if self.warmup_iterations or self.warmup_seconds:
+            await self._warmup_async()
+        self._start_logging()
+        try:
+            if self.concurrency is None:
+                self._reset_measurements()
+                await self._measure_async()
+            else:
+                # Every worker runs its own event loop in a separate thread or process.
+                loop = asyncio.get_event_loop()
+                await loop.run_in_executor(None, self._measure_concurrently, 0, 0)
+        finally:
+            self._stop_logging()
+        if self.profile:
+            await self._profile_async()
+        self._complete()
+
+    def _start_logging(self):
         self.last_io = self.current_io()
-        while True:
-            ops = self.func()
+        if self.save_memory:
+            self.start_tracking_memory()
+        if self.sample_interval:
+            try:
+                self.timeline = ResourceSampler(self.sample_interval).start()
+            except BaseException:
+                if self.save_memory:
+                    self.stop_tracking_memory()
+                raise
 
-            self.count_operations += ops if isinstance(ops, int) else 1
-            self.count_iterations += 1
-            self.time_elapsed = time.time() - before
+    def _stop_logging(self):
+        """
+            Also called, if the measurements fail, as tracing slows
+            down every later allocation in the process and the
+            sampler thread would keep running.
+        """
+        try:
+            if self.sample_interval:
+                self.timeline.stop()
+        finally:
+            if self.save_memory:
+                self.stop_tracking_memory()
 
-            # Stop if we have reached any limit.
-            if self.limit_operations is not None:
-                if self.limit_operations <= self.count_operations:
-                    break
-            if self.limit_iterations is not None:
-                if self.limit_iterations <= self.count_iterations:
-                    break
-            if self.limit_seconds is not None:
-                if self.limit_seconds <= self.time_elapsed:
-                    break
+    def _complete(self):
         # Mark as completed.
         self.date_utc = datetime.utcnow()
         if isinstance(self.source, sf.StatsFile):
             self.source.upsert(self)
 
+    def _profile(self):
+        """
+            Runs an extra instrumented pass, that doesn't
+            affect the measurements, and logs the hotspots.
+        """
+        profiler = _profilers_by_name[self.profiler](root=self.func)
+        started = time.perf_counter()
+        profiler.start()
+        try:
+            batch_size = 1
+            while time.perf_counter() - started < self.profile_seconds:
+                MicroBench._time_batch(self.func, batch_size)
+                batch_size *= 2
+        finally:
+            profiler.stop()
+        self._log_profile(profiler)
+
+    async def _profile_async(self):
+        profiler = _profilers_by_name[self.profiler](root=self.func)
+        started = time.perf_counter()
+        profiler.start()
+        try:
+            while True:
+                await self.func()
+                if time.perf_counter() - started >= self.profile_seconds:
+                    break
+        finally:
+            profiler.stop()
+        self._log_profile(profiler)
+
+    def _log_profile(self, profiler):
+        self.hotspots = profiler.hotspots(self.profile_top)
+        collapsed = profiler.collapsed()
+        if self.save_stacks and collapsed is not None:
+            self.stacks_path = self.default_stacks_path() \
+                if self.save_stacks is True else str(self.save_stacks)
+            with open(self.stacks_path, 'w') as f:
+                f.write(collapsed)
+
+    def default_stacks_path(self) -> str:
+        """
+            Path next to the `source` file, unique for
+            every set of `filtering_criterea()`.
+        """
+        filename = getattr(self.source, 'filename', None)
+        assert filename, 'Stacks are saved next to the source file'
+        criterea = json.dumps(self.filtering_criterea(),
+                              sort_keys=True, default=str)
+        digest = hashlib.sha1(criterea.encode()).hexdigest()[:8]
+        name = re.sub(r'[^\w\-]', '_', self.benchmark_name)
+        path = Path(filename)
+        return str(path.parent / f'{path.stem}.{name}.{digest}.folded')
+
+    def _reset_measurements(self):
+        self.count_operations = 0
+        self.count_iterations = 0
+        self.time_elapsed = 0
+        self.latencies = QuantileSketch()
+        self.batch_latencies = MeanAccumulator()
+
+    def _measure(self, call_overhead: float, clock_overhead: float):
+        self._reset_measurements()
+        if self.is_async():
+            asyncio.run(self._measure_async())
+            return
+
+        elapsed = 0
+        batch_size = 1
+        wall_started = time.perf_counter_ns()
+        while True:
+            ops, batch_time = MicroBench._time_batch(self.func, batch_size)
+            batch_time -= call_overhead * batch_size + clock_overhead
+            batch_time = max(batch_time, 0)
+            elapsed += batch_time
+            if ops > 0:
+                self.batch_latencies.add(batch_time / 1e6 / ops)
+            if self.save_latencies and ops > 0:
+                # Calls aren't batched, but may perform many operations.
+                self.latencies.add(batch_time / 1e6 / ops, ops)
+            self.count_operations += ops
+            self.count_iterations += batch_size
+            self.time_elapsed = elapsed / 1e9
+            wall_elapsed = (time.perf_counter_ns() - wall_started) / 1e9
+            if self._reached_limits(wall_elapsed):
+                break
+            batch_size = self._next_batch_size(
+                batch_size, batch_time, wall_elapsed)
+
+    async def _measure_async(self):
+        """
+            Keeps up to `max_in_flight` requests running on the current
+            event loop, timing each one separately. The `time_elapsed`
+            is the wall time of the whole run, so `operations_per_second`
+            is the throughput, while the latencies are per request.
+        """
+        started = time.perf_counter_ns()
+
+        async def request_loop():
+            while not self._reached_limits((time.perf_counter_ns() - started) / 1e9):
+                self.count_iterations += 1
+                request_started = time.perf_counter_ns()
+                returned = await self.func()
+                latency = (time.perf_counter_ns() - request_started) / 1e6
+                self.count_operations += returned if isinstance(
+                    returned, int) else 1
+                self.batch_latencies.add(latency)
+                if self.save_latencies:
+                    self.latencies.add(latency)
+
+        await asyncio.gather(*[request_loop() for _ in range(self.max_in_flight)])
+        self.time_elapsed = (time.perf_counter_ns() - started) / 1e9
+
+    def _reached_limits(self, wall_elapsed: float) -> bool:
+        if self.limit_operations is not None:
+            if self.limit_operations <= self.count_operations:
+                return True
+        if self.limit_iterations is not None:
+            if self.limit_iterations <= self.count_iterations:
+                return True
+        if self.limit_seconds is not None:
+            if self.limit_seconds <= wall_elapsed:
+                return True
+        # Stop if the results are precise enough.
+        if self.target_relative_error is not None and \
+                self.batch_latencies.count >= MicroBench.min_batches:
+            if self.relative_error() <= self.target_relative_error:
+                return True
+        return False
+
+    def is_async(self) -> bool:
+        return inspect.iscoroutinefunction(self.func)
+
+    def _measure_concurrently(self, call_overhead: float, clock_overhead: float):
+        """
+            Runs `_measure()` in every worker at once and merges the
+            results. Workers start together, once all of them are ready,
+            and the wall time until the last one finishes is logged.
+        """
+        workers = [self._worker() for _ in range(self.concurrency)]
+        if self.executor == 'processes':
+            context = mp.get_context('fork')
+            barrier = context.Barrier(self.concurrency + 1)
+            results = context.Queue()
+
+            def work(idx: int):
+                worker = workers[idx]
+                try:
+                    barrier.wait(MicroBench.start_timeout)
+                    worker._measure(call_overhead, clock_overhead)
+                    results.put((idx, (
+                        worker.count_iterations, worker.count_operations,
+                        worker.time_elapsed, worker.latencies, worker.batch_latencies)))
+                except Exception as e:
+                    results.put((idx, e))
+
+            processes = [context.Process(target=work, args=(idx, ))
+                         for idx in range(self.concurrency)]
+            try:
+                for p in processes:
+                    p.start()
+                barrier.wait(MicroBench.start_timeout)
+                started = time.perf_counter_ns()
+                received = MicroBench._receive_results(results, processes)
+                finished = time.perf_counter_ns()
+            finally:
+                for p in processes:
+                    if p.is_alive():
+                        p.terminate()
+                    p.join()
+            for idx, result in received.items():
+                if isinstance(result, Exception):
+                    raise result
+                worker = workers[idx]
+                worker.count_iterations, worker.count_operations, \
+                    worker.time_elapsed, worker.latencies, worker.batch_latencies = result
+        else:
+            barrier = threading.Barrier(self.concurrency + 1)
+            errors = list()
+
+            def work(worker: MicroBench):
+                barrier.wait()
+                try:
+                    worker._measure(call_overhead, clock_overhead)
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=work, args=(w, ))
+                       for w in workers]
+            for t in threads:
+                t.start()
+            barrier.wait()
+            started = time.perf_counter_ns()
+            for t in threads:
+                t.join()
+            finished = time.perf_counter_ns()
+            if len(errors):
+                raise errors[0]
+
+        self.count_iterations = sum(w.count_iterations for w in workers)
+        self.count_operations = sum(w.count_operations for w in workers)
+        self.time_elapsed = (finished - started) / 1e9
+        self.latencies = QuantileSketch()
+        self.batch_latencies = MeanAccumulator()
+        for w in workers:
+            self.latencies.merge(w.latencies)
+            self.batch_latencies.merge(w.batch_latencies)
+        self.msecs_per_op_per_worker = statistics.mean(
+            w.msecs_per_op() for w in workers)
+
+    @staticmethod
+    def _receive_results(results, processes: list) -> dict:
+        """
+            Collects a result from every process, without hanging
+            on those, that died before posting one.
+        """
+        received = dict()
+        exited = set()
+        while len(received) < len(processes):
+            try:
+                idx, result = results.get(timeout=0.1)
+                received[idx] = result
+                continue
+            except queue.Empty:
+                pass
+            # Results are flushed before the process exits, so those
+            # still missing after one more poll will never come.
+            for idx in exited:
+                if idx not in received:
+                    raise RuntimeError(
+                        f'Worker {idx} exited with code {processes[idx].exitcode} without results')
+            exited = {idx for idx, p in enumerate(processes)
+                      if idx not in received and p.exitcode is not None}
+        return received
+
+    def _worker(self) -> MicroBench:
+        return MicroBench(
+            self.func,
+            benchmark_name=self.benchmark_name,
+            device_name=self.device_name,
+            limit_iterations=self.limit_iterations,
+            limit_operations=self.limit_operations,
+            limit_seconds=self.limit_seconds,
+            batch_seconds=self.batch_seconds,
+            target_relative_error=self.target_relative_error,
+            confidence=self.confidence,
+            max_in_flight=self.max_in_flight,
+            save_latencies=self.save_latencies,
+        )
+
+    def scaling_efficiency(self) -> Optional[float]:
+        """
+            Throughput relative to `concurrency` times the
+            `baseline_ops_per_sec` of a single worker.
+        """
+        if self.concurrency == 1:
+            return 1.0
+        if not self.baseline_ops_per_sec or not self.concurrency:
+            return None
+        return self.ops_per_sec() / self.baseline_ops_per_sec / self.concurrency
+
+    @staticmethod
+    def sweep(func, concurrency_levels=(1, 2, 4, 8), source=None, **kwargs) -> List[MicroBench]:
+        """
+            Runs the same `func` at every level of `concurrency`, storing
+            each one as a separate record. The single-worker level, if
+            present, is the baseline for the `scaling_efficiency`.
+            Levels already present in the `source` aren't re-run.
+        """
+        benches = list()
+        baseline = None
+        for level in sorted(concurrency_levels):
+            bench = MicroBench(func, concurrency=level, **kwargs)
+            bench.baseline_ops_per_sec = baseline
+            if source is None:
+                bench.run()
+            elif not source.contains(bench):
+                source.upsert(bench)
+            if level == 1:
+                if bench.did_run():
+                    baseline = bench.ops_per_sec()
+                else:
+                    existing = source.benchmarks[source.existing_index(bench)]
+                    baseline = existing['operations_per_second']
+            benches.append(bench)
+        return benches
+
+    def warmup(self):
+        """
+            Calls `func` in growing batches for `warmup_iterations`
+            and `warmup_seconds`, without counting the results.
+        """
+        if not self.warmup_iterations and not self.warmup_seconds:
+            return
+        if self.is_async():
+            asyncio.run(self._warmup_async())
+            return
+        count_iterations = 0
+        batch_size = 1
+        started = time.perf_counter_ns()
+        while True:
+            MicroBench._time_batch(self.func, batch_size)
+            count_iterations += batch_size
+            wall_elapsed = (time.perf_counter_ns() - started) / 1e9
+            if count_iterations >= self.warmup_iterations and \
+                    wall_elapsed >= self.warmup_seconds:
+                break
+            batch_size *= 2
+            if not self.warmup_seconds:
+                batch_size = min(
+                    batch_size, self.warmup_iterations - count_iterations)
+
+    async def _warmup_async(self):
+        count_iterations = 0
+        started = time.perf_counter_ns()
+
+        async def request_loop():
+            nonlocal count_iterations
+            while count_iterations < self.warmup_iterations or \
+                    (time.perf_counter_ns() - started) / 1e9 < self.warmup_seconds:
+                count_iterations += 1
+                await self.func()
+
+        await asyncio.gather(*[request_loop() for _ in range(self.max_in_flight)])
+
+    def relative_error(self) -> float:
+        """
+            Half-width of the `confidence` interval of the mean
+            time per operation across batches, relative to the mean.
+        """
+        if self.batch_latencies.count < 2:
+            return math.inf
+        stdev = self.batch_latencies.stdev()
+        if stdev == 0:
+            return 0
+        mean = self.batch_latencies.result()
+        if mean <= 0:
+            return math.inf
+        if hasattr(statistics, 'NormalDist'):
+            z = statistics.NormalDist().inv_cdf((1 + self.confidence) / 2)
+        else:
+            assert self.confidence in _z_scores, \
+                f'Supported confidences are {sorted(_z_scores)}'
+            z = _z_scores[self.confidence]
+        return z * stdev / math.sqrt(self.batch_latencies.count) / mean
+
+    def _next_batch_size(self, batch_size: int, batch_time: int, wall_elapsed: float) -> int:
+        """
+            Grows the batch towards `batch_seconds` at most 10x at a time,
+            like `timeit.Timer.autorange`, but never beyond the
+            remaining number of iterations, operations or seconds.
+        """
+        if self.save_latencies:
+            return 1
+        secs_per_call = max(batch_time, 1) / 1e9 / batch_size
+        next_size = int(self.batch_seconds / secs_per_call)
+        next_size = max(1, min(next_size, batch_size * 10))
+
+        if self.limit_iterations is not None:
+            next_size = min(
+                next_size, self.limit_iterations - self.count_iterations)
+        if self.limit_operations is not None:
+            ops_per_call = self.count_operations / self.count_iterations
+            if ops_per_call > 0:
+                remaining_ops = self.limit_operations - self.count_operations
+                next_size = min(next_size, math.ceil(
+                    remaining_ops / ops_per_call))
+        if self.limit_seconds is not None:
+            remaining_secs = self.limit_seconds - wall_elapsed
+            next_size = min(next_size, math.ceil(
+                remaining_secs / secs_per_call))
+        return max(1, next_size)
+
+    @staticmethod
+    def _time_batch(func, batch_size: int) -> (int, int):
+        """
+            Calls `func` `batch_size` times and returns the
+            number of operations and the duration in nanoseconds.
+        """
+        ops = 0
+        started = time.perf_counter_ns()
+        for _ in range(batch_size):
+            returned = func()
+            ops += returned if isinstance(returned, int) else 1
+        return ops, time.perf_counter_ns() - started
+
+    # Cached results of `calibrate()`.
+    _overheads = None
+
+    @staticmethod
+    def calibrate(trials: int = 7, batch_size: int = 10000) -> (float, float):
+        """
+            Estimates the nanoseconds spent on calling an empty
+            function inside of the batch loop and on reading the
+            clock. Best of multiple `trials` is taken, and
+            cached for the lifetime of the process.
+        """
+        if MicroBench._overheads is not None:
+            return MicroBench._overheads
+
+        def empty():
+            pass
+
+        clock_overhead = min(
+            -time.perf_counter_ns() + time.perf_counter_ns() for _ in range(trials * 100))
+        call_overhead = min(
+            (MicroBench._time_batch(empty, batch_size)[1] - clock_overhead) / batch_size
+            for _ in range(trials))
+        MicroBench._overheads = (max(call_overhead, 0), max(clock_overhead, 0))
+        return MicroBench._overheads
+
     def did_run(self) -> bool:
         return self.date_utc is not None
 
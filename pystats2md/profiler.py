@@ -0,0 +1,151 @@
+from __future__ import annotations
+from typing import List, Dict, Optional
+from collections import Counter
+import os
+import signal
+import threading
+
+from pystats2md.helpers import LazyModule
+
+cProfile = LazyModule('cProfile')
+pstats = LazyModule('pstats')
+
+# Frames of the benchmarking harness itself, hidden from the results.
+_harness_files = {
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), n)
+    for n in ['micro_bench.py', 'profiler.py']
+}
+
+
+def _function_name(filename: str, line: int, name: str) -> str:
+    if filename == '~':
+        return name
+    return f'{name} ({os.path.basename(filename)}:{line})'
+
+
+class FunctionProfiler(object):
+    """
+        Deterministic profiler on top of `cProfile`. Exact call counts,
+        but every Python call gets noticeably slower.
+    """
+
+    def __init__(self, root=None):
+        """
+            If the `root` function is given, percentages are relative
+            to the total time spent in it, rather than in all functions.
+        """
+        self.root = root
+        self.profile = cProfile.Profile()
+
+    def start(self) -> FunctionProfiler:
+        self.profile.enable()
+        return self
+
+    def stop(self) -> FunctionProfiler:
+        self.profile.disable()
+        return self
+
+    def hotspots(self, top: int = 10) -> List[dict]:
+        stats = pstats.Stats(self.profile).stats
+        code = getattr(self.root, '__code__', None)
+        root_key = (code.co_filename, code.co_firstlineno, code.co_name) if code else None
+        entries = list()
+        total_secs = 0
+        for key, (_, calls, own_secs, cum_secs, _) in stats.items():
+            filename, line, name = key
+            if filename in _harness_files or '_lsprof.Profiler' in name:
+                continue
+            if key == root_key:
+                total_secs = cum_secs
+            entries.append((_function_name(filename, line, name), calls, own_secs, cum_secs))
+        if total_secs == 0:
+            total_secs = sum(e[2] for e in entries)
+        entries.sort(key=lambda e: e[2], reverse=True)
+        return [{
+            'function': name,
+            'calls': calls,
+            'own_percent': own_secs * 100 / total_secs if total_secs else 0,
+            'total_percent': cum_secs * 100 / total_secs if total_secs else 0,
+        } for name, calls, own_secs, cum_secs in entries[:top]]
+
+    def collapsed(self) -> Optional[str]:
+        # Deterministic profiles don't preserve whole stacks.
+        return None
+
+
+class SamplingProfiler(object):
+    """
+        Statistical profiler, that records the call stack of the main
+        thread on every `SIGPROF`, which the OS sends each `interval`
+        seconds of consumed CPU time. The overhead is proportional to
+        the number of samples, not calls. Unix only.
+    """
+
+    def __init__(self, root=None, interval: float = 0.001):
+        """
+            If the `root` function is given, stacks are trimmed
+            to start from it and samples outside of it are ignored.
+        """
+        self.root_code = getattr(root, '__code__', None)
+        self.interval = interval
+        self.stacks = Counter()
+        self._previous_handler = None
+
+    def start(self) -> SamplingProfiler:
+        assert hasattr(signal, 'setitimer'), 'Requires POSIX interval timers'
+        assert threading.current_thread() is threading.main_thread(), \
+            'Signals are only delivered to the main thread'
+        self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        return self
+
+    def stop(self) -> SamplingProfiler:
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+        return self
+
+    def _sample(self, signum, frame):
+        stack = list()
+        while frame is not None:
+            code = frame.f_code
+            if self.root_code is None and code.co_filename in _harness_files:
+                break
+            stack.append(_function_name(
+                code.co_filename, code.co_firstlineno, code.co_name))
+            if code is self.root_code:
+                break
+            frame = frame.f_back
+        if len(stack) == 0 or (self.root_code is not None and frame is None):
+            return
+        self.stacks[tuple(reversed(stack))] += 1
+
+    def hotspots(self, top: int = 10) -> List[dict]:
+        own = Counter()
+        total = Counter()
+        count_samples = sum(self.stacks.values())
+        for stack, n in self.stacks.items():
+            own[stack[-1]] += n
+            # Recursive functions are only counted once per sample.
+            for name in set(stack):
+                total[name] += n
+        return [{
+            'function': name,
+            'samples': n,
+            'own_percent': n * 100 / count_samples,
+            'total_percent': total[name] * 100 / count_samples,
+        } for name, n in own.most_common(top)]
+
+    def collapsed(self) -> str:
+        """
+            Stacks in the "collapsed" format of `flamegraph.pl`
+            and speedscope: semicolon-separated frames and a count.
+        """
+        return ''.join(f'{";".join(stack)} {n}\n'
+                       for stack, n in sorted(self.stacks.items()))
+
+
+# Profiler classes by the names accepted by `MicroBench`.
+_profilers_by_name: Dict[str, type] = {
+    'cprofile': FunctionProfiler,
+    'sampling': SamplingProfiler,
+}
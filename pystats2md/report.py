@@ -1,43 +1,257 @@
 from __future__ import annotations
-from typing import List, Optional
-import platform, sys
+from typing import List, Optional, Dict, Tuple, Callable
 import inspect
 from pathlib import Path
 import re
-
-import psutil
-import cpuinfo
+import os
+import json
+import hashlib
 
 from pystats2md.stats_table import StatsTable
 from pystats2md.stats_plot import StatsPlot
 from pystats2md.helpers import *
+from pystats2md.device_specs import DeviceSpecs
+import pystats2md.stats_file as sf
+
+cf = LazyModule('concurrent.futures')
+
+
+def _render_to(task: tuple) -> bool:
+    obj, path, fingerprint = task
+    return obj.render_to(path, fingerprint)
+
+
+class ReportSection(object):
+    """
+        Named part of a `Report`, that is only rebuilt, when the
+        fingerprint of its `inputs` or of the `build` function changes.
+        Rendered sections are wrapped into HTML comments, so they
+        can be found and replaced inside of hand-written files.
+    """
+
+    def __init__(self, name: str, build: Callable[[Report], object], inputs: Optional[list] = None):
+        assert re.fullmatch(r'[\w\-.]+', name), 'Section names must be single words'
+        self.name = name
+        self.build = build
+        self.inputs = list(inputs) if inputs else []
+
+    @staticmethod
+    def _fingerprint_of(obj) -> object:
+        if isinstance(obj, sf.StatsFile) and obj.filename is None:
+            return obj.benchmarks
+        if isinstance(obj, sf.StatsFile) and obj.has_unsaved_changes():
+            # The file on disk is stale, so the contents are hashed.
+            return [ReportSection._fingerprint_of(obj.filename), obj.benchmarks]
+        if isinstance(obj, sf.StatsFile):
+            obj = obj.filename
+        if isinstance(obj, (str, Path)) and os.path.isfile(obj):
+            # Cheaper than hashing the contents of huge files.
+            stat = os.stat(obj)
+            return ['file', str(obj), stat.st_mtime_ns, stat.st_size]
+        return obj
+
+    def fingerprint(self) -> str:
+        try:
+            code = inspect.getsource(self.build)
+        except (OSError, TypeError):
+            code = getattr(self.build, '__qualname__', repr(self.build))
+        spec = json.dumps(
+            [self.name, code, [ReportSection._fingerprint_of(i) for i in self.inputs]],
+            sort_keys=True, default=str)
+        return hashlib.sha256(spec.encode()).hexdigest()[:32]
+
+    def begin_marker(self, fingerprint: str) -> str:
+        return f'<!-- pystats2md:begin {self.name} {fingerprint} -->\n'
+
+    def end_marker(self) -> str:
+        return f'<!-- pystats2md:end {self.name} -->\n'
+
+    def is_up_to_date(self, existing: Optional[Tuple[str, str]], fingerprint: str, directory: str = '.') -> bool:
+        """
+            Checks if the `existing` fingerprint and text can be reused.
+            Reused sections aren't built, so their charts are never
+            rendered again, and those missing from the `directory` must
+            be regenerated by a rebuild.
+        """
+        if existing is None or existing[0] != fingerprint:
+            return False
+        images = re.findall(r'!\[[^\]]*\]\(([^)\s]+\.svg)\)', existing[1])
+        return all(os.path.isfile(os.path.join(directory, i)) for i in images)
+
+    def render(self, existing: Optional[Tuple[str, str]] = None, directory: str = '.') -> Tuple[str, dict]:
+        """
+            Returns the marked-up text and the plots to render. If the
+            `existing` fingerprint and text are still valid, they are reused.
+        """
+        fingerprint = self.fingerprint()
+        if self.is_up_to_date(existing, fingerprint, directory):
+            return existing[1], dict()
+        part = Report()
+        self.build(part)
+        text = self.begin_marker(fingerprint) + part.content + self.end_marker()
+        return text, part.attachments
+
+    @staticmethod
+    def find_all(text: str) -> Dict[str, Tuple[str, str, Tuple[int, int]]]:
+        """
+            Maps the names of marked sections in `text` to their
+            fingerprints, whole marked-up text and its span.
+        """
+        result = dict()
+        pattern = re.compile(
+            r'<!-- pystats2md:begin ([\w\-.]+) (\w+) -->\n.*?<!-- pystats2md:end \1 -->\n?', re.DOTALL)
+        for match in pattern.finditer(text):
+            result[match.group(1)] = (match.group(2), match.group(0), match.span())
+        return result
 
 
 class Report(object):
+    """
+        Markdown document assembled from a list of text chunks and
+        `ReportSection`-s, that are only joined when printed.
+    """
 
     def __init__(self):
         self.clear()
 
     def clear(self):
-        self.content = ''
+        self.chunks = []
         self.attachments = {}
 
+    @property
+    def content(self) -> str:
+        """
+            Text of the whole report. Sections are built on every access,
+            but their plots are only collected, when printed.
+        """
+        return ''.join(self._render_chunks(dict(), dict()))
+
+    @content.setter
+    def content(self, content: str):
+        # Sections get frozen into text, if extended with `+=`.
+        self.chunks = [content]
+
+    def _render_chunks(self, existing: dict, attachments: dict, directory: str = '.') -> List[str]:
+        """
+            Renders the sections, reusing the `existing` ones, if
+            they are up to date, and collects the plots to render
+            into `attachments`.
+        """
+        result = list()
+        for chunk in self.chunks:
+            if isinstance(chunk, ReportSection):
+                found = existing.get(chunk.name, None)
+                text, section_attachments = chunk.render(
+                    found[:2] if found else None, directory)
+                attachments.update(section_attachments)
+                result.append(text)
+                result.append('\n')
+            else:
+                result.append(chunk)
+        return result
+
+    def add_section(self, name: str, build: Callable[[Report], object], inputs: Optional[list] = None) -> Report:
+        """
+            Adds a named section, that the `build` function fills
+            into an empty `Report`. The `inputs`, like the `StatsFile`-s
+            and the query parameters, decide if it must be rebuilt.
+        """
+        self.chunks.append(ReportSection(name, build, inputs))
+        return self
+
     def filename_for(self, filename) -> str:
         return re.sub('[^\w\-_\.]', '_', filename)
 
-    def print_to(self, filename: str, overwrite=True) -> Report:
-        text_file = open(filename, 'w' if overwrite else 'a')
-        text_file.write(self.content)
-        text_file.close()
+    def print_to(self, filename: str, overwrite=True, max_workers: Optional[int] = None) -> Report:
+        """
+            Sections, that are already in the file and are up to date,
+            are copied from it instead of being rebuilt.
+            Charts are only rendered, if their spec has changed since
+            the last time. If several have, they are rendered in parallel
+            by a pool of up to `max_workers` processes, that stay alive
+            between charts, so the renderer only starts once per worker.
+        """
+        existing = dict()
+        if overwrite and os.path.isfile(filename):
+            with open(filename) as f:
+                existing = ReportSection.find_all(f.read())
+        chunks = self._render_chunks(
+            existing, self.attachments, os.path.dirname(filename) or '.')
+        with open(filename, 'w' if overwrite else 'a') as f:
+            f.writelines(chunks)
+        self._render_attachments(filename, max_workers)
+        self.clear()
+        return self
+
+    def splice_into(self, filename: str, max_workers: Optional[int] = None) -> Report:
+        """
+            Replaces the marked sections inside of an existing file,
+            like a hand-written README, keeping the rest of it intact.
+            Sections, that are missing from it, are appended to the end.
+            Chunks outside of sections aren't printed.
+        """
+        text = ''
+        if os.path.isfile(filename):
+            with open(filename) as f:
+                text = f.read()
+        existing = ReportSection.find_all(text)
+        sections = [c for c in self.chunks if isinstance(c, ReportSection)]
+        directory = os.path.dirname(filename) or '.'
 
-        for title, obj in self.attachments.items():
-            obj_path = Path(filename).parent / \
-                f'{self.filename_for(title)}.svg'
-            obj.save_to(str(obj_path))
+        replacements = list()
+        appended = list()
+        for section in sections:
+            found = existing.get(section.name, None)
+            fingerprint = section.fingerprint()
+            if section.is_up_to_date(found[:2] if found else None, fingerprint, directory):
+                continue
+            rendered, attachments = section.render()
+            self.attachments.update(attachments)
+            if found is None:
+                appended.append(rendered)
+            else:
+                replacements.append((found[2], rendered))
+
+        chunks = list()
+        last_end = 0
+        for (start, end), rendered in sorted(replacements, key=lambda r: r[0]):
+            chunks.append(text[last_end:start])
+            chunks.append(rendered)
+            last_end = end
+        chunks.append(text[last_end:])
+        if len(appended):
+            if len(text) and not text.endswith('\n\n'):
+                chunks.append('\n' if text.endswith('\n') else '\n\n')
+            chunks.extend(r + '\n' for r in appended)
 
+        if len(replacements) or len(appended):
+            temp_filename = f'{filename}.tmp'
+            with open(temp_filename, 'w') as f:
+                f.writelines(chunks)
+            os.replace(temp_filename, filename)
+        self._render_attachments(filename, max_workers)
         self.clear()
         return self
 
+    def _render_attachments(self, filename: str, max_workers: Optional[int]):
+        stale = list()
+        for title, obj in self.attachments.items():
+            obj_path = str(Path(filename).parent /
+                           f'{self.filename_for(title)}.svg')
+            fingerprint = obj.fingerprint()
+            if not obj.is_rendered(obj_path, fingerprint):
+                stale.append((obj, obj_path, fingerprint))
+
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+        if len(stale) < 2 or max_workers < 2:
+            for obj, obj_path, fingerprint in stale:
+                obj.render_to(obj_path, fingerprint)
+        else:
+            with cf.ProcessPoolExecutor(max_workers=min(max_workers, len(stale))) as pool:
+                for _ in pool.map(_render_to, stale):
+                    pass
+
     def add(self, obj: object) -> Report:
         if isinstance(obj, str):
             return self.add_text(obj)
@@ -54,36 +268,51 @@ class Report(object):
         # Remove whitespaces in front of every row.
         # text = '\n'.join([line.strip() for line in text.splitlines()])
         text = inspect.cleandoc(text)
-        self.content += f'{text}\n'
+        self.chunks.append(f'{text}\n')
         # Headers must have 2 line spacings.
-        self.content += '\n\n'
+        self.chunks.append('\n\n')
         return self
 
     def add_table(self, obj: StatsTable) -> Report:
         assert isinstance(obj, StatsTable)
-        self.content += obj.print()
-        self.content += '\n\n'
+        self.chunks.append(obj.print())
+        self.chunks.append('\n\n')
         return self
 
     def add_plot(self, obj: StatsPlot) -> Report:
         assert isinstance(obj, StatsPlot)
         self.attachments[obj.title] = obj
-        self.content += '![{}]({}.svg)'.format(
+        self.chunks.append('![{}]({}.svg)'.format(
+            obj.title,
+            self.filename_for(obj.title),
+        ))
+        self.chunks.append('\n\n')
+        return self
+
+    def add_plots(self, *objs: StatsPlot) -> Report:
+        """
+            Places several plots in a single row, like the
+            throughput bars next to the resource timeline.
+        """
+        for obj in objs:
+            assert isinstance(obj, StatsPlot)
+            self.attachments[obj.title] = obj
+        self.chunks.append(' '.join('![{}]({}.svg)'.format(
             obj.title,
             self.filename_for(obj.title),
-        )
-        self.content += '\n\n'
+        ) for obj in objs))
+        self.chunks.append('\n\n')
         return self
 
     def add_current_device_specs(self) -> Report:
-        cpu_info = cpuinfo.get_cpu_info()
-        cpu_model = cpu_info.get('brand', '?')
-        cpu_cores = psutil.cpu_count(logical=False)
-        cpu_threads = psutil.cpu_count(logical=True)
-        cpu_frequency = metric2str(psutil.cpu_freq().min * 1e6)
-        ram_gbs = bytes2str(psutil.virtual_memory().total)
-        disk_gbs = bytes2str(psutil.disk_usage('/').total)
-        python_v = sys.version_info
+        specs = DeviceSpecs.current()
+        cpu_model = specs['cpu_model']
+        cpu_cores = specs['num_cores']
+        cpu_threads = specs['num_cpus']
+        cpu_frequency = metric2str(specs['mhz_min'] * 1e6)
+        ram_gbs = bytes2str(specs['ram_bytes'])
+        disk_gbs = bytes2str(specs['disk_bytes'])
+        python_v = specs['python_version'].split('.')
 
         self.add(f'''
         * CPU:
@@ -91,7 +320,7 @@ class Report(object):
             * Cores: {cpu_cores} ({cpu_threads} threads @ {cpu_frequency}hz).
         * RAM Space: {ram_gbs}.
         * Disk Space: {disk_gbs}.
-        * OS Family: {platform.system()}.
+        * OS Family: {specs['os_family']}.
         * Python Version: {python_v[0]}.{python_v[1]}.{python_v[2]}.
         ''')
         return self
@@ -0,0 +1,129 @@
+from __future__ import annotations
+from typing import List, Dict
+import threading
+import time
+
+from pystats2md.helpers import delta_encode, delta_decode, LazyModule
+
+psutil = LazyModule('psutil')
+
+
+class ResourceSampler(object):
+    """
+        Periodically samples the CPU load of every core, the current
+        CPU frequency, the resident memory of this process and the
+        disk and network rates of the whole machine from a background
+        thread. Values are rounded to integers and delta-encoded
+        on export, as neighbouring samples are usually close.
+    """
+
+    # Names of the exported series, except for per-core `cpu_percent`.
+    series_names = [
+        'rss_bytes',
+        'cpu_mhz',
+        'read_bytes_per_second',
+        'write_bytes_per_second',
+        'bytes_sent_per_second',
+        'bytes_recv_per_second',
+    ]
+
+    def __init__(self, interval: float = 0.1):
+        assert interval > 0, 'Sampling interval must be positive'
+        self.interval = interval
+        self.process = psutil.Process()
+        self.msecs = list()
+        self.cpu_percent = list()
+        self.series = {n: list() for n in ResourceSampler.series_names}
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def start(self) -> ResourceSampler:
+        assert self._thread is None, 'Already started'
+        self._started = time.perf_counter()
+        self._last_time = self._started
+        self._last_counters = ResourceSampler._counters()
+        # The first call only sets the reference point.
+        psutil.cpu_percent(percpu=True)
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> ResourceSampler:
+        if self._thread is None:
+            return self
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+        return self
+
+    def __enter__(self) -> ResourceSampler:
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def __len__(self) -> int:
+        return len(self.msecs)
+
+    def _loop(self):
+        while not self._stopping.wait(self.interval):
+            self.sample()
+
+    @staticmethod
+    def _counters() -> tuple:
+        disk = psutil.disk_io_counters()
+        net = psutil.net_io_counters()
+        return (
+            disk.read_bytes if disk else 0,
+            disk.write_bytes if disk else 0,
+            net.bytes_sent if net else 0,
+            net.bytes_recv if net else 0,
+        )
+
+    def sample(self):
+        now = time.perf_counter()
+        counters = ResourceSampler._counters()
+        secs = max(now - self._last_time, 1e-9)
+        rates = [round((new - old) / secs)
+                 for new, old in zip(counters, self._last_counters)]
+        self._last_time = now
+        self._last_counters = counters
+
+        freq = psutil.cpu_freq()
+        self.msecs.append(round((now - self._started) * 1000))
+        self.cpu_percent.append([round(p)
+                                 for p in psutil.cpu_percent(percpu=True)])
+        self.series['rss_bytes'].append(self.process.memory_info().rss)
+        self.series['cpu_mhz'].append(round(freq.current) if freq else 0)
+        for name, rate in zip(ResourceSampler.series_names[2:], rates):
+            self.series[name].append(rate)
+
+    def to_dict(self) -> dict:
+        cores = len(self.cpu_percent[0]) if len(self.cpu_percent) else 0
+        return {
+            'interval': self.interval,
+            'msecs': delta_encode(self.msecs),
+            'cpu_percent': [delta_encode([s[core] for s in self.cpu_percent])
+                            for core in range(cores)],
+            **{n: delta_encode(vals) for n, vals in self.series.items()},
+        }
+
+    @staticmethod
+    def from_dict(serialized: dict) -> Dict[str, List]:
+        """
+            Decodes the exported timeline into a dictionary of series,
+            where `cpu_percent` is averaged across cores and `cpu_percent_max`
+            keeps the busiest one.
+        """
+        per_core = [delta_decode(c) for c in serialized['cpu_percent']]
+        per_sample = list(zip(*per_core))
+        result = {
+            'msecs': delta_decode(serialized['msecs']),
+            'cpu_percent': [sum(s) / len(s) for s in per_sample],
+            'cpu_percent_max': [max(s) for s in per_sample],
+        }
+        for n in ResourceSampler.series_names:
+            if n in serialized:
+                result[n] = delta_decode(serialized[n])
+        return result
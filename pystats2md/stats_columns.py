@@ -0,0 +1,566 @@
+from __future__ import annotations
+import re
+from array import array
+from typing import List, Optional, Iterable
+
+from pystats2md.aggregation import Aggregation, CountAccumulator, \
+    SumAccumulator, MeanAccumulator, MinAccumulator, MaxAccumulator
+from pystats2md.helpers import optional_module
+
+# Vectorizes the hot loops, if installed.
+numpy = optional_module('numpy')
+
+
+class _Missing(object):
+
+    def __repr__(self) -> str:
+        return '<missing>'
+
+
+# Marks absent fields in columns of arbitrary objects.
+_missing = _Missing()
+
+
+class NumericColumn(object):
+    """
+        Integers or floats packed into a typed `array`,
+        with a separate byte-mask of present values.
+    """
+
+    def __init__(self, typecode: str):
+        self.values = array(typecode)
+        self.present = bytearray()
+
+    def accepts(self, val) -> bool:
+        if self.values.typecode == 'q':
+            return type(val) is int and -2**63 <= val < 2**63
+        return type(val) is float
+
+    def append(self, val):
+        if val is _missing:
+            self.values.append(0)
+            self.present.append(0)
+        else:
+            self.values.append(val)
+            self.present.append(1)
+
+    def __len__(self) -> int:
+        return len(self.present)
+
+    def get(self, idx: int) -> object:
+        return self.values[idx] if self.present[idx] else _missing
+
+    def take(self, indices: List[int]) -> NumericColumn:
+        result = NumericColumn(self.values.typecode)
+        result.values = array(self.values.typecode,
+                              [self.values[i] for i in indices])
+        result.present = bytearray(self.present[i] for i in indices)
+        return result
+
+    def equals(self, val) -> bytearray:
+        if isinstance(val, bool) or not isinstance(val, (int, float)):
+            return bytearray(len(self))
+        if numpy is not None:
+            mask = numpy.frombuffer(self.values, dtype=self.values.typecode) == val
+            mask &= numpy.frombuffer(self.present, dtype=numpy.uint8) != 0
+            return bytearray(mask.view(numpy.uint8))
+        return bytearray(p and v == val for v, p in zip(self.values, self.present))
+
+    def matches(self, pattern: re.Pattern) -> bytearray:
+        return bytearray(len(self))
+
+
+class CategoricalColumn(object):
+    """
+        Strings interned into a vocabulary and stored as integer
+        codes, where `-1` marks absent values.
+    """
+
+    def __init__(self):
+        self.codes = array('l')
+        self.vocabulary = list()
+        self.code_of = dict()
+        self.shares_vocabulary = False
+
+    def accepts(self, val) -> bool:
+        return type(val) is str
+
+    def append(self, val):
+        if val is _missing:
+            self.codes.append(-1)
+            return
+        code = self.code_of.get(val, None)
+        if code is None:
+            if self.shares_vocabulary:
+                self.vocabulary = list(self.vocabulary)
+                self.code_of = dict(self.code_of)
+                self.shares_vocabulary = False
+            code = len(self.vocabulary)
+            self.vocabulary.append(val)
+            self.code_of[val] = code
+        self.codes.append(code)
+
+    def __len__(self) -> int:
+        return len(self.codes)
+
+    def get(self, idx: int) -> object:
+        code = self.codes[idx]
+        return self.vocabulary[code] if code >= 0 else _missing
+
+    def take(self, indices: List[int]) -> CategoricalColumn:
+        # The vocabulary is shared until a new string is appended.
+        result = CategoricalColumn()
+        result.codes = array('l', [self.codes[i] for i in indices])
+        result.vocabulary = self.vocabulary
+        result.code_of = self.code_of
+        result.shares_vocabulary = True
+        self.shares_vocabulary = True
+        return result
+
+    def _codes_in(self, codes: set) -> bytearray:
+        if len(codes) == 0:
+            return bytearray(len(self))
+        if numpy is not None:
+            all_codes = numpy.frombuffer(self.codes, dtype=self.codes.typecode)
+            mask = numpy.isin(all_codes, list(codes))
+            return bytearray(mask.view(numpy.uint8))
+        return bytearray(c in codes for c in self.codes)
+
+    def equals(self, val) -> bytearray:
+        if not isinstance(val, str) or val not in self.code_of:
+            return bytearray(len(self))
+        return self._codes_in({self.code_of[val]})
+
+    def matches(self, pattern: re.Pattern) -> bytearray:
+        # Every distinct string is matched just once.
+        codes = {c for c, s in enumerate(self.vocabulary) if pattern.search(s)}
+        return self._codes_in(codes)
+
+
+class ObjectColumn(object):
+    """
+        Fallback for mixed or non-scalar values.
+    """
+
+    def __init__(self, values: Optional[list] = None):
+        self.values = values if values is not None else list()
+
+    def accepts(self, val) -> bool:
+        return True
+
+    def append(self, val):
+        self.values.append(val)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def get(self, idx: int) -> object:
+        return self.values[idx]
+
+    def take(self, indices: List[int]) -> ObjectColumn:
+        return ObjectColumn([self.values[i] for i in indices])
+
+    def equals(self, val) -> bytearray:
+        return bytearray(v is not _missing and v == val for v in self.values)
+
+    def matches(self, pattern: re.Pattern) -> bytearray:
+        return bytearray(isinstance(v, str) and pattern.search(v) is not None
+                         for v in self.values)
+
+
+def _column_for(val) -> object:
+    if type(val) is str:
+        return CategoricalColumn()
+    if type(val) is float:
+        return NumericColumn('d')
+    if type(val) is int and -2**63 <= val < 2**63:
+        return NumericColumn('q')
+    return ObjectColumn()
+
+
+# Policies, that can be vectorized with NumPy.
+_vectorized_policies = {
+    Aggregation.take_min: 'min',
+    Aggregation.take_max: 'max',
+    Aggregation.take_sum: 'sum',
+    Aggregation.take_mean: 'mean',
+    MinAccumulator: 'min',
+    MaxAccumulator: 'max',
+    SumAccumulator: 'sum',
+    MeanAccumulator: 'mean',
+    CountAccumulator: 'count',
+}
+
+
+class StatsColumns(object):
+    """
+        Column-oriented alternative to a list of stats dictionaries.
+        Integer and float fields are packed into typed arrays and
+        strings are interned into integer codes, which makes filters
+        produce byte-masks and lets grouping hash small integers.
+        If NumPy is installed, masks and reductions are vectorized.
+    """
+
+    def __init__(self, dicts: Optional[Iterable[dict]] = None):
+        self.count = 0
+        self.columns = dict()
+        if dicts is not None:
+            self.extend(dicts)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def extend(self, dicts: Iterable[dict]) -> StatsColumns:
+        columns = self.columns
+        for d in dicts:
+            for k, val in d.items():
+                column = columns.get(k, None)
+                if column is None:
+                    column = _column_for(val)
+                    columns[k] = column
+                elif not column.accepts(val):
+                    column = ObjectColumn(
+                        [column.get(i) for i in range(len(column))])
+                    columns[k] = column
+                # Pad the column, if it was absent in previous entries.
+                while len(column) < self.count:
+                    column.append(_missing)
+                column.append(val)
+            self.count += 1
+        for column in columns.values():
+            while len(column) < self.count:
+                column.append(_missing)
+        return self
+
+    def row(self, idx: int) -> dict:
+        result = dict()
+        for k, column in self.columns.items():
+            val = column.get(idx)
+            if val is not _missing:
+                result[k] = val
+        return result
+
+    def to_dicts(self) -> List[dict]:
+        return [self.row(i) for i in range(self.count)]
+
+    def take(self, indices: List[int]) -> StatsColumns:
+        result = StatsColumns()
+        result.count = len(indices)
+        result.columns = {k: c.take(indices) for k, c in self.columns.items()}
+        return result
+
+# pragma region Filtering
+
+    def mask(self, **filters) -> bytearray:
+        """
+            Evaluates filters into a byte-mask of matching entries.
+            Supports regular expressions for filtering critereas.
+        """
+        mask = bytearray(b'\x01') * self.count
+        for property_name, filter_criterea in filters.items():
+            assert (filter_criterea is not None), 'Undefined value in the filter'
+            column = self.columns.get(property_name, None)
+            if column is None:
+                return bytearray(self.count)
+            if isinstance(filter_criterea, re.Pattern):
+                current = column.matches(filter_criterea)
+            else:
+                current = column.equals(filter_criterea)
+            mask = StatsColumns._and(mask, current)
+        return mask
+
+    @staticmethod
+    def _and(a: bytearray, b: bytearray) -> bytearray:
+        if numpy is not None:
+            result = numpy.frombuffer(a, dtype=numpy.uint8) & \
+                numpy.frombuffer(b, dtype=numpy.uint8)
+            return bytearray(result)
+        return bytearray(x & y for x, y in zip(a, b))
+
+    @staticmethod
+    def indices_of(mask: bytearray) -> List[int]:
+        if numpy is not None:
+            return numpy.flatnonzero(numpy.frombuffer(mask, dtype=numpy.uint8)).tolist()
+        return [i for i, m in enumerate(mask) if m]
+
+    def filtered(self, **filters) -> StatsColumns:
+        return self.take(StatsColumns.indices_of(self.mask(**filters)))
+
+    def unique(self, field: str, rows: Optional[Iterable[int]] = None) -> list:
+        """
+            Lists distinct values of the `field` in all or just
+            the selected `rows`.
+        """
+        column = self.columns.get(field, None)
+        if column is None:
+            return list()
+        if rows is None:
+            rows = range(self.count)
+        if isinstance(column, CategoricalColumn):
+            codes = column.codes
+            return [column.vocabulary[c] for c in sorted({codes[i] for i in rows}) if c >= 0]
+        return [v for v in {column.get(i) for i in rows} if v is not _missing]
+
+# pragma region Grouping
+
+    def _group_ids(self, grouping_keys, rows: Optional[Iterable[int]] = None) -> (List[int], List[tuple]):
+        """
+            Assigns consecutive group IDs to the selected `rows`, that
+            have all the `grouping_keys`. Others get `-1`.
+            Returns the IDs and the keys of every group.
+            If NumPy is installed, the IDs are a NumPy array.
+        """
+        keys_columns = [self.columns.get(k, None) for k in grouping_keys]
+        if any(c is None for c in keys_columns):
+            return [-1] * self.count, list()
+
+        if numpy is not None and not any(isinstance(c, ObjectColumn) for c in keys_columns):
+            result = self._group_ids_vectorized(keys_columns, rows)
+            if result is not None:
+                return result
+
+        if rows is None:
+            rows = range(self.count)
+        per_row = list()
+        for column in keys_columns:
+            if isinstance(column, CategoricalColumn):
+                codes = column.codes
+                per_row.append([codes[i] for i in rows])
+            else:
+                per_row.append([column.get(i) for i in rows])
+
+        coded = [isinstance(c, CategoricalColumn) for c in keys_columns]
+        ids = [-1] * self.count
+        combos = dict()
+        for i, combo in zip(rows, zip(*per_row)):
+            if any((v == -1) if is_coded else (v is _missing)
+                   for v, is_coded in zip(combo, coded)):
+                continue
+            group_id = combos.get(combo, None)
+            if group_id is None:
+                group_id = len(combos)
+                combos[combo] = group_id
+            ids[i] = group_id
+
+        decoded = list()
+        for combo in combos.keys():
+            decoded.append(tuple(
+                c.vocabulary[v] if isinstance(c, CategoricalColumn) else v
+                for c, v in zip(keys_columns, combo)))
+        return ids, decoded
+
+    def _group_ids_vectorized(self, keys_columns: list, rows: Optional[Iterable[int]] = None):
+        """
+            Combines the integer codes of all the keys into a single
+            mixed-radix code per row and factorizes those with NumPy.
+            Numeric keys are factorized into codes first.
+            Returns `None`, if the combined codes may overflow.
+        """
+        if rows is None:
+            rows = numpy.arange(self.count, dtype=numpy.int64)
+        else:
+            rows = numpy.asarray(rows if isinstance(rows, list) else list(rows), dtype=numpy.int64)
+
+        per_key_codes = list()
+        per_key_values = list()
+        missing = numpy.zeros(len(rows), dtype=bool)
+        capacity = 1
+        for column in keys_columns:
+            if isinstance(column, CategoricalColumn):
+                codes = numpy.frombuffer(column.codes, dtype=column.codes.typecode)[rows]
+                missing |= codes < 0
+                values = column.vocabulary
+                radix = len(values)
+            else:
+                present = numpy.frombuffer(column.present, dtype=numpy.uint8)[rows] != 0
+                missing |= ~present
+                values, codes = StatsColumns._factorize(
+                    numpy.frombuffer(column.values, dtype=column.values.typecode)[rows], present)
+                radix = len(values)
+            capacity *= max(radix, 1)
+            per_key_codes.append((codes, max(radix, 1)))
+            per_key_values.append(values)
+        if capacity >= 2**63:
+            return None
+
+        combined = numpy.zeros(len(rows), dtype=numpy.int64)
+        for codes, radix in per_key_codes:
+            combined = combined * radix + codes
+        valid = ~missing
+        combined = combined[valid]
+        count_valid = len(combined)
+        if capacity <= max(4 * count_valid, 1 << 16):
+            # Small key spaces are factorized with a direct lookup table
+            # instead of sorting. Unbuffered `minimum.at` keeps the first
+            # position of every key, even if it repeats.
+            first = numpy.full(capacity, count_valid, dtype=numpy.int64)
+            numpy.minimum.at(first, combined, numpy.arange(count_valid, dtype=numpy.int64))
+            uniques = numpy.flatnonzero(first < count_valid)
+            first_positions = first[uniques]
+            lookup = numpy.zeros(capacity, dtype=numpy.int64)
+            lookup[uniques] = numpy.arange(len(uniques), dtype=numpy.int64)
+            inverse = lookup[combined]
+        else:
+            uniques, first_positions, inverse = numpy.unique(
+                combined, return_index=True, return_inverse=True)
+
+        # Groups are numbered in the order of their first appearance.
+        order = numpy.argsort(first_positions, kind='stable')
+        ranks = numpy.empty(len(order), dtype=numpy.int64)
+        ranks[order] = numpy.arange(len(order), dtype=numpy.int64)
+        ids = numpy.full(self.count, -1, dtype=numpy.int64)
+        ids[rows[valid]] = ranks[inverse.reshape(-1)]
+
+        remaining = uniques[order]
+        decoded_codes = list()
+        for codes, radix in reversed(per_key_codes):
+            decoded_codes.append((remaining % radix).tolist())
+            remaining = remaining // radix
+        decoded_codes.reverse()
+        decoded = [tuple(values[c] for values, c in zip(per_key_values, combo))
+                   for combo in zip(*decoded_codes)]
+        return ids, decoded
+
+    @staticmethod
+    def _factorize(values, present) -> (list, object):
+        """
+            Replaces numbers with positions in the sorted list
+            of their distinct values. Absent values get any code.
+        """
+        if values.dtype.kind == 'i' and present.any():
+            low = int(values[present].min())
+            high = int(values[present].max())
+            if high - low < max(4 * len(values), 1 << 16):
+                # Narrow integer ranges are just shifted.
+                codes = numpy.where(present, values - low, 0)
+                used = numpy.zeros(high - low + 1, dtype=bool)
+                used[codes[present]] = True
+                distinct = numpy.flatnonzero(used)
+                lookup = numpy.zeros(len(used), dtype=numpy.int64)
+                lookup[distinct] = numpy.arange(len(distinct), dtype=numpy.int64)
+                return (distinct + low).tolist(), lookup[codes]
+        distinct, codes = numpy.unique(values, return_inverse=True)
+        return distinct.tolist(), codes.reshape(-1)
+
+    def group(self, *grouping_keys, rows: Optional[Iterable[int]] = None, **aggregation_policies) -> List[dict]:
+        """
+            Equivalent of `StatsSubset.group()`, that hashes the
+            integer codes of the grouping keys instead of strings.
+            Only the selected `rows` are grouped, if those are given.
+        """
+        ids, combos = self._group_ids(grouping_keys, rows)
+        count_groups = len(combos)
+        if numpy is not None and count_groups:
+            ids_array = numpy.asarray(ids, dtype=numpy.int64)
+            positions = numpy.flatnonzero(ids_array >= 0)
+            grouped_ids = ids_array[positions]
+            sizes = numpy.bincount(grouped_ids, minlength=count_groups).tolist()
+            first_rows = numpy.full(count_groups, self.count, dtype=numpy.int64)
+            numpy.minimum.at(first_rows, grouped_ids, positions)
+            first_rows = first_rows.tolist()
+        else:
+            sizes = [0] * count_groups
+            first_rows = [-1] * count_groups
+            for i, group_id in enumerate(ids):
+                if group_id < 0:
+                    continue
+                if sizes[group_id] == 0:
+                    first_rows[group_id] = i
+                sizes[group_id] += 1
+
+        reduced = [dict() for _ in range(count_groups)]
+        ids_list = None
+        for property_name, policy in aggregation_policies.items():
+            column = self.columns.get(property_name, None)
+            if column is None:
+                continue
+            vectorized = _vectorized_policies.get(policy, None)
+            if numpy is not None and vectorized is not None and \
+                    isinstance(column, NumericColumn):
+                self._reduce_vectorized(
+                    reduced, ids, column, property_name, vectorized)
+            else:
+                if ids_list is None:
+                    ids_list = ids.tolist() if hasattr(ids, 'tolist') else ids
+                self._reduce_generic(
+                    reduced, ids_list, column, property_name, policy)
+
+        result = list()
+        for group_id, combo in enumerate(combos):
+            if sizes[group_id] == 1:
+                # Singular groups are exported as is, just like in `compact()`.
+                reduced_stats = self.row(first_rows[group_id])
+            else:
+                reduced_stats = reduced[group_id]
+            result.append({**reduced_stats, **dict(zip(grouping_keys, combo))})
+        return result
+
+    @staticmethod
+    def _reduce_vectorized(reduced: List[dict], ids: List[int], column: NumericColumn, property_name: str, kind: str):
+        count_groups = len(reduced)
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        values = numpy.frombuffer(column.values, dtype=column.values.typecode)
+        selected = (ids >= 0) & (numpy.frombuffer(
+            column.present, dtype=numpy.uint8) != 0)
+        ids = ids[selected]
+        values = values[selected]
+        counts = numpy.bincount(ids, minlength=count_groups)
+        is_integer = column.values.typecode == 'q'
+        if kind in ('sum', 'mean'):
+            if is_integer:
+                # Float weights would round integers above 2**53.
+                sums = numpy.zeros(count_groups, dtype=numpy.int64)
+                numpy.add.at(sums, ids, values)
+            else:
+                sums = numpy.bincount(ids, weights=values, minlength=count_groups)
+        elif kind in ('min', 'max'):
+            if is_integer:
+                limits = numpy.iinfo(numpy.int64)
+                initial = limits.max if kind == 'min' else limits.min
+            else:
+                initial = numpy.inf if kind == 'min' else -numpy.inf
+            extremes = numpy.full(count_groups, initial, dtype=values.dtype)
+            reduce = numpy.minimum if kind == 'min' else numpy.maximum
+            reduce.at(extremes, ids, values)
+
+        cast = int if is_integer else float
+        for group_id in range(count_groups):
+            n = int(counts[group_id])
+            if n == 0:
+                continue
+            if kind == 'count':
+                val = n
+            elif kind == 'sum':
+                val = cast(sums[group_id])
+            elif kind == 'mean':
+                val = cast(sums[group_id]) / n
+            else:
+                val = cast(extremes[group_id])
+            reduced[group_id][property_name] = val
+
+    @staticmethod
+    def _reduce_generic(reduced: List[dict], ids: List[int], column, property_name: str, policy):
+        make_accumulator = Aggregation.accumulator_for(policy)
+        reductions = [None] * len(reduced)
+        for i, group_id in enumerate(ids):
+            if group_id < 0:
+                continue
+            val = column.get(i)
+            if val is _missing:
+                continue
+            reduction = reductions[group_id]
+            if reduction is None:
+                reduction = list() if make_accumulator is None else make_accumulator()
+                reductions[group_id] = reduction
+            if make_accumulator is None:
+                reduction.append(val)
+            else:
+                reduction.add(val)
+
+        for group_id, reduction in enumerate(reductions):
+            if reduction is None:
+                continue
+            if make_accumulator is None:
+                reduced[group_id][property_name] = policy(reduction)
+            else:
+                reduced[group_id][property_name] = reduction.result()
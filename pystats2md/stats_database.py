@@ -0,0 +1,371 @@
+from __future__ import annotations
+import json
+from typing import Optional, List, Iterator, Tuple
+
+import pystats2md.micro_bench as mb
+import pystats2md.stats_file as sf
+import pystats2md.stats_subset as ss
+import pystats2md.aggregation as a
+from pystats2md.helpers import LazyModule
+
+sqlite3 = LazyModule('sqlite3')
+
+
+# Aggregation policies, that SQLite can evaluate on its own.
+_sql_aggregates = {
+    a.Aggregation.take_min: 'MIN',
+    a.Aggregation.take_max: 'MAX',
+    a.Aggregation.take_sum: 'SUM',
+    a.Aggregation.take_mean: 'AVG',
+    a.MinAccumulator: 'MIN',
+    a.MaxAccumulator: 'MAX',
+    a.SumAccumulator: 'SUM',
+    a.MeanAccumulator: 'AVG',
+    a.CountAccumulator: 'COUNT',
+}
+
+
+class StatsDatabase(sf.StatsFile):
+    """
+        Persistent stats file backed by SQLite, for histories
+        too big to be loaded and filtered in Python on every report.
+        Every entry is stored as a JSON document, while the most
+        commonly queried fields are also copied into indexed columns.
+
+        Equality filters and aggregations with SQL counterparts
+        are pushed down into the database by `filtered()`, `grouped()`,
+        `table()` and `plot()`, the rest is evaluated in Python.
+        The `benchmarks` list is only loaded, when accessed directly.
+
+        Modifications are committed in batches of `commit_every` entries
+        and on `dump_to_file()` or `close()`. Until then other connections
+        don't see them, and `reset_from_file()` rolls them back.
+    """
+
+    default_columns = ['benchmark_name', 'device_name', 'date_utc']
+    commit_every = 1000
+
+# pragma region Serialization
+
+    def __init__(self, filename: str, columns: Optional[List[str]] = None):
+        self.columns = list(columns if columns else self.default_columns)
+        self.connection = None
+        self._count_uncommitted = 0
+        super().__init__(filename)
+
+    @property
+    def benchmarks(self) -> List[dict]:
+        if self._benchmarks is None:
+            rows = self.connection.execute(
+                'SELECT record FROM benchmarks ORDER BY id')
+            self._benchmarks = [json.loads(r[0]) for r in rows]
+        return self._benchmarks
+
+    @benchmarks.setter
+    def benchmarks(self, benchmarks: Optional[List[dict]]):
+        self._benchmarks = benchmarks
+
+    def reset_from_file(self, filename=None):
+        if filename is None:
+            filename = self.filename
+        if self.connection is not None:
+            self.connection.close()
+        self.filename = filename
+        self.connection = sqlite3.connect(filename)
+        self._count_uncommitted = 0
+        self.context = dict()
+        self._create_schema()
+        self._drop_cache()
+
+    def _create_schema(self):
+        self.connection.execute('''
+            CREATE TABLE IF NOT EXISTS benchmarks (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                record TEXT NOT NULL
+            )''')
+        existing_columns = {
+            r[1] for r in self.connection.execute('PRAGMA table_info(benchmarks)')}
+        for column in self.columns:
+            quoted = StatsDatabase._quote(column)
+            if column not in existing_columns:
+                self.connection.execute(
+                    f'ALTER TABLE benchmarks ADD COLUMN {quoted}')
+                self.connection.execute(
+                    f'UPDATE benchmarks SET {quoted} = json_extract(record, ?)',
+                    (StatsDatabase._json_path(column), ))
+            index_name = StatsDatabase._quote(f'benchmarks_by_{column}')
+            self.connection.execute(
+                f'CREATE INDEX IF NOT EXISTS {index_name} ON benchmarks ({quoted})')
+        self.connection.commit()
+
+    def _drop_cache(self):
+        self._benchmarks = None
+        self._drop_indexes()
+
+    def dump_to_file(self, filename=None):
+        """
+            Commits the pending changes or exports all entries
+            into a file of another supported format.
+        """
+        if filename is None or filename == self.filename:
+            self._commit()
+        else:
+            super().dump_to_file(filename)
+
+    def compact(self, filename=None):
+        self.dump_to_file(filename)
+        if filename is None or filename == self.filename:
+            self.connection.execute('VACUUM')
+
+    def has_unsaved_changes(self) -> bool:
+        return self._count_uncommitted > 0
+
+    def close(self):
+        self._commit()
+        self.connection.close()
+        self.connection = None
+
+# pragma region Modification
+
+    def append(self, file: sf.StatsFile):
+        for b in file.benchmarks:
+            record = self._insert(b)
+            self._cache_record(None, record)
+            self._count_uncommitted += 1
+        self._commit_if_needed()
+
+    def existing_index(self, bench) -> Optional[int]:
+        row_id = self._existing_id(bench)
+        if row_id is None:
+            return None
+        row = self.connection.execute(
+            'SELECT COUNT(*) FROM benchmarks WHERE id < ?', (row_id, ))
+        return row.fetchone()[0]
+
+    def contains(self, bench) -> bool:
+        return self._existing_id(bench) is not None
+
+    def _existing_id(self, bench) -> Optional[int]:
+        if isinstance(bench, mb.MicroBench):
+            bench = bench.filtering_criterea()
+        assert isinstance(bench, dict), type(bench).__name__
+        for row_id, _ in self._select_rows(**bench):
+            return row_id
+        return None
+
+    def _upsert_dict(self, bench: dict, criterea: dict) -> bool:
+        row_id = self._existing_id(criterea)
+        if row_id is None:
+            record = self._insert(bench)
+        else:
+            names, values = self._columns_of(bench)
+            record = values[0]
+            assignments = ', '.join(f'{n} = ?' for n in names)
+            self.connection.execute(
+                f'UPDATE benchmarks SET {assignments} WHERE id = ?',
+                (*values, row_id))
+        self._cache_record(row_id, record)
+        self._count_uncommitted += 1
+        self._commit_if_needed()
+        return row_id is None
+
+    def _insert(self, bench: dict) -> str:
+        names, values = self._columns_of(bench)
+        placeholders = ', '.join(['?'] * len(names))
+        self.connection.execute(
+            f'INSERT INTO benchmarks ({", ".join(names)}) VALUES ({placeholders})',
+            values)
+        return values[0]
+
+    def _cache_record(self, row_id: Optional[int], record: str):
+        """
+            Mirrors the stored `record` in the `benchmarks` list, if it
+            was loaded, instead of reading the whole table again.
+            New rows get the largest `id`, so they go to the end.
+        """
+        if self._benchmarks is None:
+            return
+        self._own_benchmarks()
+        bench = json.loads(record)
+        if row_id is None:
+            self._benchmarks.append(bench)
+        else:
+            row = self.connection.execute(
+                'SELECT COUNT(*) FROM benchmarks WHERE id < ?', (row_id, ))
+            self._replace(row.fetchone()[0], bench)
+
+    def _commit_if_needed(self):
+        if self._count_uncommitted >= self.commit_every:
+            self._commit()
+
+    def _commit(self):
+        self.connection.commit()
+        self._count_uncommitted = 0
+
+    def _columns_of(self, bench: dict) -> Tuple[List[str], list]:
+        names = ['record']
+        values = [json.dumps(bench)]
+        for column in self.columns:
+            val = bench.get(column, None)
+            names.append(StatsDatabase._quote(column))
+            values.append(val if StatsDatabase._is_scalar(val) else None)
+        return names, values
+
+# pragma region Queries
+
+    @staticmethod
+    def _quote(name: str) -> str:
+        return '"' + name.replace('"', '""') + '"'
+
+    @staticmethod
+    def _json_path(name: str) -> str:
+        return '$."' + name + '"'
+
+    @staticmethod
+    def _is_scalar(val) -> bool:
+        return isinstance(val, (str, int, float)) and not isinstance(val, bool)
+
+    def _field_sql(self, name: str) -> Tuple[str, list]:
+        """
+            Returns the SQL expression and parameters, that
+            select the value of the field named `name`.
+        """
+        if name in self.columns:
+            return StatsDatabase._quote(name), []
+        assert '"' not in name, 'Quotes are not allowed in field names'
+        return 'json_extract(record, ?)', [StatsDatabase._json_path(name)]
+
+    def _where_sql(self, filters: dict) -> Tuple[str, list, dict]:
+        """
+            Translates the equality `filters` on scalars into
+            an SQL condition and returns the remaining filters,
+            that must be evaluated in Python.
+        """
+        conditions = list()
+        params = list()
+        remaining = dict()
+        for name, val in filters.items():
+            if StatsDatabase._is_scalar(val) and '"' not in name:
+                expr, expr_params = self._field_sql(name)
+                conditions.append(f'{expr} = ?')
+                params.extend(expr_params)
+                params.append(val)
+            else:
+                remaining[name] = val
+        where = ' AND '.join(conditions) if len(conditions) else '1'
+        return where, params, remaining
+
+    def _select_rows(self, **filters) -> Iterator[Tuple[int, dict]]:
+        where, params, remaining = self._where_sql(filters)
+        pred = ss.StatsSubset.predicate(**remaining)
+        rows = self.connection.execute(
+            f'SELECT id, record FROM benchmarks WHERE {where} ORDER BY id',
+            params)
+        for row_id, record in rows:
+            b = json.loads(record)
+            if pred(b):
+                yield row_id, b
+
+    def stream(self, **filters) -> Iterator[dict]:
+        """
+            Lazily yields the entries matching the `filters`,
+            without loading the whole table.
+        """
+        for _, b in self._select_rows(**filters):
+            yield b
+
+# pragma region Shortcuts
+
+    def filtered(self, **filters) -> ss.StatsSubset:
+        return ss.StatsSubset(source=self.stream(**filters))
+
+    def grouped(self, *grouping_keys, **aggregation_policies) -> ss.StatsSubset:
+        """
+            Groups entries inside of SQLite, if all the policies have
+            SQL counterparts. Just like in `StatsSubset.group()` groups
+            of a single entry are exported whole, so their records
+            are fetched by `id` after the aggregation.
+        """
+        aggregates = [_sql_aggregates.get(p, None)
+                      for p in aggregation_policies.values()]
+        if any(a is None for a in aggregates) or \
+                any('"' in k for k in [*grouping_keys, *aggregation_policies.keys()]):
+            return ss.StatsSubset(source=iter(ss.StatsSubset.group(
+                self.stream(), *grouping_keys, **aggregation_policies)))
+
+        selected = list()
+        conditions = list()
+        params = list()
+        for k in grouping_keys:
+            expr, expr_params = self._field_sql(k)
+            selected.append((expr, expr_params))
+            conditions.append((f'{expr} IS NOT NULL', expr_params))
+        for k, aggregate in zip(aggregation_policies.keys(), aggregates):
+            expr, expr_params = self._field_sql(k)
+            selected.append((f'{aggregate}({expr})', expr_params))
+        selected.append(('COUNT(*)', []))
+        selected.append(('MIN(id)', []))
+
+        for _, expr_params in selected:
+            params.extend(expr_params)
+        for _, expr_params in conditions:
+            params.extend(expr_params)
+        for expr, expr_params in selected[:len(grouping_keys)]:
+            params.extend(expr_params)
+
+        select_sql = ', '.join(expr for expr, _ in selected)
+        where_sql = ' AND '.join(expr for expr, _ in conditions)
+        group_sql = ', '.join(expr for expr, _ in selected[:len(grouping_keys)])
+        query = f'SELECT {select_sql} FROM benchmarks'
+        if len(conditions):
+            query += f' WHERE {where_sql}'
+        if len(grouping_keys):
+            query += f' GROUP BY {group_sql}'
+
+        names = [*grouping_keys, *aggregation_policies.keys()]
+        result = list()
+        singles = dict()
+        for *row, count, first_id in self.connection.execute(query, params):
+            if count == 1:
+                singles[first_id] = len(result)
+                result.append(dict(zip(grouping_keys, row)))
+            else:
+                result.append(
+                    {n: v for n, v in zip(names, row) if v is not None})
+
+        # Stay below the default limit of 999 parameters per query.
+        single_ids = list(singles.keys())
+        for start in range(0, len(single_ids), 500):
+            chunk = single_ids[start:start + 500]
+            placeholders = ', '.join(['?'] * len(chunk))
+            rows = self.connection.execute(
+                f'SELECT id, record FROM benchmarks WHERE id IN ({placeholders})',
+                chunk)
+            for row_id, record in rows:
+                idx = singles[row_id]
+                result[idx] = {**json.loads(record), **result[idx]}
+        return ss.StatsSubset(source=iter(result))
+
+    def table(self, rows: str, cols: str, cells: str):
+        fields = [rows, cols, cells]
+        if any('"' in k for k in fields):
+            return super().table(rows, cols, cells)
+
+        # Only fetch the three fields, that will be used.
+        selected = list()
+        params = list()
+        for k in fields:
+            expr, expr_params = self._field_sql(k)
+            selected.append(expr)
+            params.extend(expr_params)
+        select_sql = ', '.join(selected)
+        where_sql = ' AND '.join(f'{expr} IS NOT NULL' for expr in selected)
+        params = params + params
+        query = f'SELECT {select_sql} FROM benchmarks WHERE {where_sql} ORDER BY id'
+        entries = (dict(zip(fields, row))
+                   for row in self.connection.execute(query, params))
+        return ss.StatsSubset(source=entries).table(
+            row_name_property=rows,
+            col_name_property=cols,
+            cell_content_property=cells,
+        )
@@ -1,7 +1,9 @@
 from __future__ import annotations
 import json
 import csv
-from typing import Optional
+import re
+from typing import Optional, Iterator, Dict, List
+import os
 from os import path
 import platform
 from datetime import datetime
@@ -14,24 +16,123 @@ import pystats2md.micro_bench as mb
 import pystats2md.stats_subset as ss
 import pystats2md.stats_table as st
 import pystats2md.aggregation as a
+from pystats2md.helpers import positions_by_value
+from pystats2md.device_specs import DeviceSpecs
+
+
+class _JSONStream(object):
+    """
+        Incremental reader of a JSON document, that decodes one
+        value at a time from a sliding window over the file.
+        Only the elements of top-level arrays are yielded lazily,
+        so the memory usage is bounded by the biggest single element.
+    """
+
+    def __init__(self, f, chunk_size: int = 1 << 16):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self) -> bool:
+        chunk = self.f.read(self.chunk_size)
+        if len(chunk) == 0:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, char: str):
+        found = self.peek()
+        assert found == char, f'Expected {char}, got: {found}'
+        self.pos += 1
+
+    def value(self) -> object:
+        self.peek()
+        while True:
+            try:
+                val, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # Numbers and literals may continue in the next chunk.
+            if end == len(self.buffer) and not self.eof and self._fill():
+                continue
+            self.pos = end
+            return val
+
+    def array(self) -> Iterator[object]:
+        self.expect('[')
+        if self.peek() == ']':
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.peek() == ',':
+                self.pos += 1
+                continue
+            self.expect(']')
+            return
 
 
 class StatsFile(object):
     """
         Wrapper for the full persistent stats file.
         Can import/produce CSV and JSON (dicts and arrays).
+
+        JSON Lines (`.jsonl`) files are treated as append-only logs:
+        every `upsert()` appends a single line, that lists the names of
+        its identity fields under `identity_field`. When reading, later
+        lines replace earlier entries with the same identity, and
+        `compact()` rewrites the log without the replaced entries.
     """
 
+    identity_field = '_identity'
+
+    # Identity indexes are only built for sets of fields, that were
+    # looked up at least twice, and at most this many are kept.
+    identity_indexes_limit = 8
+
 # pragma region Serialization
 
-    def __init__(self, filename=None):
+    def __init__(self, filename=None, indexed=True):
+        """
+            If `indexed`, lookups by identity fields, like the
+            `MicroBench.filtering_criterea()`, use hash indexes,
+            that are lazily built and kept in sync with the
+            modifications made through this object.
+        """
         self.filename = filename
+        self.indexed = indexed
         self.benchmarks = list()
         self.context = dict()
+        # The `benchmarks` list, while it is shared with subsets.
+        self._shared_benchmarks = None
+        # Specs of devices by fingerprint, loaded on first access.
+        self._devices = None
+        # Modifications made since the file was last read or written.
+        self._count_unsaved = 0
+        self._drop_indexes()
         self.reset_from_file(self.filename)
 
     def append(self, file: StatsFile):
+        # Identity indexes will catch up with the new tail on next lookup.
+        self._own_benchmarks()
         self.benchmarks.extend(file.benchmarks)
+        self._count_unsaved += 1
 
     def reset_from_file(self, filename=None):
         if filename is None:
@@ -39,6 +140,9 @@ class StatsFile(object):
             if filename is None:
                 return
 
+        self._drop_indexes()
+        self._devices = None
+        self._count_unsaved = 0
         if not path.exists(filename):
             self.benchmarks = list()
             self.context = dict()
@@ -47,22 +151,123 @@ class StatsFile(object):
             ext = Path(filename).suffix
             if ext == '.json':
                 self._read_from_json(f)
+            elif ext == '.jsonl':
+                self._read_from_jsonl(f)
             elif ext == '.csv':
                 self._read_from_csv(f)
             else:
                 assert False, f'Unknown extension: {ext}'
 
     def _read_from_json(self, f):
-        contents = json.load(f)
-        if isinstance(contents, dict):
-            self.context = contents.get('context', dict())
-            self.benchmarks = contents.get('benchmarks', list())
-            self.benchmarks = [b.update(self.context) for b in self.benchmarks]
-        elif isinstance(contents, list):
-            self.context = dict()
-            self.benchmarks = contents
-        else:
-            assert False, f'Unknown parsed type: {contents}'
+        self.context = dict()
+        self.benchmarks = list(StatsFile._stream_json(f, self.context))
+
+    @staticmethod
+    def stream(filename: str, context: Optional[dict] = None, chunk_size: int = 1 << 16) -> Iterator[dict]:
+        """
+            Lazily yields entries of a file one at a time, without
+            loading it whole. Such iterators can be passed to
+            `StatsSubset.filter()` and `StatsSubset.group()`,
+            so memory is only spent on the retained results.
+
+            For Google Benchmark JSON outputs the `context` is merged
+            into every entry and is also exported into the
+            optionally provided `context` dictionary.
+            Entries replaced later in `.jsonl` logs are skipped.
+        """
+        if context is None:
+            context = dict()
+        ext = Path(filename).suffix
+        if ext == '.jsonl':
+            yield from StatsFile._stream_jsonl(filename)
+            return
+        with open(filename, 'r') as f:
+            if ext == '.json':
+                yield from StatsFile._stream_json(f, context, chunk_size)
+            elif ext == '.csv':
+                yield from csv.DictReader(f)
+            else:
+                assert False, f'Unknown extension: {ext}'
+
+    @staticmethod
+    def _stream_json(f, context: dict, chunk_size: int = 1 << 16) -> Iterator[dict]:
+        stream = _JSONStream(f, chunk_size)
+        first_char = stream.peek()
+        if first_char == '[':
+            yield from stream.array()
+            return
+
+        assert first_char == '{', f'Unknown parsed type: {first_char}'
+        stream.expect('{')
+        if stream.peek() == '}':
+            return
+        while True:
+            key = stream.value()
+            stream.expect(':')
+            if key == 'benchmarks' and stream.peek() == '[':
+                # Google Benchmark outputs the `context` before the `benchmarks`.
+                for b in stream.array():
+                    yield {**context, **b}
+            elif key == 'context':
+                context.update(stream.value())
+            else:
+                stream.value()
+            if stream.peek() == ',':
+                stream.pos += 1
+                continue
+            stream.expect('}')
+            return
+
+    @staticmethod
+    def _stream_jsonl(filename: str) -> Iterator[dict]:
+        # First pass: remember the last line for every identity.
+        last_lines = dict()
+        identities = set()
+        with open(filename, 'r') as f:
+            for idx_line, line in enumerate(f):
+                if len(line.strip()) == 0:
+                    continue
+                b = json.loads(line)
+                identity = b.get(StatsFile.identity_field, None)
+                if identity is None:
+                    continue
+                fields = tuple(sorted(identity))
+                key = StatsFile._key_of(b, fields)
+                if key is not None:
+                    identities.add(fields)
+                    last_lines[(fields, key)] = idx_line
+
+        # Second pass: export entries not replaced by later lines.
+        with open(filename, 'r') as f:
+            for idx_line, line in enumerate(f):
+                if len(line.strip()) == 0:
+                    continue
+                b = json.loads(line)
+                b.pop(StatsFile.identity_field, None)
+                is_replaced = False
+                for fields in identities:
+                    key = StatsFile._key_of(b, fields)
+                    if key is None:
+                        continue
+                    if last_lines.get((fields, key), idx_line) > idx_line:
+                        is_replaced = True
+                        break
+                if not is_replaced:
+                    yield b
+
+    def _read_from_jsonl(self, f):
+        self.context = dict()
+        self.benchmarks = list()
+        for line in f:
+            if len(line.strip()) == 0:
+                continue
+            b = json.loads(line)
+            identity = b.pop(StatsFile.identity_field, None)
+            if identity is None:
+                self.benchmarks.append(b)
+            else:
+                criterea = {k: b[k] for k in identity if k in b}
+                self._upsert_dict(b, criterea)
 
     def _read_from_csv(self, f):
         contents = csv.DictReader(f)
@@ -72,18 +277,57 @@ class StatsFile(object):
     def dump_to_file(self, filename=None):
         if filename is None:
             filename = self.filename
-        with open(filename, 'w') as f:
+        assert filename is not None, 'No file to dump into'
+        # Write into a temporary file and swap it in at once,
+        # so that a crash can't leave a half-written file behind.
+        temp_filename = f'{filename}.tmp'
+        with open(temp_filename, 'w') as f:
             ext = Path(filename).suffix
             if ext == '.json':
                 self._dump_to_json(f)
+            elif ext == '.jsonl':
+                self._dump_to_jsonl(f)
             elif ext == '.csv':
                 self._dump_to_csv(f)
             else:
                 assert False, f'Unknown extension: {ext}'
+        os.replace(temp_filename, filename)
+        if filename == self.filename:
+            self._count_unsaved = 0
+
+    def compact(self, filename=None):
+        """
+            Rewrites the file with just the current entries.
+            For append-only `.jsonl` logs this drops all the
+            replaced entries, for other formats - same as `dump_to_file()`.
+        """
+        self.dump_to_file(filename)
+
+    def has_unsaved_changes(self) -> bool:
+        """
+            Checks, if the `benchmarks` differ from the file on disk.
+            Upserts into logs are appended to the file at once.
+        """
+        return self._count_unsaved > 0
+
+    def is_log(self) -> bool:
+        return self.filename is not None and \
+            Path(self.filename).suffix == '.jsonl'
 
     def _dump_to_json(self, f):
         json.dump(self.benchmarks, f, indent=4)
 
+    def _dump_to_jsonl(self, f):
+        for b in self.benchmarks:
+            f.write(json.dumps(b))
+            f.write('\n')
+
+    def _append_to_jsonl(self, bench: dict, criterea: dict):
+        line = {**bench, StatsFile.identity_field: sorted(criterea.keys())}
+        with open(self.filename, 'a') as f:
+            f.write(json.dumps(line))
+            f.write('\n')
+
     def _dump_to_csv(self, f):
         contents = csv.writer(f)
         if len(self.benchmarks) == 0:
@@ -110,6 +354,12 @@ class StatsFile(object):
     def existing_index(self, bench) -> Optional[int]:
         if isinstance(bench, mb.MicroBench):
             bench = bench.filtering_criterea()
+        if self.indexed and StatsFile._indexable(bench):
+            fields = tuple(sorted(bench.keys()))
+            if self._is_looked_up_repeatedly(fields):
+                key = tuple(bench[k] for k in fields)
+                return self._identity_index(fields).get(key, None)
+
         pred = ss.StatsSubset.predicate(**bench)
         for i, b in enumerate(self.benchmarks):
             if pred(b):
@@ -120,35 +370,213 @@ class StatsFile(object):
         if isinstance(bench, mb.MicroBench):
             bench = bench.filtering_criterea()
         assert isinstance(bench, dict), type(bench).__name__
-        pred = ss.StatsSubset.predicate(**bench)
-        for b in self.benchmarks:
-            if pred(b):
-                return True
-        return False
+        return self.existing_index(bench) is not None
 
     def __contains__(self, bench) -> bool:
         return self.contains(bench)
 
-    def upsert(self, bench) -> bool:
+    def upsert(self, bench, criterea: Optional[dict] = None) -> bool:
         """
             Supported types: `str`, `int`, `float`, `datetime.time`.
             Others can be inserted, but won't be queried.
             Returns `True` if the `bench` was inserted as new entry.
             Returns `False` if the `bench` replaced an older entry.
+            Older entries are matched by `criterea`, which default
+            to `filtering_criterea()` or the whole `bench` dictionary.
         """
-        bench_idx = self.existing_index(bench)
-
         if isinstance(bench, mb.MicroBench):
             if not self.contains(bench):
                 if not bench.did_run():
                     bench.run()
+                    if bench.source is self:
+                        # The `run()` has already upserted the results.
+                        return True
+            if bench.save_context == 'fingerprint':
+                # Records only reference the specs, so those are stored aside.
+                self.add_device_specs(DeviceSpecs.current())
+        if criterea is None:
+            if isinstance(bench, mb.MicroBench):
+                criterea = bench.filtering_criterea()
+            else:
+                criterea = bench
         if not isinstance(bench, dict):
             bench = dict(bench)
 
+        is_new = self._upsert_dict(bench, criterea)
+        if self.is_log():
+            self._append_to_jsonl(bench, criterea)
+        else:
+            self._count_unsaved += 1
+        return is_new
+
+    def _upsert_dict(self, bench: dict, criterea: dict) -> bool:
+        self._own_benchmarks()
+        bench_idx = self.existing_index(criterea)
         if bench_idx is None:
             self.benchmarks.append(bench)
         else:
-            self.benchmarks[bench_idx] = bench
+            self._replace(bench_idx, bench)
+        return bench_idx is None
+
+    def shared_benchmarks(self) -> List[dict]:
+        """
+            Returns the `benchmarks` list for a `StatsSubset` to share
+            instead of copying. The file copies the list on its next
+            modification, so the subset keeps seeing a snapshot.
+        """
+        self._shared_benchmarks = self.benchmarks
+        return self._shared_benchmarks
+
+    def _own_benchmarks(self):
+        if self._shared_benchmarks is not None and \
+                self._shared_benchmarks is self.benchmarks:
+            # Positions don't change, so the indexes remain valid.
+            self.benchmarks = list(self.benchmarks)
+        self._shared_benchmarks = None
+
+# pragma region Device Specs
+
+    def devices_filename(self) -> Optional[str]:
+        """
+            Sidecar file next to this one, that maps the `device_fingerprint`
+            of records, saved with `save_context='fingerprint'`,
+            to the full specs of those devices.
+        """
+        if self.filename is None:
+            return None
+        file_path = Path(self.filename)
+        return str(file_path.with_name(f'{file_path.stem}.devices.json'))
+
+    @property
+    def devices(self) -> Dict[str, dict]:
+        if self._devices is None:
+            self._devices = dict()
+            filename = self.devices_filename()
+            if filename is not None and path.exists(filename):
+                with open(filename, 'r') as f:
+                    self._devices = json.load(f)
+        return self._devices
+
+    def device_specs(self, fingerprint: str) -> Optional[dict]:
+        return self.devices.get(fingerprint, None)
+
+    def add_device_specs(self, specs: dict):
+        """
+            Remembers the `specs`, like `DeviceSpecs.current()`, under
+            their fingerprint and persists them, if this file has a name.
+        """
+        fingerprint = specs['device_fingerprint']
+        specs = {k: v for k, v in specs.items() if k != 'probed_at'}
+        if self.devices.get(fingerprint, None) == specs:
+            return
+        self.devices[fingerprint] = specs
+        filename = self.devices_filename()
+        if filename is None:
+            return
+        temp_filename = f'{filename}.tmp'
+        with open(temp_filename, 'w') as f:
+            json.dump(self.devices, f, indent=4)
+        os.replace(temp_filename, filename)
+
+# pragma region Indexing
+
+    @staticmethod
+    def _indexable(criterea: dict) -> bool:
+        for v in criterea.values():
+            if v is None or isinstance(v, re.Pattern):
+                return False
+            try:
+                hash(v)
+            except TypeError:
+                return False
+        return True
+
+    @staticmethod
+    def _key_of(b: dict, fields: tuple) -> Optional[tuple]:
+        if not all(k in b for k in fields):
+            return None
+        key = tuple(b[k] for k in fields)
+        try:
+            hash(key)
+        except TypeError:
+            # Unhashable values can't be equal to the hashable criterea.
+            return None
+        return key
+
+    def _drop_indexes(self):
+        # Maps a sorted tuple of field names to a pair:
+        # a dictionary of values to first positions and
+        # the number of already indexed `benchmarks`.
+        self._identity_indexes = dict()
+        # Counts lookups by sets of fields, that aren't indexed yet.
+        self._identity_lookups = dict()
+        # Maps a field name to a pair: a dictionary of values
+        # to all positions and the number of indexed `benchmarks`.
+        self._field_indexes = dict()
+
+    def field_index(self, field: str) -> Dict[object, List[int]]:
+        """
+            Maps the values of `field` to the positions of all the
+            entries with such value. Used by `StatsSubset.filtered()`
+            to avoid scanning the whole file on equality filters.
+        """
+        index = self._field_indexes.get(field, None)
+        if index is None or index[1] > len(self.benchmarks):
+            index = [dict(), 0]
+            self._field_indexes[field] = index
+        if index[1] < len(self.benchmarks):
+            positions_by_value(self.benchmarks, field, index[0], index[1])
+            index[1] = len(self.benchmarks)
+        return index[0]
+
+    def _is_looked_up_repeatedly(self, fields: tuple) -> bool:
+        """
+            One-off lookups, like upserts of whole heterogeneous
+            dictionaries, are cheaper to scan, than to index.
+        """
+        if fields in self._identity_indexes:
+            return True
+        if len(self._identity_lookups) >= StatsFile.identity_indexes_limit * 64:
+            self._identity_lookups = dict()
+        count = self._identity_lookups.get(fields, 0) + 1
+        self._identity_lookups[fields] = count
+        return count >= 2
+
+    def _identity_index(self, fields: tuple) -> dict:
+        """
+            Maps the values of `fields` to the position of the first
+            entry with such values. Entries appended since the last
+            lookup are indexed on the fly. The least recently
+            used indexes are dropped above the `identity_indexes_limit`.
+        """
+        index = self._identity_indexes.pop(fields, None)
+        if index is None or index[1] > len(self.benchmarks):
+            index = [dict(), 0]
+            while len(self._identity_indexes) >= StatsFile.identity_indexes_limit:
+                del self._identity_indexes[next(iter(self._identity_indexes))]
+        # Re-inserting moves the index to the end of the LRU order.
+        self._identity_indexes[fields] = index
+
+        positions, count_indexed = index
+        for i in range(count_indexed, len(self.benchmarks)):
+            key = StatsFile._key_of(self.benchmarks[i], fields)
+            if key is not None and key not in positions:
+                positions[key] = i
+        index[1] = len(self.benchmarks)
+        return positions
+
+    def _replace(self, idx: int, bench: dict):
+        old = self.benchmarks[idx]
+        self.benchmarks[idx] = bench
+        for field in list(self._field_indexes.keys()):
+            if old.get(field, None) != bench.get(field, None) or \
+                    (field in old) != (field in bench):
+                del self._field_indexes[field]
+        for fields in list(self._identity_indexes.keys()):
+            old_key = StatsFile._key_of(old, fields)
+            if old_key != StatsFile._key_of(bench, fields):
+                # Some later entry may now be the first with `old_key`.
+                del self._identity_indexes[fields]
 
 # pragma region Shortcuts
 
@@ -158,6 +586,9 @@ class StatsFile(object):
     def filtered(self, *vargs, **kwargs) -> ss.StatsSubset:
         return ss.StatsSubset(source=self).filtered(*vargs, **kwargs)
 
+    def grouped(self, *vargs, **kwargs) -> ss.StatsSubset:
+        return ss.StatsSubset(source=self).grouped(*vargs, **kwargs)
+
     def table(self, rows: str, cols: str, cells: str):
         return ss.StatsSubset(source=self).table(
             row_name_property=rows,
@@ -166,7 +597,7 @@ class StatsFile(object):
         )
 
     def plot(self, title: str, variants: str, groups: str, values: str, aggregator=a.Aggregation.take_mean, **kwargs):
-        return ss.StatsSubset(source=self).grouped(
+        return self.grouped(
             *[variants, groups],
             **{values: aggregator}
         ).table(
@@ -1,24 +1,112 @@
 import copy
-
-import plotly.graph_objects as go
-import plotly.express as px
+import json
+import hashlib
+import os
+import shutil
+import importlib.util
+from typing import Dict, List
 
 from pystats2md.helpers import *
+from pystats2md.aggregation import QuantileSketch
+from pystats2md.svg_chart import SVGBarChart, SVGLineChart, prism_colors
 
 
 class StatsPlot(object):
 
-    def __init__(self, table, title: str, print_height=True, print_cols_names=True, print_rows_names=True):
+    # Prefix of the comment, that marks rendered SVGs with their `fingerprint()`.
+    fingerprint_marker = '<!-- pystats2md:'
+
+    # Result of `default_backend()`, cached for the lifetime of the process.
+    _default_backend = None
+
+    def __init__(self, table, title: str, print_height=True, print_cols_names=True, print_rows_names=True, backend='auto'):
+        """
+            The `backend` is either 'plotly', which requires the Kaleido
+            or Orca image export engine, or the built-in 'svg' renderer.
+            The 'auto' picks Plotly, if it's usable, and SVG otherwise.
+        """
+        assert backend in ['auto', 'plotly', 'svg'], backend
         self.table = table
         self.title = title
         self.print_height = print_height
         self.print_cols_names = print_cols_names
         self.print_rows_names = print_rows_names
+        self.backend = backend
+
+    @staticmethod
+    def default_backend() -> str:
+        if StatsPlot._default_backend is None:
+            has_plotly = importlib.util.find_spec('plotly') is not None
+            has_engine = importlib.util.find_spec('kaleido') is not None or \
+                shutil.which('orca') is not None
+            StatsPlot._default_backend = 'plotly' if has_plotly and has_engine else 'svg'
+        return StatsPlot._default_backend
+
+    def resolved_backend(self) -> str:
+        return self.backend if self.backend != 'auto' else StatsPlot.default_backend()
+
+    def spec(self) -> dict:
+        """
+            Everything, that affects the rendered image.
+        """
+        return {
+            'title': self.title,
+            'content': self.table.content,
+            'header_row': self.table.header_row,
+            'header_col': self.table.header_col,
+            'print_height': self.print_height,
+            'print_cols_names': self.print_cols_names,
+            'print_rows_names': self.print_rows_names,
+            'backend': self.resolved_backend(),
+        }
+
+    def fingerprint(self) -> str:
+        spec = json.dumps([type(self).__name__, self.spec()],
+                          sort_keys=True, default=str)
+        return hashlib.sha256(spec.encode()).hexdigest()[:32]
+
+    def is_rendered(self, path: str, fingerprint: str = None) -> bool:
+        """
+            Checks if the image at `path` was rendered from the same spec,
+            by looking for the fingerprint at the end of the file.
+        """
+        if not os.path.exists(path):
+            return False
+        if fingerprint is None:
+            fingerprint = self.fingerprint()
+        with open(path, 'rb') as f:
+            f.seek(max(os.path.getsize(path) - 256, 0))
+            tail = f.read().decode(errors='ignore')
+        return f'{StatsPlot.fingerprint_marker}{fingerprint} -->' in tail
+
+    def render_to(self, path: str, fingerprint: str = None) -> bool:
+        """
+            Renders the image, unless it's already up to date, and marks
+            it with the `fingerprint()`. Returns `True` if it was rendered.
+        """
+        if fingerprint is None:
+            fingerprint = self.fingerprint()
+        if self.is_rendered(path, fingerprint):
+            return False
+        self.save_to(path)
+        with open(path, 'a') as f:
+            f.write(f'\n{StatsPlot.fingerprint_marker}{fingerprint} -->\n')
+        return True
 
     def save_to(self, path: str = '') -> str:
         cols_names = self.table.header_row if self.print_cols_names else ([''] * len(self.table.header_row))
         rows_names = self.table.header_col if self.print_rows_names else ([''] * len(self.table.header_col))
-        availiable_colors = px.colors.qualitative.Prism
+        if self.resolved_backend() == 'svg':
+            assert path.endswith('.svg'), 'Only SVG is supported without Plotly'
+            return SVGBarChart(
+                title=self.title,
+                groups=cols_names,
+                series=list(zip(rows_names, self.table.content)),
+                print_height=self.print_height,
+            ).save_to(path)
+
+        import plotly.graph_objects as go
+        availiable_colors = prism_colors
 
         fig = go.Figure()
         for row_idx, row_name in enumerate(rows_names):
@@ -63,3 +151,126 @@ class StatsPlot(object):
         )
         fig.write_image(path)
         return path
+
+
+class LatencyPlot(StatsPlot):
+    """
+        Cumulative distribution of latencies of several benchmarks,
+        reconstructed from their serialized `latency_histogram`-s.
+    """
+
+    def __init__(self, histograms: Dict[str, QuantileSketch], title: str, log_scale=True, backend='auto'):
+        super().__init__(table=None, title=title, backend=backend)
+        self.histograms = histograms
+        self.log_scale = log_scale
+
+    def spec(self) -> dict:
+        return {
+            'title': self.title,
+            'histograms': {str(n): h.to_dict() for n, h in self.histograms.items()},
+            'log_scale': self.log_scale,
+            'backend': self.resolved_backend(),
+        }
+
+    def save_to(self, path: str = '') -> str:
+        if self.resolved_backend() == 'svg':
+            assert path.endswith('.svg'), 'Only SVG is supported without Plotly'
+            return SVGLineChart(
+                title=self.title,
+                series=[(str(n), h.cdf()) for n, h in self.histograms.items()],
+                x_title='Latency (msecs)',
+                y_title='Fraction of operations',
+                log_x=self.log_scale,
+                step=True,
+                y_range=(0, 1),
+            ).save_to(path)
+
+        import plotly.graph_objects as go
+        availiable_colors = prism_colors
+
+        fig = go.Figure()
+        for idx, (name, sketch) in enumerate(self.histograms.items()):
+            points = sketch.cdf()
+            fig.add_trace(go.Scatter(
+                name=str(name),
+                x=[p[0] for p in points],
+                y=[p[1] for p in points],
+                mode='lines',
+                line_shape='hv',
+                marker_color=availiable_colors[idx % len(availiable_colors)],
+            ))
+
+        fig.update_layout(
+            title_text=self.title,
+            xaxis_title='Latency (msecs)',
+            xaxis_type='log' if self.log_scale else 'linear',
+            yaxis_title='Fraction of operations',
+            yaxis_range=[0, 1],
+            legend=dict(
+                x=0,
+                y=1.0,
+                bgcolor='rgba(255, 255, 255, 0)',
+                bordercolor='rgba(255, 255, 255, 0)'
+            ),
+        )
+        fig.write_image(path)
+        return path
+
+
+class TimelinePlot(StatsPlot):
+    """
+        Resource usage over the duration of several benchmarks,
+        decoded from their serialized `resource_timeline`-s.
+        Spikes and plateaus reveal noisy or throttled runs.
+    """
+
+    def __init__(self, timelines: Dict[str, Dict[str, List]], title: str, metric: str = 'cpu_percent', backend='auto'):
+        super().__init__(table=None, title=title, backend=backend)
+        self.timelines = timelines
+        self.metric = metric
+
+    def spec(self) -> dict:
+        return {
+            'title': self.title,
+            'timelines': {str(n): t for n, t in self.timelines.items()},
+            'metric': self.metric,
+            'backend': self.resolved_backend(),
+        }
+
+    def save_to(self, path: str = '') -> str:
+        if self.resolved_backend() == 'svg':
+            assert path.endswith('.svg'), 'Only SVG is supported without Plotly'
+            return SVGLineChart(
+                title=self.title,
+                series=[(str(n), [(t / 1000, v) for t, v in zip(timeline['msecs'], timeline[self.metric])])
+                        for n, timeline in self.timelines.items()],
+                x_title='Time (secs)',
+                y_title=self.metric,
+            ).save_to(path)
+
+        import plotly.graph_objects as go
+        availiable_colors = prism_colors
+
+        fig = go.Figure()
+        for idx, (name, timeline) in enumerate(self.timelines.items()):
+            fig.add_trace(go.Scatter(
+                name=str(name),
+                x=[t / 1000 for t in timeline['msecs']],
+                y=timeline[self.metric],
+                mode='lines',
+                marker_color=availiable_colors[idx % len(availiable_colors)],
+            ))
+
+        fig.update_layout(
+            title_text=self.title,
+            xaxis_title='Time (secs)',
+            yaxis_title=self.metric,
+            legend=dict(
+                x=0,
+                y=1.0,
+                bgcolor='rgba(255, 255, 255, 0)',
+                bordercolor='rgba(255, 255, 255, 0)'
+            ),
+        )
+        fig.write_image(path)
+        return path
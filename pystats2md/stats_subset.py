@@ -1,107 +1,574 @@
 from __future__ import annotations
-import copy
 import re  # Filtering
-import itertools  # Combinations of grouping keys
+import itertools  # Chaining lazy inputs
 
 from pystats2md.helpers import *
 from pystats2md.aggregation import Aggregation
+from pystats2md.stats_columns import StatsColumns
+from pystats2md.aggregation import QuantileSketch
+from pystats2md.stats_plot import LatencyPlot, TimelinePlot
+from pystats2md.resource_sampler import ResourceSampler
 import pystats2md.stats_file as sf
 import pystats2md.stats_table as st
+import pystats2md.micro_bench as mb
 
 
 class StatsSubset(object):
+    """
+        A view over a list of stats dictionaries, that can be
+        shared with a `StatsFile` or other subsets. Filtering only
+        narrows the list of selected positions, nothing is copied,
+        until the `dicts_list` is requested or new stats are included.
+        The stats dictionaries themselves are never modified.
+    """
 
-    def __init__(self, source=None):
-        self.dicts_list = list()
+    def __init__(self, source=None, columnar=False, lazy=False):
+        """
+            If `columnar`, the stats are stored in `StatsColumns`
+            instead of a list of dictionaries, which is much more
+            compact and faster to filter and group for big inputs.
+            The `dicts_list` is then materialized on every access.
+
+            If `lazy`, filtering, compaction and grouping are only
+            recorded into a plan, that is optimized and evaluated,
+            when the results are needed. Files passed by name and
+            callables returning iterables are then streamed in a single
+            pass on every evaluation. Other iterators can't be restarted,
+            so those are loaded into memory on the first evaluation.
+        """
+        self.columns = StatsColumns() if columnar else None
+        self._source = list()
+        self._owns_source = True
+        # The file sharing its `benchmarks` as our `_source` and
+        # the lazily built positions of values of separate fields.
+        self._file = None
+        self._field_indexes = dict()
+        # Positions of selected stats in the `_source` or `columns`,
+        # or `None`, if everything is selected.
+        self._rows = None
+        # Recorded operations and not yet consumed inputs of lazy subsets.
+        self._plan = list() if lazy else None
+        self._lazy_inputs = list()
         self.include(source)
 
+    def is_lazy(self) -> bool:
+        return self._plan is not None
+
+    @property
+    def dicts_list(self) -> List[dict]:
+        self._materialize()
+        if self.columns is not None:
+            return [self.columns.row(i) for i in self._selected_rows()]
+        # The list may be modified by the caller, so we must own it.
+        self._own_source()
+        return self._source
+
+    @dicts_list.setter
+    def dicts_list(self, dicts_list: List[dict]):
+        self._rows = None
+        if self.columns is not None:
+            self.columns = StatsColumns(dicts_list)
+        else:
+            self._source = dicts_list
+            self._owns_source = True
+            self._field_indexes = dict()
+
+    def __len__(self) -> int:
+        self._materialize()
+        if self._rows is not None:
+            return len(self._rows)
+        return len(self.columns) if self.columns is not None else len(self._source)
+
+    def __iter__(self):
+        self._materialize()
+        return self._iterate_selected()
+
+    def _iterate_selected(self):
+        if self.columns is not None:
+            return (self.columns.row(i) for i in self._selected_rows())
+        if self._rows is None:
+            return iter(self._source)
+        return (self._source[i] for i in self._rows)
+
+    def _selected_rows(self):
+        if self._rows is not None:
+            return self._rows
+        return range(len(self.columns) if self.columns is not None else len(self._source))
+
+    def _own_source(self):
+        """
+            Copy-on-write: replaces a shared or partially selected
+            source with a private list of references to the selected stats.
+        """
+        if self.columns is not None:
+            if self._rows is not None:
+                self.columns = self.columns.take(self._rows)
+                self._rows = None
+            return
+        if self._owns_source and self._rows is None:
+            return
+        self._source = list(self._iterate_selected())
+        self._owns_source = True
+        self._field_indexes = dict()
+        self._rows = None
+
     def include(self, contents: List[dict]) -> StatsSubset:
         if contents is None:
             return self
-        elif isinstance(contents, list):
-            self.dicts_list.extend(copy.deepcopy(contents))
-            return self
         elif isinstance(contents, sf.StatsFile):
-            self.dicts_list.extend(contents.benchmarks.copy())
+            self.include(contents.shared_benchmarks())
+            self._file = contents
             return self
-        elif isinstance(contents, str):
+
+        if self.is_lazy():
+            # Recorded operations must not apply to the new stats.
+            self._materialize()
+            if not isinstance(contents, list):
+                self._lazy_inputs.append(contents)
+                return self
+        if isinstance(contents, str):
             return self.include(sf.StatsFile(contents))
+        if callable(contents):
+            contents = contents()
+
+        if self.columns is not None:
+            # Values are copied into the columns anyway.
+            self._own_source()
+            self.columns.extend(contents)
+        elif isinstance(contents, list) and len(self) == 0:
+            # Share the list instead of copying it.
+            self._source = contents
+            self._owns_source = False
+            self._rows = None
+            self._field_indexes = dict()
+        else:
+            # Any other iterable, like `StatsFile.stream()`, is consumed once.
+            self._own_source()
+            self._source.extend(contents)
+            self._field_indexes = dict()
+        return self
 
     def filtered(self, **filters) -> StatsSubset:
-        self.dicts_list = StatsSubset.filter(self.dicts_list, **filters)
+        if self.is_lazy():
+            self._plan.append(('filter', filters))
+            return self
+        if self.columns is not None:
+            mask = self.columns.mask(**filters)
+            self._rows = [i for i in self._selected_rows() if mask[i]]
+            return self
+
+        pred = StatsSubset.predicate(**filters)
+        source = self._source
+        candidates = self._equality_candidates(filters)
+        if candidates is None:
+            candidates = self._selected_rows()
+        elif self._rows is not None:
+            # Positions in indexes are ascending, so the order is preserved.
+            selected = set(self._rows)
+            candidates = [i for i in candidates if i in selected]
+        self._rows = [i for i in candidates if pred(source[i])]
         return self
 
+    def _field_index(self, field: str) -> Optional[dict]:
+        """
+            Returns positions of values of the `field` in the `_source`.
+            Indexes of files are shared between all of their subsets.
+            Others are only built, if the whole source is selected,
+            as a scan of a narrower selection is cheaper.
+        """
+        if self._file is not None and self._source is self._file.benchmarks:
+            return self._file.field_index(field)
+        index = self._field_indexes.get(field, None)
+        if index is None and self._rows is None:
+            index = positions_by_value(self._source, field)
+            self._field_indexes[field] = index
+        return index
+
+    def _equality_candidates(self, filters: dict) -> Optional[List[int]]:
+        """
+            Picks the shortest list of positions, that satisfy one
+            of the equality `filters`, or `None`, if none is indexed.
+        """
+        shortest = None
+        for property_name, filter_criterea in filters.items():
+            if isinstance(filter_criterea, re.Pattern):
+                continue
+            try:
+                hash(filter_criterea)
+            except TypeError:
+                continue
+            index = self._field_index(property_name)
+            if index is None:
+                continue
+            positions = index.get(filter_criterea, [])
+            if shortest is None or len(positions) < len(shortest):
+                shortest = positions
+        return shortest
+
     def compacted(self, **aggregation_policies) -> StatsSubset:
-        self.dicts_list = StatsSubset.compact(
-            self.dicts_list, **aggregation_policies)
+        if self.is_lazy():
+            self._plan.append(('compact', aggregation_policies))
+            return self
+        reduced_dict = StatsSubset.compact(
+            list(self), **aggregation_policies)
+        self.dicts_list = [reduced_dict] if len(reduced_dict) else []
         return self
 
     def grouped(self, *grouping_keys, **aggregation_policies) -> StatsSubset:
-        self.dicts_list = StatsSubset.group(
-            self.dicts_list, *grouping_keys, **aggregation_policies)
+        if self.is_lazy():
+            self._plan.append(('group', grouping_keys, aggregation_policies))
+            return self
+        if self.columns is not None:
+            self.columns = StatsColumns(self.columns.group(
+                *grouping_keys, rows=self._rows, **aggregation_policies))
+            self._rows = None
+        else:
+            self.dicts_list = StatsSubset.group(
+                self, *grouping_keys, **aggregation_policies)
         return self
 
-    def unique(self, field: str) -> List[str]:
-        return sorted(list(get_unique(self.dicts_list, field)))
+    def unique(self, field: str) -> list:
+        """
+            Sorted distinct values of the `field`, keeping their types.
+        """
+        if self._is_pending():
+            return self._evaluated({field}).unique(field)
+        if self.columns is not None:
+            return sorted_values(self.columns.unique(field, self._rows))
+        return unique_values(self, field)
 
     def table(
         self,
         row_name_property: str,
         col_name_property: str,
         cell_content_property: str,
-        row_names: List[str] = [],
-        col_names: List[str] = [],
+        row_names: list = [],
+        col_names: list = [],
         include_headers=True,
+        cell_aggregation=None,
     ) -> StatsTable:
         """
-            Transforms the list of stats into a 2D table.
-            Performs no type conversions and assumes the data
-            is already `compact()`-ed to have just 1 entry per
-            combination of (`row_name`, `col_name`).
+            Transforms the list of stats into a 2D table in a single pass.
+            Performs no type conversions. If several stats land into
+            the same cell, the last one is kept, unless a
+            `cell_aggregation` policy is provided, like `Aggregation.take_mean`.
 
             If no names are provided for rows and columns, 
             we will add all combinations.
         """
+        if self._is_pending():
+            fields = {row_name_property, col_name_property, cell_content_property}
+            return self._evaluated(fields).table(
+                row_name_property,
+                col_name_property,
+                cell_content_property,
+                row_names=row_names,
+                col_names=col_names,
+                include_headers=include_headers,
+                cell_aggregation=cell_aggregation,
+            )
+
+        # Names, that will be collected in the same pass, if not provided.
+        seen_rows = None if len(row_names) else set()
+        seen_cols = None if len(col_names) else set()
+        make_accumulator = None
+        if cell_aggregation is not None:
+            make_accumulator = Aggregation.accumulator_for(cell_aggregation)
 
-        if len(row_names) == 0:
-            row_names = self.unique(row_name_property)
-        if len(col_names) == 0:
-            col_names = self.unique(col_name_property)
+        cells = dict()
+        for s in self:
+            try:
+                if seen_rows is not None and row_name_property in s:
+                    seen_rows.add(s[row_name_property])
+                if seen_cols is not None and col_name_property in s:
+                    seen_cols.add(s[col_name_property])
+                # The `s` dictionary must have all the request fields to be included.
+                if not ((row_name_property in s) and
+                        (col_name_property in s) and
+                        (cell_content_property in s)):
+                    continue
+                key = (s[row_name_property], s[col_name_property])
+                val = s[cell_content_property]
+                if cell_aggregation is None:
+                    cells[key] = val
+                    continue
+                reduction = cells.get(key, None)
+            except TypeError:
+                # Unhashable names can't match any row or column.
+                continue
+            if reduction is None:
+                reduction = list() if make_accumulator is None else make_accumulator()
+                cells[key] = reduction
+            if make_accumulator is None:
+                reduction.append(val)
+            else:
+                reduction.add(val)
+
+        if seen_rows is not None:
+            row_names = sorted_values(seen_rows)
+        if seen_cols is not None:
+            col_names = sorted_values(seen_cols)
+        row_positions = dict()
+        for i, name in enumerate(row_names):
+            row_positions.setdefault(name, i)
+        col_positions = dict()
+        for i, name in enumerate(col_names):
+            col_positions.setdefault(name, i)
 
         result = list()
         for _ in row_names:
             result.append([None] * len(col_names))
-        for s in self.dicts_list:
-            # The `s` dictionary must have all the request fields to be included.
-            if not ((row_name_property in s) and
-                    (col_name_property in s) and
-                    (cell_content_property in s)):
-                continue
-            idx_row = index_of(row_names, s.get(row_name_property, None))
-            idx_col = index_of(col_names, s.get(col_name_property, None))
+        for (row_name, col_name), val in cells.items():
+            idx_row = row_positions.get(row_name, None)
+            idx_col = col_positions.get(col_name, None)
             if (idx_row is None) or (idx_col is None):
                 continue
-            result[idx_row][idx_col] = s.get(cell_content_property, None)
+            if cell_aggregation is not None:
+                if make_accumulator is None:
+                    val = cell_aggregation(val)
+                else:
+                    val = val.result()
+            result[idx_row][idx_col] = val
+
+        return st.StatsTable(
+            content=result,
+            header_row=list(col_names),
+            header_col=list(row_names),
+        )
+
+    def latency_table(self, row_name_property: str = 'benchmark_name') -> StatsTable:
+        """
+            Builds a table of latency percentiles in milliseconds,
+            saved by `MicroBench` with `save_latencies`, with a row
+            for every distinct value of `row_name_property`.
+        """
+        fields = ['msecs_' + percentile2str(q) for q in mb.MicroBench.percentiles]
+        fields.append('msecs_max')
+        rows = dict()
+        for s in self:
+            if row_name_property in s and fields[0] in s:
+                rows[s[row_name_property]] = [s.get(k, None) for k in fields]
+        row_names = sorted_values(rows.keys())
+        return st.StatsTable(
+            content=[rows[n] for n in row_names],
+            header_row=[k[len('msecs_'):] for k in fields],
+            header_col=row_names,
+        )
+
+    def hotspots_table(self, benchmark_name: str, **filters) -> StatsTable:
+        """
+            Builds a table of the functions, where the benchmark spent
+            most of its time, from the last matching entry with `hotspots`,
+            saved by `MicroBench` with `profile`.
+        """
+        entries = StatsSubset.filter(self, benchmark_name=benchmark_name, **filters)
+        hotspots = None
+        for s in entries:
+            if 'hotspots' in s:
+                hotspots = s['hotspots']
+        assert hotspots is not None, f'No profile for {benchmark_name}'
+        count_field = 'calls' if len(hotspots) and 'calls' in hotspots[0] else 'samples'
+        return st.StatsTable(
+            content=[[h['own_percent'], h['total_percent'], h.get(count_field, None)]
+                     for h in hotspots],
+            header_row=['Own %', 'Total %', count_field.capitalize()],
+            header_col=[f'`{h["function"]}`' for h in hotspots],
+        )
+
+    def latency_plot(self, title: str, row_name_property: str = 'benchmark_name', **kwargs) -> LatencyPlot:
+        """
+            Plots latency distributions of entries with a
+            `latency_histogram`, one line per `row_name_property`.
+        """
+        histograms = dict()
+        for s in self:
+            if row_name_property in s and 'latency_histogram' in s:
+                histograms[s[row_name_property]] = QuantileSketch.from_dict(
+                    s['latency_histogram'])
+        return LatencyPlot(histograms=histograms, title=title, **kwargs)
+
+    def timeline_plot(self, title: str, row_name_property: str = 'benchmark_name', **kwargs) -> TimelinePlot:
+        """
+            Plots resource usage of entries with a `resource_timeline`,
+            one line per `row_name_property`.
+        """
+        timelines = dict()
+        for s in self:
+            if row_name_property in s and 'resource_timeline' in s:
+                timelines[s[row_name_property]] = ResourceSampler.from_dict(
+                    s['resource_timeline'])
+        return TimelinePlot(timelines=timelines, title=title, **kwargs)
+
+# pragma region Lazy Evaluation
+
+    def _is_pending(self) -> bool:
+        return self.is_lazy() and \
+            (len(self._plan) > 0 or len(self._lazy_inputs) > 0)
+
+    def _materialize(self):
+        if not self._is_pending():
+            return
+        result = self._evaluate(None)
+        self._plan = list()
+        self._lazy_inputs = list()
+        self.dicts_list = result
+
+    def _evaluated(self, fields: set) -> StatsSubset:
+        """
+            Evaluates the plan into a temporary eager subset with
+            just the `fields` used by a single terminal operation.
+            The recorded plan is preserved for other terminals.
+        """
+        result = StatsSubset(columnar=self.columns is not None)
+        evaluated = self._evaluate(fields)
+        if self.columns is not None:
+            evaluated = StatsSubset.project(evaluated, fields)
+        result.dicts_list = evaluated
+        return result
+
+    def _evaluate(self, fields: Optional[set]) -> List[dict]:
+        plan, used_fields = StatsSubset.optimize(self._plan, fields)
 
-        return st.StatsTable(content=result, header_row=col_names, header_col=row_names)
+        # Lazy inputs are streamed, keeping only the used fields.
+        streams = list()
+        for idx, lazy_input in enumerate(self._lazy_inputs):
+            if isinstance(lazy_input, str):
+                lazy_input = sf.StatsFile.stream(lazy_input)
+            elif callable(lazy_input):
+                lazy_input = lazy_input()
+            elif iter(lazy_input) is lazy_input:
+                # Other terminals would find a one-shot iterator exhausted.
+                lazy_input = list(lazy_input)
+                self._lazy_inputs[idx] = lazy_input
+            if used_fields is not None:
+                lazy_input = StatsSubset.project(lazy_input, used_fields)
+            streams.append(lazy_input)
+        stream = itertools.chain(self._iterate_selected(), *streams)
+
+        for step in plan:
+            if step[0] == 'filter':
+                pred = StatsSubset.predicate(**step[1])
+                stream = (s for s in stream if pred(s))
+            elif step[0] == 'group':
+                stream = StatsSubset.group(stream, *step[1], **step[2])
+            elif step[0] == 'compact':
+                reduced_dict = StatsSubset.compact(list(stream), **step[1])
+                stream = [reduced_dict] if len(reduced_dict) else []
+        return list(stream)
+
+    @staticmethod
+    def project(inputs, fields: set):
+        for s in inputs:
+            yield {k: v for k, v in s.items() if k in fields}
+
+    @staticmethod
+    def optimize(plan: list, fields: Optional[set] = None) -> (list, Optional[set]):
+        """
+            Rewrites a recorded plan into a cheaper equivalent:
+            pushes filters on grouping keys below the groupings,
+            merges consecutive filters and finds the fields, that
+            the source must provide, if only `fields` of the
+            result are used. `None` means all fields are used.
+        """
+        plan = list(plan)
+
+        # Filters on grouping keys commute with the grouping.
+        swapped = True
+        while swapped:
+            swapped = False
+            for i in range(1, len(plan)):
+                previous, current = plan[i - 1], plan[i]
+                if current[0] == 'filter' and previous[0] == 'group' and \
+                        set(current[1].keys()).issubset(previous[1]):
+                    plan[i - 1], plan[i] = current, previous
+                    swapped = True
+
+        merged = list()
+        for step in plan:
+            if step[0] == 'filter' and len(merged) and merged[-1][0] == 'filter':
+                last_filters = merged[-1][1]
+                conflicts = any(k in last_filters and last_filters[k] != v
+                                for k, v in step[1].items())
+                if not conflicts:
+                    merged[-1] = ('filter', {**last_filters, **step[1]})
+                    continue
+            merged.append(step)
+
+        if fields is not None:
+            fields = set(fields)
+            for step in reversed(merged):
+                if step[0] == 'filter':
+                    fields |= set(step[1].keys())
+                elif step[0] == 'group':
+                    fields |= set(step[1]) | set(step[2].keys())
+                elif step[0] == 'compact':
+                    fields |= set(step[1].keys())
+        return merged, fields
+
+    # Results of regular expressions for every distinct string,
+    # for at most `_regex_patterns_limit` recently used patterns.
+    _regex_cache = dict()
+    _regex_cache_limit = 1 << 16
+    _regex_patterns_limit = 64
+
+    @staticmethod
+    def _cache_for(pattern: re.Pattern) -> dict:
+        caches = StatsSubset._regex_cache
+        cache = caches.pop(pattern, None)
+        if cache is None:
+            cache = dict()
+            while len(caches) >= StatsSubset._regex_patterns_limit:
+                caches.pop(next(iter(caches)), None)
+        # Re-inserting moves the pattern to the end of the LRU order.
+        caches[pattern] = cache
+        return cache
 
     @staticmethod
     def predicate(**filters) -> object:
-        def matches(s):
-            for property_name, filter_criterea in filters.items():
-                assert isinstance(
-                    property_name, str), 'Undefined key in the filter'
-                assert (filter_criterea is not None), 'Undefined value in the filter'
-                current_value = s.get(property_name, None)
-
-                if isinstance(filter_criterea, re.Pattern):
-                    if not isinstance(current_value, str):
-                        return False
-                    if not filter_criterea.search(current_value):
-                        return False
-                    else:
-                        return True
-                if current_value != filter_criterea:
+        """
+            Compiles the filters into a single callable.
+            Equality criterea are checked first, all at once.
+            Regular expressions only run once per distinct string.
+        """
+        equal_keys = list()
+        equal_vals = list()
+        patterns = list()
+        for property_name, filter_criterea in filters.items():
+            assert isinstance(
+                property_name, str), 'Undefined key in the filter'
+            assert (filter_criterea is not None), 'Undefined value in the filter'
+            if isinstance(filter_criterea, re.Pattern):
+                cache = StatsSubset._cache_for(filter_criterea)
+                patterns.append((property_name, filter_criterea, cache))
+            else:
+                equal_keys.append(property_name)
+                equal_vals.append(filter_criterea)
+        equal_keys = tuple(equal_keys)
+        equal_vals = tuple(equal_vals)
+
+        def matches_pattern(s, property_name, pattern, cache) -> bool:
+            current_value = s.get(property_name, None)
+            if not isinstance(current_value, str):
+                return False
+            found = cache.get(current_value, None)
+            if found is None:
+                if len(cache) >= StatsSubset._regex_cache_limit:
+                    cache.clear()
+                found = pattern.search(current_value) is not None
+                cache[current_value] = found
+            return found
+
+        if len(patterns) == 0:
+            if len(equal_keys) == 1:
+                key, val = equal_keys[0], equal_vals[0]
+                return lambda s: s.get(key, None) == val
+            return lambda s: tuple(map(s.get, equal_keys)) == equal_vals
+
+        def matches(s) -> bool:
+            if len(equal_keys) and tuple(map(s.get, equal_keys)) != equal_vals:
+                return False
+            for property_name, pattern, cache in patterns:
+                if not matches_pattern(s, property_name, pattern, cache):
                     return False
             return True
         return matches
@@ -120,42 +587,88 @@ class StatsSubset(object):
         """
             Reduces all the dictionaries in this subset by applying
             specified policies to every key in the range.
+            Policies with `Accumulator` counterparts are evaluated
+            online, others receive the list of all values.
         """
         if len(inputs) == 0:
             return dict()
         if len(inputs) == 1:
             return inputs[0]
 
-        reduced_dict = dict()
-        for aggregated_property, aggregation_policy in aggregation_policies.items():
-            all_vals = [s.get(aggregated_property)
-                        for s in inputs if aggregated_property in s]
-            if len(all_vals) == 0:
-                continue
-            reduced_val = aggregation_policy(all_vals)
-            reduced_dict[aggregated_property] = reduced_val
-
-        return reduced_dict
+        reductions = StatsSubset._start_reductions(aggregation_policies)
+        for s in inputs:
+            StatsSubset._update_reductions(reductions, s)
+        return StatsSubset._finish_reductions(reductions, aggregation_policies)
 
     @staticmethod
     def group(inputs, *grouping_keys, **aggregation_policies) -> List[dict]:
         """
-            Grouping is filtering and compaction chained togethers.
-            First we identify all unique combinations of `grouping_keys`.
-            For every such combination we group matching stats.
-            Once those groups are formed, we `compact()` them into single entries.
+            Grouping is filtering and compaction chained together.
+            In a single pass we bucket stats by the tuple of their
+            `grouping_keys` values, so only existing combinations
+            form groups. Stats missing any of the keys are skipped.
+            Every group is then reduced like in `compact()`, keeping
+            just the running state of the aggregation policies.
         """
+        groups = dict()
+        for s in inputs:
+            if not all(k in s for k in grouping_keys):
+                continue
+            combo = tuple(s[k] for k in grouping_keys)
+            group = groups.get(combo)
+            if group is None:
+                # Singular groups are exported as is, just like in `compact()`.
+                group = [s, 0, StatsSubset._start_reductions(
+                    aggregation_policies)]
+                groups[combo] = group
+            group[1] += 1
+            StatsSubset._update_reductions(group[2], s)
+
         result = list()
-        values_per_key = [get_unique(inputs, k) for k in grouping_keys]
-
-        for combo in itertools.product(*values_per_key):
-            combo_filter = dict()
-            for i, k in enumerate(grouping_keys):
-                combo_filter[k] = combo[i]
-            matching_stats = StatsSubset.filter(inputs, **combo_filter)
-            reduced_stats = StatsSubset.compact(
-                matching_stats, **aggregation_policies)
-            reduced_stats = {**reduced_stats, **combo_filter}
+        for combo, (first_stats, count_stats, reductions) in groups.items():
+            if count_stats == 1:
+                reduced_stats = first_stats
+            else:
+                reduced_stats = StatsSubset._finish_reductions(
+                    reductions, aggregation_policies)
+            reduced_stats = {**reduced_stats, **dict(zip(grouping_keys, combo))}
             result.append(reduced_stats)
 
         return result
+
+    @staticmethod
+    def _start_reductions(aggregation_policies: dict) -> dict:
+        reductions = dict()
+        for aggregated_property, aggregation_policy in aggregation_policies.items():
+            make_accumulator = Aggregation.accumulator_for(aggregation_policy)
+            if make_accumulator is None:
+                reductions[aggregated_property] = list()
+            else:
+                reductions[aggregated_property] = make_accumulator()
+        return reductions
+
+    @staticmethod
+    def _update_reductions(reductions: dict, s: dict):
+        for aggregated_property, reduction in reductions.items():
+            if aggregated_property not in s:
+                continue
+            val = s[aggregated_property]
+            if isinstance(reduction, list):
+                reduction.append(val)
+            else:
+                reduction.add(val)
+
+    @staticmethod
+    def _finish_reductions(reductions: dict, aggregation_policies: dict) -> dict:
+        reduced_dict = dict()
+        for aggregated_property, reduction in reductions.items():
+            if isinstance(reduction, list):
+                if len(reduction) == 0:
+                    continue
+                policy = aggregation_policies[aggregated_property]
+                reduced_dict[aggregated_property] = policy(reduction)
+            else:
+                if reduction.count == 0:
+                    continue
+                reduced_dict[aggregated_property] = reduction.result()
+        return reduced_dict
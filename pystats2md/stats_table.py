@@ -16,15 +16,26 @@ class StatsTable(object):
         content: List[List[str]],
         header_row: Optional[List[str]],
         header_col: Optional[List[str]],
+        deep_copy: bool = False,
     ):
+        """
+            Takes ownership of the `content` and the headers,
+            which are modified in place by the `add_*()` and
+            `printable_*()` methods. Pass `deep_copy=True`,
+            if the caller still needs the originals.
+        """
         assert isinstance(content, list)
         if header_row is not None:
             assert isinstance(header_row, list)
         if header_col is not None:
             assert isinstance(header_col, list)
-        self.content = copy.deepcopy(content)
-        self.header_row = copy.deepcopy(header_row)
-        self.header_col = copy.deepcopy(header_col)
+        if deep_copy:
+            content = copy.deepcopy(content)
+            header_row = copy.deepcopy(header_row)
+            header_col = copy.deepcopy(header_col)
+        self.content = content
+        self.header_row = header_row
+        self.header_col = header_col
 
     def rows(self) -> int:
         return len(self.header_col)
@@ -98,7 +109,7 @@ class StatsTable(object):
                 mean_gain_in_row = sum(gains_in_row) / count_cols
                 gains_per_row.append(mean_gain_in_row)
         else:
-            title = self.header_row[column] + ' Gains'    
+            title = f'{self.header_row[column]} Gains'    
             values = list(map(self._numeric_value, self._only_col(column)))
             baseline = values[baseline_row]
             gains_per_row = [v / baseline for v in values]
@@ -138,7 +149,7 @@ class StatsTable(object):
                 else:
                     r.append(f'# {idx + 1}')
 
-        self.header_row.append(title + ' Ranking')
+        self.header_row.append(f'{title} Ranking')
         return self
 
     def add_emoji(
@@ -199,7 +210,7 @@ class StatsTable(object):
 
         # https://github.com/ikatyang/emoji-cheat-sheet/blob/master/README.md
         # https://gist.github.com/AliMD/3344523
-        self.header_row.append(title + ' Result')
+        self.header_row.append(f'{title} Result')
         return self
 
     def print(self) -> str:
@@ -212,12 +223,12 @@ class StatsTable(object):
         result = list()
         result.append(list())
         result[0].append('')
-        result[0].extend(self.header_row)
+        result[0].extend(map(num2str, self.header_row))
         content_strs = [[num2str(c) for c in r] for r in self.content]
 
         for idx_row in range(len(self.header_col)):
             result.append(list())
-            result[idx_row+1].append(self.header_col[idx_row])
+            result[idx_row+1].append(num2str(self.header_col[idx_row]))
             result[idx_row+1].extend(content_strs[idx_row])
 
         return table2str(result)
@@ -0,0 +1,313 @@
+from __future__ import annotations
+from typing import List, Optional, Tuple
+from html import escape
+import math
+
+
+# Plotly's `px.colors.qualitative.Prism`.
+prism_colors = [
+    'rgb(95, 70, 144)',
+    'rgb(29, 105, 150)',
+    'rgb(56, 166, 165)',
+    'rgb(15, 133, 84)',
+    'rgb(115, 175, 72)',
+    'rgb(237, 173, 8)',
+    'rgb(225, 124, 5)',
+    'rgb(204, 80, 62)',
+    'rgb(148, 52, 110)',
+    'rgb(111, 64, 112)',
+    'rgb(102, 102, 102)',
+]
+
+
+def _escape(text) -> str:
+    return escape(str(text), quote=False)
+
+
+_si_prefixes = ['y', 'z', 'a', 'f', 'p', 'n', 'µ', 'm', '', 'k', 'M', 'G', 'T', 'P', 'E', 'Z', 'Y']
+
+
+def si2str(num: float, significant: int = 2, trim: bool = False) -> str:
+    """
+        Formats numbers with SI prefixes, like the `.2s` format
+        of D3 and Plotly: `1234` is `1.2k`, `0.00056` is `560µ`.
+    """
+    if num == 0 or not math.isfinite(num):
+        return '0' if num == 0 else str(num)
+    power = math.floor(math.log10(abs(num)))
+    prefix = max(-8, min(8, math.floor(power / 3)))
+    scaled = num / 10 ** (prefix * 3)
+    digits = max(0, significant - 1 - math.floor(math.log10(abs(scaled))))
+    result = f'{scaled:.{digits}f}'
+    # Rounding can produce one more digit, like `999.7` into `1000`.
+    if abs(float(result)) >= 1000 and prefix < 8:
+        return si2str(math.copysign(1000, num) * 10 ** (prefix * 3), significant, trim)
+    if trim and '.' in result:
+        result = result.rstrip('0').rstrip('.')
+    return result + _si_prefixes[prefix + 8]
+
+
+def nice_ticks(low: float, high: float, count: int = 5) -> List[float]:
+    """
+        Round tick values covering `[low, high]`, spaced by 1, 2 or 5
+        times a power of ten.
+    """
+    if high <= low:
+        high = low + 1
+    raw_step = (high - low) / count
+    magnitude = 10 ** math.floor(math.log10(raw_step))
+    step = magnitude * 10
+    for multiple in [1, 2, 5, 10]:
+        if raw_step <= multiple * magnitude:
+            step = multiple * magnitude
+            break
+    first = math.floor(low / step)
+    last = math.ceil(high / step)
+    return [i * step for i in range(first, last + 1)]
+
+
+class SVGBarChart(object):
+    """
+        Dependency-free renderer of grouped bar charts, following the
+        layout of the Plotly charts produced by `StatsPlot`: a title,
+        value labels, rotated category names and a legend in the
+        top-left corner. Produces a standalone SVG document.
+    """
+
+    font = 'font-family="Open Sans, verdana, arial, sans-serif"'
+
+    def __init__(
+        self,
+        title: str,
+        groups: List[str],
+        series: List[Tuple[str, List[Optional[float]]]],
+        print_height: bool = True,
+        width: int = 700,
+        height: int = 500,
+        bargap: float = 0.15,
+        bargroupgap: float = 0.1,
+    ):
+        self.title = title
+        self.groups = groups
+        self.series = series
+        self.print_height = print_height
+        self.width = width
+        self.height = height
+        self.bargap = bargap
+        self.bargroupgap = bargroupgap
+
+    def render(self) -> str:
+        vals = [v for _, vs in self.series for v in vs
+                if isinstance(v, (int, float)) and math.isfinite(v)]
+        ticks = nice_ticks(min(vals + [0]), max(vals + [0]))
+        low, high = ticks[0], ticks[-1]
+
+        # Rotated category names need more space at the bottom.
+        longest = max([len(str(g)) for g in self.groups] + [1])
+        left, right, top = 80, 80, 100
+        bottom = min(80 + longest * 5, self.height // 2)
+        plot_width = self.width - left - right
+        plot_height = self.height - top - bottom
+
+        def y_of(val: float) -> float:
+            return top + plot_height * (high - val) / (high - low)
+
+        out = [
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{self.width}" height="{self.height}" '
+            f'viewBox="0 0 {self.width} {self.height}">',
+            f'<rect width="{self.width}" height="{self.height}" fill="white"/>',
+            f'<rect x="{left}" y="{top}" width="{plot_width}" height="{plot_height}" fill="rgb(229, 236, 246)"/>',
+            f'<text x="{left}" y="{top / 2}" {self.font} font-size="17" fill="rgb(42, 63, 95)">'
+            f'{_escape(self.title)}</text>',
+        ]
+
+        # Grid lines and their values.
+        for tick in ticks:
+            y = y_of(tick)
+            out.append(
+                f'<line x1="{left}" x2="{left + plot_width}" y1="{y:.2f}" y2="{y:.2f}" '
+                f'stroke="white" stroke-width="{2 if tick == 0 else 1}"/>')
+            out.append(
+                f'<text x="{left - 6}" y="{y + 4:.2f}" {self.font} font-size="12" '
+                f'fill="rgb(42, 63, 95)" text-anchor="end">{si2str(tick, 3, trim=True)}</text>')
+
+        # Bars of every series are placed side-by-side inside every group.
+        slot = plot_width / max(len(self.groups), 1)
+        group_width = slot * (1 - self.bargap)
+        bar_slot = group_width / max(len(self.series), 1)
+        bar_width = bar_slot * (1 - self.bargroupgap)
+        zero = y_of(0)
+        for series_idx, (name, vs) in enumerate(self.series):
+            color = prism_colors[series_idx % len(prism_colors)]
+            for group_idx, val in enumerate(vs[:len(self.groups)]):
+                if not isinstance(val, (int, float)) or not math.isfinite(val):
+                    continue
+                x = left + slot * group_idx + (slot - group_width) / 2 + \
+                    bar_slot * series_idx + (bar_slot - bar_width) / 2
+                y = min(y_of(val), zero)
+                h = abs(zero - y_of(val))
+                out.append(
+                    f'<rect x="{x:.2f}" y="{y:.2f}" width="{bar_width:.2f}" height="{h:.2f}" fill="{color}">'
+                    f'<title>{_escape(name)}: {val}</title></rect>')
+                if self.print_height:
+                    label_y = y - 4 if val >= 0 else y + h + 12
+                    out.append(
+                        f'<text x="{x + bar_width / 2:.2f}" y="{label_y:.2f}" {self.font} font-size="10" '
+                        f'fill="rgb(42, 63, 95)" text-anchor="middle">{si2str(val)}</text>')
+
+        # Category names, rotated by 45 degrees.
+        for group_idx, group in enumerate(self.groups):
+            x = left + slot * (group_idx + 0.5)
+            y = top + plot_height + 14
+            out.append(
+                f'<text x="{x:.2f}" y="{y:.2f}" {self.font} font-size="12" fill="rgb(42, 63, 95)" '
+                f'text-anchor="end" transform="rotate(-45 {x:.2f} {y:.2f})">{_escape(group)}</text>')
+
+        # Legend in the top-left corner of the plotting area.
+        for series_idx, (name, _) in enumerate(self.series):
+            color = prism_colors[series_idx % len(prism_colors)]
+            y = top + 10 + series_idx * 19
+            out.append(
+                f'<rect x="{left + 8}" y="{y}" width="12" height="12" fill="{color}"/>')
+            out.append(
+                f'<text x="{left + 26}" y="{y + 10}" {self.font} font-size="12" '
+                f'fill="rgb(42, 63, 95)">{_escape(name)}</text>')
+
+        out.append('</svg>')
+        return '\n'.join(out) + '\n'
+
+    def save_to(self, path: str) -> str:
+        with open(path, 'w') as f:
+            f.write(self.render())
+        return path
+
+
+class SVGLineChart(object):
+    """
+        Dependency-free renderer of line charts, matching the look of
+        `SVGBarChart`. Every series is a list of `(x, y)` points.
+        With `step`, lines go horizontally first, like Plotly's 'hv'
+        shape, which suits cumulative distributions.
+    """
+
+    font = SVGBarChart.font
+
+    def __init__(
+        self,
+        title: str,
+        series: List[Tuple[str, List[Tuple[float, float]]]],
+        x_title: str = '',
+        y_title: str = '',
+        log_x: bool = False,
+        step: bool = False,
+        y_range: Optional[Tuple[float, float]] = None,
+        width: int = 700,
+        height: int = 500,
+    ):
+        self.title = title
+        self.series = series
+        self.x_title = x_title
+        self.y_title = y_title
+        self.log_x = log_x
+        self.step = step
+        self.y_range = y_range
+        self.width = width
+        self.height = height
+
+    def _x_ticks(self, xs: List[float]) -> List[float]:
+        if not self.log_x:
+            return nice_ticks(min(xs + [0]), max(xs + [0]))
+        positives = [x for x in xs if x > 0] or [1]
+        first = math.floor(math.log10(min(positives)))
+        last = max(math.ceil(math.log10(max(positives))), first + 1)
+        return [10 ** p for p in range(first, last + 1)]
+
+    def render(self) -> str:
+        points = [(x, y) for _, ps in self.series for x, y in ps
+                  if math.isfinite(x) and math.isfinite(y) and (x > 0 or not self.log_x)]
+        x_ticks = self._x_ticks([x for x, _ in points])
+        if self.y_range is not None:
+            y_ticks = nice_ticks(*self.y_range)
+        else:
+            y_ticks = nice_ticks(min([y for _, y in points] + [0]),
+                                 max([y for _, y in points] + [0]))
+        x_low, x_high = x_ticks[0], x_ticks[-1]
+        y_low, y_high = y_ticks[0], y_ticks[-1]
+
+        left, right, top, bottom = 80, 80, 100, 80
+        plot_width = self.width - left - right
+        plot_height = self.height - top - bottom
+
+        def x_of(val: float) -> float:
+            if self.log_x:
+                share = math.log10(val / x_low) / math.log10(x_high / x_low)
+            else:
+                share = (val - x_low) / (x_high - x_low)
+            return left + plot_width * share
+
+        def y_of(val: float) -> float:
+            return top + plot_height * (y_high - val) / (y_high - y_low)
+
+        out = [
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{self.width}" height="{self.height}" '
+            f'viewBox="0 0 {self.width} {self.height}">',
+            f'<rect width="{self.width}" height="{self.height}" fill="white"/>',
+            f'<rect x="{left}" y="{top}" width="{plot_width}" height="{plot_height}" fill="rgb(229, 236, 246)"/>',
+            f'<text x="{left}" y="{top / 2}" {self.font} font-size="17" fill="rgb(42, 63, 95)">'
+            f'{_escape(self.title)}</text>',
+        ]
+
+        # Grid lines and their values along both axes.
+        for tick in y_ticks:
+            y = y_of(tick)
+            out.append(
+                f'<line x1="{left}" x2="{left + plot_width}" y1="{y:.2f}" y2="{y:.2f}" stroke="white"/>')
+            out.append(
+                f'<text x="{left - 6}" y="{y + 4:.2f}" {self.font} font-size="12" '
+                f'fill="rgb(42, 63, 95)" text-anchor="end">{si2str(tick, 3, trim=True)}</text>')
+        for tick in x_ticks:
+            x = x_of(tick)
+            out.append(
+                f'<line x1="{x:.2f}" x2="{x:.2f}" y1="{top}" y2="{top + plot_height}" stroke="white"/>')
+            out.append(
+                f'<text x="{x:.2f}" y="{top + plot_height + 16}" {self.font} font-size="12" '
+                f'fill="rgb(42, 63, 95)" text-anchor="middle">{si2str(tick, 3, trim=True)}</text>')
+        out.append(
+            f'<text x="{left + plot_width / 2}" y="{self.height - 30}" {self.font} font-size="14" '
+            f'fill="rgb(42, 63, 95)" text-anchor="middle">{_escape(self.x_title)}</text>')
+        y_middle = top + plot_height / 2
+        out.append(
+            f'<text x="{left - 50}" y="{y_middle}" {self.font} font-size="14" fill="rgb(42, 63, 95)" '
+            f'text-anchor="middle" transform="rotate(-90 {left - 50} {y_middle})">{_escape(self.y_title)}</text>')
+
+        for series_idx, (name, ps) in enumerate(self.series):
+            color = prism_colors[series_idx % len(prism_colors)]
+            ps = [(x, y) for x, y in ps
+                  if math.isfinite(x) and math.isfinite(y) and (x > 0 or not self.log_x)]
+            coords = list()
+            for idx, (x, y) in enumerate(ps):
+                if self.step and idx > 0:
+                    coords.append(f'{x_of(x):.2f},{y_of(ps[idx - 1][1]):.2f}')
+                coords.append(f'{x_of(x):.2f},{y_of(y):.2f}')
+            out.append(
+                f'<polyline points="{" ".join(coords)}" fill="none" stroke="{color}" stroke-width="2">'
+                f'<title>{_escape(name)}</title></polyline>')
+
+        # Legend in the top-left corner of the plotting area.
+        for series_idx, (name, _) in enumerate(self.series):
+            color = prism_colors[series_idx % len(prism_colors)]
+            y = top + 10 + series_idx * 19
+            out.append(
+                f'<line x1="{left + 8}" x2="{left + 20}" y1="{y + 6}" y2="{y + 6}" '
+                f'stroke="{color}" stroke-width="2"/>')
+            out.append(
+                f'<text x="{left + 26}" y="{y + 10}" {self.font} font-size="12" '
+                f'fill="rgb(42, 63, 95)">{_escape(name)}</text>')
+
+        out.append('</svg>')
+        return '\n'.join(out) + '\n'
+
+    def save_to(self, path: str) -> str:
+        with open(path, 'w') as f:
+            f.write(self.render())
+        return path